@@ -5,18 +5,55 @@ Integrates with Breeze-ASR-25 for Chinese speech recognition.
 
 import asyncio
 import io
+import json
 import logging
+import math
+import os
+import random
+import subprocess
+import threading
+import time
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Optional
+
+from cancellation import Cancelled, current_token, check_cancelled
+from logs import ChunkEvents
+from startup import profile as startup_profile, timed_import
 
 logger = logging.getLogger(__name__)
+chunk_log = ChunkEvents(__name__)
+
+# 每個 inference thread 重複使用的 float32 buffer
+_float_workspace = threading.local()
 
 
-def decode_audio(audio_data: bytes) -> bytes:
+def _run_ffmpeg(args: list[str], timeout: float, stdout=subprocess.PIPE) -> subprocess.CompletedProcess:
+    """執行 ffmpeg；目前的工作被取消 (cancel_scope) 時直接 kill，不等它解完"""
+    token = current_token()
+    deadline = time.monotonic() + timeout
+    proc = subprocess.Popen(args, stdout=stdout, stderr=subprocess.PIPE)
+    while True:
+        remaining = deadline - time.monotonic()
+        try:
+            out, err = proc.communicate(timeout=min(remaining, 0.05) if token else remaining)
+            return subprocess.CompletedProcess(args, proc.returncode, out, err)
+        except subprocess.TimeoutExpired:
+            if token and token.cancelled:
+                proc.kill()
+                proc.communicate()
+                raise Cancelled()
+            if time.monotonic() >= deadline:
+                proc.kill()
+                proc.communicate()
+                raise
+
+
+def decode_audio(audio_data: bytes, timeout: float = 10) -> bytes:
     """將 WebM/Opus 音訊轉換為 PCM 16-bit 16kHz mono"""
-    import subprocess
     import tempfile
-    import os
+
+    check_cancelled()
 
     try:
         # 寫入暫存檔，因為 ffmpeg pipe 無法識別 webm 格式
@@ -25,7 +62,7 @@ def decode_audio(audio_data: bytes) -> bytes:
             input_path = f.name
 
         try:
-            result = subprocess.run(
+            result = _run_ffmpeg(
                 [
                     'ffmpeg', '-y', '-hide_banner', '-loglevel', 'error',
                     '-i', input_path,
@@ -33,12 +70,11 @@ def decode_audio(audio_data: bytes) -> bytes:
                     '-ar', '16000', '-ac', '1',
                     'pipe:1'
                 ],
-                capture_output=True,
-                timeout=10
+                timeout=timeout
             )
 
             if result.returncode == 0 and result.stdout:
-                logger.info(f"Audio decoded: {len(audio_data)} -> {len(result.stdout)} bytes")
+                chunk_log.event("audio decoded", bytes_in=len(audio_data), bytes_out=len(result.stdout))
                 return result.stdout
             else:
                 logger.warning(f"ffmpeg error: {result.stderr.decode()[:200]}")
@@ -46,19 +82,164 @@ def decode_audio(audio_data: bytes) -> bytes:
         finally:
             os.unlink(input_path)
 
+    except Cancelled:
+        raise
     except Exception as e:
         logger.warning(f"Audio decode failed: {e}")
         return audio_data
 
 
+def decode_audio_file(input_path: str, output_path: str, timeout: float = 3600) -> int:
+    """
+    將任意音訊檔轉成 PCM 16-bit 16kHz mono 直接寫到 output_path
+    ffmpeg 輸出不經過 Python 記憶體，長錄音也不會整段讀進來；回傳 PCM bytes 數
+    """
+    import os
+
+    result = _run_ffmpeg(
+        [
+            'ffmpeg', '-y', '-hide_banner', '-loglevel', 'error',
+            '-i', input_path,
+            '-f', 's16le', '-acodec', 'pcm_s16le',
+            '-ar', '16000', '-ac', '1',
+            output_path
+        ],
+        stdout=subprocess.DEVNULL,
+        timeout=timeout
+    )
+    if result.returncode != 0:
+        raise ValueError(f"ffmpeg error: {result.stderr.decode()[:200]}")
+
+    size = os.path.getsize(output_path)
+    logger.info(f"Audio file decoded: {input_path} -> {size} bytes PCM")
+    return size
+
+
+def pcm_to_wav(pcm_data: bytes, sample_rate: int = 16000) -> bytes:
+    """替 PCM 16-bit mono 加上 WAV header"""
+    import struct
+
+    header = b''.join([
+        b'RIFF',
+        struct.pack('<I', 36 + len(pcm_data)),
+        b'WAVE',
+        b'fmt ',
+        struct.pack('<I', 16),               # chunk size
+        struct.pack('<H', 1),                # audio format (PCM)
+        struct.pack('<H', 1),                # channels
+        struct.pack('<I', sample_rate),      # sample rate
+        struct.pack('<I', sample_rate * 2),  # byte rate
+        struct.pack('<H', 2),                # block align
+        struct.pack('<H', 16),               # bits per sample
+        b'data',
+        struct.pack('<I', len(pcm_data)),
+    ])
+    return header + pcm_data
+
+
+class WebMStreamDecoder:
+    """
+    單一連續 MediaRecorder 串流 -> PCM 16-bit 16kHz mono
+    WebMStreamDemuxer 保留 header、只取出新到的 Opus packet，decoder 狀態跨 chunk 保留，
+    不需要每個 chunk 都是完整檔案，也沒有重啟錄音造成的空隙
+    有 PyAV (faster-whisper 的依賴) 就直接解 packet；沒有的話把 header + 新的 cluster 交給 ffmpeg
+    """
+
+    def __init__(self):
+        from webm import WebMStreamDemuxer
+
+        try:
+            import av
+            self._av = av
+        except ImportError:
+            logger.warning("PyAV not available, continuous WebM stream falls back to ffmpeg per chunk")
+            self._av = None
+
+        self.demuxer = WebMStreamDemuxer(keep_media=self._av is None)
+        self._codec = None
+        self._resampler = None
+
+    def feed(self, data: bytes) -> bytes:
+        """餵入下一段串流，回傳新解出來的 PCM"""
+        packets = self.demuxer.feed(data)
+        if not self.demuxer.ready:
+            return b""
+
+        if self._av is None:
+            media = self.demuxer.take_media()
+            return decode_audio(self.demuxer.header + media) if media else b""
+
+        if self._codec is None:
+            self._open_codec()
+
+        import numpy as np
+
+        # OpusHead 的 pre-skip 由 decoder 處理 (extradata)
+        pcm = bytearray()
+        for packet in packets:
+            for frame in self._codec.decode(self._av.Packet(packet.data)):
+                for resampled in self._resampler.resample(frame):
+                    pcm.extend(resampled.to_ndarray().astype(np.int16, copy=False).tobytes())
+        return bytes(pcm)
+
+    def _open_codec(self) -> None:
+        codec_name = {"A_OPUS": "opus", "A_VORBIS": "vorbis"}.get(self.demuxer.codec)
+        if codec_name is None:
+            raise ValueError(f"Unsupported codec in WebM stream: {self.demuxer.codec}")
+
+        self._codec = self._av.CodecContext.create(codec_name, "r")
+        private = self.demuxer.codec_private
+        if private:
+            self._codec.extradata = private
+        # resampler 也跨 chunk 保留，邊界不會有不連續
+        self._resampler = self._av.AudioResampler(format="s16", layout="mono", rate=16000)
+        logger.info(f"WebM stream decoder opened ({codec_name})")
+
+
+def pcm_to_float32(pcm_data) -> "np.ndarray":
+    """
+    PCM 16-bit (bytes / bytearray / memoryview) -> float32 [-1, 1)
+    直接寫進這個 thread 重複使用的 buffer，不另外配置 int16 或 float32 陣列
+    回傳的是 buffer 的 view，同一個 thread 下次呼叫前有效
+    """
+    import numpy as np
+
+    samples = np.frombuffer(pcm_data, dtype=np.int16)
+    buffer = getattr(_float_workspace, "buffer", None)
+    if buffer is None or len(buffer) < len(samples):
+        # 至少 30 秒 (Whisper 一次看的長度)，之後不用再長大
+        buffer = np.empty(max(len(samples), 30 * 16000), dtype=np.float32)
+        _float_workspace.buffer = buffer
+    audio = buffer[:len(samples)]
+    # 先轉型再原地縮放；直接 np.multiply(..., out=) 會為了轉型另外配置暫存 buffer
+    np.copyto(audio, samples, casting="safe")
+    audio *= np.float32(1 / 32768.0)
+    return audio
+
+
 @dataclass
 class TranscriptionResult:
     text: str
     is_final: bool
     confidence: float = 1.0
+    utterance_id: Optional[int] = None  # hybrid 模式用來讓 final 取代同一句的 partial
+    duration: float = 0.0  # 辨識的音訊長度 (秒)，0 = 未知
+
+
+@dataclass
+class TranscriptSegment:
+    """辨識途中解出的一段文字，start / end 是相對於輸入音訊開頭的秒數"""
+    text: str
+    start: float
+    end: float
 
 
 class ASRService(ABC):
+    # True = transcribe_stream 會邊解碼邊產生段落；False 則整段辨識完才有一個段落
+    streams_segments = False
+    # True = transcribe_pcm / transcribe_stream 可以傳入 IncrementalLogMel，不用從頭重算整段的 log-mel
+    accepts_features = False
+
     @abstractmethod
     async def initialize(self) -> None:
         pass
@@ -67,15 +248,76 @@ class ASRService(ABC):
     async def transcribe(self, audio_data: bytes) -> TranscriptionResult:
         pass
 
+    async def transcribe_pcm(self, pcm_data: bytes) -> TranscriptionResult:
+        """辨識已解碼的 PCM 16-bit 16kHz mono (預設包成 WAV 再走 transcribe)"""
+        return await self.transcribe(pcm_to_wav(pcm_data))
+
+    async def transcribe_stream(self, pcm_data: bytes) -> AsyncIterator[TranscriptSegment]:
+        """
+        同 transcribe_pcm，但每解出一段就產生一個 TranscriptSegment
+        迭代完之後用 join_segments 取得完整結果 (含後處理)
+        """
+        result = await self.transcribe_pcm(pcm_data)
+        if result.text:
+            yield TranscriptSegment(text=result.text, start=0.0, end=result.duration)
+
+    def join_segments(self, segments: list[TranscriptSegment], duration: float) -> TranscriptionResult:
+        """transcribe_stream 產生的段落接成完整結果；預設段落已經是後處理過的結果"""
+        return TranscriptionResult(
+            text="".join(segment.text for segment in segments), is_final=True, duration=duration
+        )
+
     @abstractmethod
     async def reset(self) -> None:
         pass
 
+    @property
+    def ready(self) -> bool:
+        """模型 / 服務已經初始化完成，可以辨識"""
+        return getattr(self, "_initialized", True)
+
+
+async def transcribe_streaming(
+    service: ASRService, pcm_data: bytes, on_segment: Callable[[TranscriptSegment], None]
+) -> TranscriptionResult:
+    """transcribe_stream + join_segments；每解出一段就呼叫 on_segment (在辨識的 thread 上)"""
+    segments = []
+    async for segment in service.transcribe_stream(pcm_data):
+        segments.append(segment)
+        on_segment(segment)
+    return service.join_segments(segments, len(pcm_data) / 32000)
+
+
+def parse_latency(spec: str) -> tuple[str, tuple[float, ...]]:
+    """
+    MOCK_ASR_LATENCY 格式 "分佈:參數" (秒)
+    fixed:0.1 | uniform:0.05,0.3 | normal:0.2,0.05 | lognormal:0.2,0.5 (中位數, sigma) | rtf:0.3 (音訊長度的倍數)
+    """
+    kind, _, params = spec.partition(":")
+    kind = kind.strip().lower()
+    values = tuple(float(v) for v in params.split(",") if v.strip())
+    expected = {"fixed": 1, "uniform": 2, "normal": 2, "lognormal": 2, "rtf": 1}
+    if kind not in expected or len(values) != expected[kind]:
+        raise ValueError(f"Invalid mock latency: {spec!r}")
+    return kind, values
+
 
 class MockASRService(ASRService):
-    """Mock ASR service for development and testing."""
+    """
+    Mock ASR service for development and testing.
+    latency 決定每次辨識花多久 (見 parse_latency)，cpu 決定這段時間怎麼花:
+    sleep = 不用 CPU，只佔住 worker；burn = 純 Python 迴圈 (持有 GIL)；numpy = 矩陣運算 (釋放 GIL，像原生推論)
+    沒有模型、沒有網路也能對伺服器做負載測試
+    """
 
-    def __init__(self):
+    CPU_MODES = ("sleep", "burn", "numpy")
+
+    def __init__(self, latency: str = "fixed:0.1", cpu: str = "sleep", seed: Optional[int] = None):
+        if cpu not in self.CPU_MODES:
+            raise ValueError(f"Invalid mock CPU mode: {cpu!r} (use {', '.join(self.CPU_MODES)})")
+        self.latency = parse_latency(latency)
+        self.cpu = cpu
+        self._random = random.Random(seed)
         self._initialized = False
         self._mock_responses = [
             "你好",
@@ -94,16 +336,56 @@ class MockASRService(ASRService):
         logger.info("Mock ASR Service initialized")
 
     async def transcribe(self, audio_data: bytes) -> TranscriptionResult:
+        from webm import webm_duration
+        return await self._respond(webm_duration(audio_data) or 0.0)
+
+    async def transcribe_pcm(self, pcm_data: bytes) -> TranscriptionResult:
+        return await self._respond(len(pcm_data) / 2 / 16000)
+
+    def _sample_latency(self, duration: float) -> float:
+        kind, values = self.latency
+        if kind == "fixed":
+            return values[0]
+        if kind == "uniform":
+            return self._random.uniform(*values)
+        if kind == "normal":
+            return max(0.0, self._random.gauss(*values))
+        if kind == "lognormal":
+            median, sigma = values
+            return median * math.exp(self._random.gauss(0.0, sigma))
+        return values[0] * duration  # rtf
+
+    def _burn(self, seconds: float) -> None:
+        """佔用 CPU 指定秒數，中途可以被取消"""
+        deadline = time.perf_counter() + seconds
+        if self.cpu == "numpy":
+            import numpy as np
+            matrix = np.ones((128, 128), dtype=np.float32)
+            while time.perf_counter() < deadline:
+                matrix @ matrix
+                check_cancelled()
+        else:
+            while time.perf_counter() < deadline:
+                for _ in range(10000):
+                    pass
+                check_cancelled()
+
+    async def _respond(self, duration: float) -> TranscriptionResult:
         if not self._initialized:
             await self.initialize()
 
         # Simulate processing time
-        await asyncio.sleep(0.1)
+        latency = self._sample_latency(duration)
+        if self.cpu == "sleep":
+            await asyncio.sleep(latency)
+        else:
+            self._burn(latency)
+        check_cancelled()
 
         response = self._mock_responses[self._response_index % len(self._mock_responses)]
         self._response_index += 1
 
-        return TranscriptionResult(text=response, is_final=True, confidence=0.95)
+        return TranscriptionResult(text=response, is_final=True, confidence=0.95, duration=duration)
 
     async def reset(self) -> None:
         logger.info("Mock ASR Service state reset")
@@ -115,31 +397,71 @@ class FasterWhisperService(ASRService):
     4x faster than standard Whisper on CPU.
     """
 
-    def __init__(self, model_size: str = "base"):
+    streams_segments = True
+
+    def __init__(
+        self,
+        model_size: str = "base",
+        beam_size: int = 1,
+        cpu_threads: Optional[int] = None,
+        compute_type: Optional[str] = None,
+        num_workers: Optional[int] = None,
+        vad_filter: bool = True,
+    ):
         # 可選: tiny, base, small, medium, large-v3
         # tiny: 最快但較不準確
         # base: 平衡速度與準確度 (推薦 CPU)
         # small: 更準確但較慢
         self.model_size = model_size
+        # 1 = greedy decoding (最快)，調大較準但較慢
+        self.beam_size = beam_size
+        # 沒指定就用這台機器的調校結果 (python tuning.py)；num_workers 跟 executor worker 數一致，
+        # 同時進來的辨識才會真的平行，不會在 CTranslate2 裡排隊
+        self.cpu_threads = cpu_threads
+        self.compute_type = compute_type
+        self.num_workers = num_workers
+        # tuning.py 測試時關掉，讓每次辨識都跑完整段音訊
+        self.vad_filter = vad_filter
         self._model = None
         self._initialized = False
 
+    def with_beam_size(self, beam_size: int) -> "FasterWhisperService":
+        """同一個模型、不同 beam_size 的服務 (共用已載入的模型)"""
+        import copy
+
+        service = copy.copy(self)
+        service.beam_size = beam_size
+        return service
+
     async def initialize(self) -> None:
         if self._initialized:
             return
 
-        logger.info(f"Initializing faster-whisper ({self.model_size})...")
+        from tuning import active_tuning
+
+        tuning = active_tuning()
+        cpu_threads = self.cpu_threads or tuning.cpu_threads
+        compute_type = self.compute_type or tuning.compute_type
+        num_workers = self.num_workers or tuning.workers
+        logger.info(
+            f"Initializing faster-whisper ({self.model_size}, {compute_type}, "
+            f"{num_workers} workers x {cpu_threads} threads)..."
+        )
 
         try:
-            from faster_whisper import WhisperModel
+            # import 與載入模型都在 thread 裡做，載入期間 event loop 照常回應 (health check 等)
+            WhisperModel = (await asyncio.to_thread(timed_import, "faster_whisper")).WhisperModel
 
             # CPU 最佳化設定
-            self._model = WhisperModel(
-                self.model_size,
-                device="cpu",
-                compute_type="int8",  # int8 量化，CPU 上更快
-                cpu_threads=4,
-            )
+            with startup_profile.phase(f"load faster-whisper {self.model_size}"):
+                self._model = await asyncio.to_thread(
+                    WhisperModel,
+                    self.model_size,
+                    device="cpu",
+                    compute_type=compute_type,  # 預設 int8 量化，CPU 上更快
+                    cpu_threads=cpu_threads,
+                    num_workers=num_workers,
+                )
 
             self._initialized = True
             logger.info(f"faster-whisper ({self.model_size}) initialized")
@@ -152,27 +474,34 @@ class FasterWhisperService(ASRService):
             raise
 
     async def transcribe(self, audio_data: bytes) -> TranscriptionResult:
-        if not self._initialized:
-            await self.initialize()
-
-        import numpy as np
-
         # 解碼音訊（從 WebM 轉 PCM）
-        pcm_data = decode_audio(audio_data)
-
-        audio_array = np.frombuffer(pcm_data, dtype=np.int16).astype(np.float32)
-        audio_array = audio_array / 32768.0
+        return await self.transcribe_pcm(decode_audio(audio_data))
 
+    async def transcribe_pcm(self, pcm_data: bytes) -> TranscriptionResult:
+        duration = len(pcm_data) / 32000
         # 檢查是否有足夠的音訊數據
+        if duration < 0.1:
+            return TranscriptionResult(text="", is_final=False, duration=duration)
+        segments = [segment async for segment in self.transcribe_stream(pcm_data)]
+        return self.join_segments(segments, duration)
+
+    async def transcribe_stream(self, pcm_data: bytes) -> AsyncIterator[TranscriptSegment]:
+        if not self._initialized:
+            await self.initialize()
+        check_cancelled()
+
+        # pcm_data 可以是 AudioFrame 的 memoryview；轉換結果寫進 thread 的共用 buffer
+        # 呼叫端必須在同一個 thread 把段落迭代完，buffer 才不會被下一個 chunk 覆蓋
+        audio_array = pcm_to_float32(pcm_data)
         if len(audio_array) < 1600:  # 至少 0.1 秒
-            return TranscriptionResult(text="", is_final=False)
+            return
 
         # faster-whisper 辨識 - 優化速度
         segments, info = self._model.transcribe(
             audio_array,
             language="zh",  # 中文
-            beam_size=1,    # 最快速度 (greedy decoding)
-            vad_filter=True,  # 開啟 VAD 過濾靜音
+            beam_size=self.beam_size,
+            vad_filter=self.vad_filter,  # 開啟 VAD 過濾靜音
             vad_parameters={
                 "min_silence_duration_ms": 300,
                 "speech_pad_ms": 50,
@@ -182,53 +511,440 @@ class FasterWhisperService(ASRService):
             no_speech_threshold=0.5,
         )
 
-        # 收集所有段落的文字
-        text_parts = []
+        # segments 是 generator，每次迭代才真的解碼下一段；解出來就交出去，不等整段做完
+        # 連線中斷或 reset 時在段落之間停下來
+        from postprocess import get_post_processor
+        post_processor = get_post_processor()
         for segment in segments:
-            text_parts.append(segment.text)
-
-        transcription = "".join(text_parts).strip()
+            check_cancelled()
+            chunk_log.event("raw segment", start=round(segment.start, 2), end=round(segment.end, 2), text=segment.text)
+            # 共用後處理：幻覺過濾 (逐段，被過濾的段落不會送出)
+            result = post_processor.process(
+                TranscriptionResult(text=segment.text, is_final=False), source="local"
+            )
+            if result.text:
+                yield TranscriptSegment(text=result.text, start=segment.start, end=segment.end)
 
-        # 記錄原始辨識結果
-        logger.info(f"Raw transcription: '{transcription}' (len={len(transcription)})")
+    def join_segments(self, segments: list[TranscriptSegment], duration: float) -> TranscriptionResult:
+        # 段落在 transcribe_stream 已經逐段過濾過
+        transcription = "".join(segment.text for segment in segments).strip()
 
         # 如果沒有文字，直接返回
         if not transcription:
-            return TranscriptionResult(text="", is_final=True, confidence=0.0)
+            return TranscriptionResult(text="", is_final=True, confidence=0.0, duration=duration)
 
-        # 只過濾最明顯的幻覺（暫時簡化過濾器）
-        hallucination_patterns = [
-            "MING PAO", "wordpress.com",
-            "thank you for watching", "please subscribe",
-        ]
-        lower_text = transcription.lower()
+        chunk_log.event("transcription", engine=f"faster-whisper-{self.model_size}", text=transcription)
+        return TranscriptionResult(text=transcription, is_final=True, confidence=0.9, duration=duration)
 
-        for pattern in hallucination_patterns:
-            if pattern.lower() in lower_text:
-                logger.warning(f"Filtered hallucination: '{transcription}'")
-                return TranscriptionResult(text="", is_final=True, confidence=0.0)
+    async def reset(self) -> None:
+        logger.info("faster-whisper state reset")
+
+
+def default_onnx_model_dir(model_size: str) -> str:
+    """export_onnx.py 預設的輸出位置"""
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", f"whisper-{model_size}-onnx")
+
+
+class OnnxWhisperService(ASRService):
+    """
+    Whisper on ONNX Runtime (CPU).
+    Runs the encoder / decoder exported by export_onnx.py (optionally int8-quantized)
+    with greedy decoding and a KV cache; a second local engine next to faster-whisper.
+    """
+
+    streams_segments = True
+    accepts_features = True
+
+    def __init__(
+        self,
+        model_size: str = "small",
+        model_dir: Optional[str] = None,
+        cpu_threads: Optional[int] = None,
+        compute_type: Optional[str] = None,
+        language: str = "zh",
+        max_new_tokens: int = 224,
+        no_speech_threshold: float = 0.5,
+        share_weights: Optional[bool] = None,
+    ):
+        self.model_size = model_size
+        self.model_dir = model_dir or os.getenv("ONNX_MODEL_DIR") or default_onnx_model_dir(model_size)
+        self.cpu_threads = cpu_threads
+        # int8 = export_onnx.py 量化過的 *_int8.onnx，其他值用原本的 float32 模型
+        self.compute_type = compute_type
+        self.language = language
+        self.max_new_tokens = max_new_tokens
+        self.no_speech_threshold = no_speech_threshold
+        # 權重留在 mmap 的模型檔上 (不 prepack)，同一台機器的 serve.py worker 共用一份，見 initialize
+        # 辨識約慢 20%，單一 process 時沒有好處；serve.py 多 worker 時預設開啟
+        self.share_weights = (
+            os.getenv("ONNX_SHARE_WEIGHTS", "0") == "1" if share_weights is None else share_weights
+        )
+        self.beam_size = 1  # 只有 greedy
+        self._encoder = None
+        self._decoder = None
+        self._decoder_with_past = None
+        self._tokenizer = None
+        self._n_mels = 80
+        self._initialized = False
+
+    @property
+    def n_mels(self) -> int:
+        """模型的 mel 頻帶數 (large-v3 是 128)；建立 IncrementalLogMel 要用一樣的數量"""
+        return self._n_mels
+
+    async def initialize(self) -> None:
+        if self._initialized:
+            return
+
+        from tuning import active_tuning
+
+        tuning = active_tuning()
+        cpu_threads = self.cpu_threads or tuning.cpu_threads
+        compute_type = self.compute_type or tuning.compute_type
+        logger.info(f"Initializing ONNX Runtime Whisper ({self.model_dir}, {compute_type}, {cpu_threads} threads)...")
+
+        try:
+            # import 與建立 session 都在 thread 裡做，載入期間 event loop 照常回應
+            ort = await asyncio.to_thread(timed_import, "onnxruntime")
+            Tokenizer = (await asyncio.to_thread(timed_import, "tokenizers")).Tokenizer
+
+            if not os.path.isdir(self.model_dir):
+                raise FileNotFoundError(
+                    f"{self.model_dir} not found, run: python export_onnx.py --model {self.model_size}"
+                )
+
+            options = ort.SessionOptions()
+            options.intra_op_num_threads = cpu_threads
+            options.inter_op_num_threads = 1
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            if self.share_weights:
+                # export_onnx.py 把權重存成 external data，ONNX Runtime 直接 mmap 檔案；
+                # 不 prepack 權重就一直是唯讀的 page cache，各 worker 各自載入也只佔一份實體記憶體
+                options.add_session_config_entry("session.disable_prepacking", "1")
+
+            def load(name: str):
+                path = os.path.join(self.model_dir, f"{name}.onnx")
+                quantized = os.path.join(self.model_dir, f"{name}_int8.onnx")
+                if compute_type == "int8":
+                    if os.path.exists(quantized):
+                        path = quantized
+                    else:
+                        logger.warning(f"{quantized} not found, using float32 {name}")
+                return ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+            with startup_profile.phase(f"load onnx {self.model_size}"):
+                self._encoder, self._decoder, self._decoder_with_past = await asyncio.gather(
+                    asyncio.to_thread(load, "encoder_model"),
+                    asyncio.to_thread(load, "decoder_model"),
+                    asyncio.to_thread(load, "decoder_with_past_model"),
+                )
+
+            with open(os.path.join(self.model_dir, "config.json"), "r", encoding="utf-8") as f:
+                config = json.load(f)
+            self._n_mels = config.get("num_mel_bins", 80)
+            self._tokenizer = Tokenizer.from_file(os.path.join(self.model_dir, "tokenizer.json"))
+            token = self._tokenizer.token_to_id
+            self._eot = token("<|endoftext|>")
+            self._prompt = [
+                token("<|startoftranscript|>"), token(f"<|{self.language}|>"),
+                token("<|transcribe|>"), token("<|notimestamps|>"),
+            ]
+            if None in self._prompt:
+                raise ValueError(f"Tokenizer in {self.model_dir} does not support language {self.language!r}")
+            self._no_speech = token("<|nospeech|>") or token("<|nocaptions|>")
+            self._with_past_inputs = [i.name for i in self._decoder_with_past.get_inputs()]
+
+            self._initialized = True
+            logger.info(f"ONNX Runtime Whisper ({self.model_size}) initialized")
+
+        except ImportError as e:
+            logger.error(f"Missing onnxruntime / tokenizers: {e}")
+            raise
+        except Exception as e:
+            logger.error(f"Failed to initialize: {e}")
+            raise
+
+    async def transcribe(self, audio_data: bytes) -> TranscriptionResult:
+        return await self.transcribe_pcm(decode_audio(audio_data))
+
+    async def transcribe_pcm(self, pcm_data: bytes, features=None) -> TranscriptionResult:
+        duration = len(pcm_data) / 32000
+        if duration < 0.1:
+            return TranscriptionResult(text="", is_final=False, duration=duration)
+        segments = [segment async for segment in self.transcribe_stream(pcm_data, features)]
+        return self.join_segments(segments, duration)
+
+    async def transcribe_stream(self, pcm_data: bytes, features=None) -> AsyncIterator[TranscriptSegment]:
+        """
+        每 30 秒一個視窗 (串流的 chunk 只有一個)，一個視窗解完就是一個段落
+        features: 已經逐段餵過同一段 PCM 的 IncrementalLogMel，encoder 輸入直接從裡面取
+        """
+        if not self._initialized:
+            await self.initialize()
+        check_cancelled()
+        if features is not None and (features.samples * 2 != len(pcm_data) or features.n_mels != self._n_mels):
+            logger.warning("Precomputed features do not match the audio, recomputing")
+            features = None
+
+        from postprocess import get_post_processor
+        from whisper_features import N_SAMPLES, SAMPLE_RATE
+
+        audio_array = pcm_to_float32(pcm_data)
+        if len(audio_array) < 1600:  # 至少 0.1 秒
+            return
 
-        logger.info(f"Returning transcription: '{transcription}'")
-        return TranscriptionResult(text=transcription, is_final=True, confidence=0.9)
+        post_processor = get_post_processor()
+        for offset in range(0, len(audio_array), N_SAMPLES):
+            window = audio_array[offset:offset + N_SAMPLES]
+            if len(window) < 1600:
+                break
+            text = self._decode_window(
+                window, features.features(offset // N_SAMPLES) if features is not None else None
+            )
+            start = offset / SAMPLE_RATE
+            end = start + len(window) / SAMPLE_RATE
+            chunk_log.event("raw segment", start=round(start, 2), end=round(end, 2), text=text)
+            result = post_processor.process(TranscriptionResult(text=text, is_final=False), source="local")
+            if result.text:
+                yield TranscriptSegment(text=result.text, start=start, end=end)
+
+    def _decode_window(self, window, features=None) -> str:
+        """
+        一個 30 秒以內的視窗: encoder 跑一次，decoder 逐 token greedy，之後每步只餵新的 token + KV cache
+        features 是預先算好的 (n_mels, 3000) log-mel，沒有就從 window 算
+        """
+        import numpy as np
+        from whisper_features import log_mel_spectrogram, pad_or_trim
+
+        if features is None:
+            features = log_mel_spectrogram(pad_or_trim(window), self._n_mels)
+        (hidden_states,) = self._encoder.run(None, {"input_features": features[None]})
+
+        input_ids = np.array([self._prompt], dtype=np.int64)
+        outputs = self._decoder.run(None, {"input_ids": input_ids, "encoder_hidden_states": hidden_states})
+        names = [o.name for o in self._decoder.get_outputs()]
+        logits = outputs[0]
+
+        no_speech_prob = 0.0
+        if self._no_speech is not None:
+            no_speech_prob = float(_softmax(logits[0, 0])[self._no_speech])
+        # encoder 的 key / value 只在第一步產生，之後沿用
+        past = {
+            name.replace("present", "past_key_values"): value
+            for name, value in zip(names[1:], outputs[1:])
+        }
+        with_past_names = [o.name for o in self._decoder_with_past.get_outputs()]
+
+        tokens: list[int] = []
+        sum_logprob = 0.0
+        for step in range(self.max_new_tokens):
+            check_cancelled()
+            step_logits = logits[0, -1].astype(np.float64)
+            step_logits[self._eot + 1:] = -np.inf  # 不產生 timestamp / 語言等特殊 token
+            token = int(np.argmax(step_logits))
+            sum_logprob += float(step_logits[token] - _logsumexp(step_logits))
+            if token == self._eot:
+                break
+            tokens.append(token)
+
+            feed = {"input_ids": np.array([[token]], dtype=np.int64)}
+            for name in self._with_past_inputs:
+                if name.startswith("past_key_values"):
+                    feed[name] = past[name]
+                elif name == "encoder_hidden_states":
+                    feed[name] = hidden_states
+                elif name == "cache_position":
+                    feed[name] = np.array([len(self._prompt) + step], dtype=np.int64)
+            outputs = self._decoder_with_past.run(None, feed)
+            logits = outputs[0]
+            for name, value in zip(with_past_names[1:], outputs[1:]):
+                past[name.replace("present", "past_key_values")] = value
+
+        # 跟 faster-whisper 一樣: no_speech 機率高而且解出來的內容沒把握就當作靜音
+        avg_logprob = sum_logprob / (len(tokens) + 1)
+        if no_speech_prob > self.no_speech_threshold and avg_logprob < -1.0:
+            return ""
+        return self._tokenizer.decode(tokens, skip_special_tokens=True)
+
+    def join_segments(self, segments: list[TranscriptSegment], duration: float) -> TranscriptionResult:
+        transcription = "".join(segment.text for segment in segments).strip()
+        if not transcription:
+            return TranscriptionResult(text="", is_final=True, confidence=0.0, duration=duration)
+        chunk_log.event("transcription", engine=f"onnx-{self.model_size}", text=transcription)
+        return TranscriptionResult(text=transcription, is_final=True, confidence=0.9, duration=duration)
 
     async def reset(self) -> None:
-        logger.info("faster-whisper state reset")
+        logger.info("ONNX Runtime Whisper state reset")
+
+
+def _softmax(logits):
+    import numpy as np
+
+    exp = np.exp(logits - np.max(logits))
+    return exp / exp.sum()
+
+
+def _logsumexp(logits) -> float:
+    import numpy as np
+
+    peak = np.max(logits)
+    return float(peak + np.log(np.sum(np.exp(logits - peak))))
+
+
+class HybridASRService(ASRService):
+    """
+    兩段式辨識
+    fast: 本地小模型，每個 chunk 馬上出 partial (is_final=False)
+    final: 雲端或大模型，整句講完才辨識一次，結果取代同一句的 partial
+    """
+
+    def __init__(
+        self,
+        fast: ASRService,
+        final: ASRService,
+        max_utterance_seconds: float = 15.0,
+    ):
+        self.fast = fast
+        self.final = final
+        self.max_utterance_seconds = max_utterance_seconds
+
+    async def initialize(self) -> None:
+        # 兩個模型 (或模型與雲端提供商) 同時載入
+        await asyncio.gather(self.fast.initialize(), self.final.initialize())
+        logger.info("Hybrid ASR initialized")
+
+    async def transcribe(self, audio_data: bytes) -> TranscriptionResult:
+        # 沒有 session 狀態時無從判斷句子邊界，直接用準確的服務
+        return await self.final.transcribe(audio_data)
+
+    async def reset(self) -> None:
+        await self.fast.reset()
+        await self.final.reset()
+
+    @property
+    def ready(self) -> bool:
+        return self.fast.ready and self.final.ready
+
+    def new_session(self) -> "HybridSession":
+        return HybridSession(self)
+
+
+class HybridSession:
+    """hybrid 模式下單一連線的狀態：目前這句話累積的 PCM 與 partial 文字"""
+
+    def __init__(self, service: HybridASRService):
+        self.service = service
+        self.lock = asyncio.Lock()  # 同一連線的 feed 必須依序執行
+        self.utterance_id = 0
+        self._pcm = bytearray()
+        self._partial_parts: list[str] = []
+        self._ended = False
+        # final 服務可以吃預先算好的 log-mel 時，每個 chunk 進來就只算新音訊的 frame，
+        # 句子結束後 final 不用從頭重算整句
+        self._features = self._new_features()
+        self._utterance_features: dict[int, "IncrementalLogMel"] = {}  # 已經取出、等 final 的句子
+
+    def _new_features(self) -> Optional["IncrementalLogMel"]:
+        if not self.service.final.accepts_features:
+            return None
+        from whisper_features import IncrementalLogMel
+        return IncrementalLogMel(self.service.final.n_mels)
+
+    async def feed(self, audio_data: bytes) -> TranscriptionResult:
+        """用 fast 模型辨識一個 WebM chunk，回傳目前這句話累積的 partial"""
+        return await self.feed_pcm(decode_audio(audio_data))
+
+    async def feed_pcm(self, pcm_data: bytes) -> TranscriptionResult:
+        """同 feed，輸入是已解碼的 PCM 16-bit 16kHz mono"""
+        result = await self.service.fast.transcribe_pcm(pcm_data)
+
+        if not result.text:
+            # 講完一句後的靜音 -> 句子結束；句首的靜音直接丟掉，不浪費雲端額度
+            self._ended = bool(self._pcm)
+            return TranscriptionResult(
+                text="", is_final=False, utterance_id=self.utterance_id, duration=result.duration
+            )
+
+        self._pcm.extend(pcm_data)
+        if self._features is not None:
+            self._features.feed(pcm_data)
+        self._partial_parts.append(result.text)
+        if len(self._pcm) / 32000 >= self.service.max_utterance_seconds:
+            self._ended = True
+
+        return TranscriptionResult(
+            text="".join(self._partial_parts),
+            is_final=False,
+            confidence=result.confidence,
+            utterance_id=self.utterance_id,
+            duration=result.duration,
+        )
+
+    def pop_utterance(self, force: bool = False) -> Optional[tuple[int, bytes]]:
+        """句子結束 (或 force) 時取出整句 PCM，開始下一句"""
+        if not self._pcm or not (self._ended or force):
+            return None
+
+        utterance = (self.utterance_id, bytes(self._pcm))
+        if self._features is not None:
+            self._utterance_features[self.utterance_id] = self._features
+            self._features = self._new_features()
+        self.utterance_id += 1
+        self._pcm = bytearray()
+        self._partial_parts = []
+        self._ended = False
+        return utterance
+
+    async def finalize(self, utterance_id: int, pcm_data: bytes) -> TranscriptionResult:
+        """整句送給 final 服務"""
+        features = self._utterance_features.pop(utterance_id, None)
+        if features is not None:
+            result = await self.service.final.transcribe_pcm(pcm_data, features=features)
+        else:
+            result = await self.service.final.transcribe_pcm(pcm_data)
+        return TranscriptionResult(
+            text=result.text,
+            is_final=True,
+            confidence=result.confidence,
+            utterance_id=utterance_id,
+            duration=result.duration,
+        )
+
+    def clear(self) -> None:
+        self._pcm = bytearray()
+        self._partial_parts = []
+        self._ended = False
+        self._features = self._new_features()
+        self._utterance_features.clear()
+        self.utterance_id += 1
 
 
-def create_asr_service(use_mock: bool = False) -> ASRService:
+def create_asr_service(use_mock: bool = False, engine: Optional[str] = None, model_size: str = "small") -> ASRService:
     """
     創建 ASR 服務。
     use_mock=True: 使用假的辨識服務
-    use_mock=False: 使用 faster-whisper (預設，CPU 上快 4 倍)
+    use_mock=False: 本地模型，engine (預設 ASR_ENGINE 環境變數) 選擇推論引擎
+      faster-whisper: CTranslate2 (預設，CPU 上快 4 倍)
+      onnx: ONNX Runtime，模型要先用 export_onnx.py 匯出
     """
     if use_mock:
-        logger.info("Creating Mock ASR Service")
-        return MockASRService()
-    else:
-        logger.info("Creating faster-whisper Service")
-        # tiny: 最快 (~0.5秒) - 準確度較低
-        # base: 較快 (~1秒) - 平衡選擇
-        # small: 較準確 (~2-3秒) - 推薦 CPU
-        # medium: 更準確 (~10-15秒) - CPU 太慢
-        # large-v3: 最準確 (~20+秒) - CPU 極慢
-        return FasterWhisperService(model_size="small")
+        # 負載測試用: MOCK_ASR_LATENCY=lognormal:0.3,0.4 MOCK_ASR_CPU=numpy
+        latency = os.getenv("MOCK_ASR_LATENCY", "fixed:0.1")
+        cpu = os.getenv("MOCK_ASR_CPU", "sleep")
+        logger.info(f"Creating Mock ASR Service (latency={latency}, cpu={cpu})")
+        return MockASRService(latency=latency, cpu=cpu)
+
+    engine = engine or os.getenv("ASR_ENGINE", "faster-whisper")
+    if engine == "onnx":
+        logger.info("Creating ONNX Runtime Whisper Service")
+        return OnnxWhisperService(model_size=model_size)
+    if engine != "faster-whisper":
+        raise ValueError(f"Unknown ASR engine: {engine!r} (faster-whisper or onnx)")
+
+    logger.info("Creating faster-whisper Service")
+    # tiny: 最快 (~0.5秒) - 準確度較低
+    # base: 較快 (~1秒) - 平衡選擇
+    # small: 較準確 (~2-3秒) - 推薦 CPU
+    # medium: 更準確 (~10-15秒) - CPU 太慢
+    # large-v3: 最準確 (~20+秒) - CPU 極慢
+    return FasterWhisperService(model_size=model_size)
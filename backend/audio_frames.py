@@ -0,0 +1,145 @@
+"""
+Audio frames for AprilVoice
+PCM from the socket is copied once into pooled, preallocated buffers;
+frames are memoryviews into those buffers and carry their timing metadata.
+"""
+
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+SAMPLE_RATE = 16000
+BYTES_PER_SAMPLE = 2  # int16
+
+
+class BufferPool:
+    """
+    固定大小 bytearray 的 pool
+    frame 辨識完歸還 buffer，下一個 chunk 重複使用，不用每次重新配置
+    """
+
+    def __init__(self, size: int, max_free: int = 8):
+        self.size = size
+        self.max_free = max_free
+        self.allocated = 0  # 實際配置過幾個 buffer
+        self._free: list[bytearray] = []
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bytearray:
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+            self.allocated += 1
+        return bytearray(self.size)
+
+    def release(self, buffer: bytearray) -> None:
+        with self._lock:
+            if len(self._free) < self.max_free:
+                self._free.append(buffer)
+
+
+@dataclass
+class AudioFrame:
+    """
+    一段 PCM 16-bit mono，資料在 pool 的 buffer 裡，用完要 release()
+    送進 executor 的工作會讀 data，要先 retain()，工作結束後再 release()；
+    全部的擁有者都 release 之後 buffer 才回到 pool (都在 event loop 上呼叫，不用 lock)
+    """
+    buffer: bytearray
+    length: int  # bytes
+    start: float  # 在這個串流中的開始時間 (秒)
+    received_at: float  # 最後一段資料到達的時間 (time.monotonic)
+    sample_rate: int = SAMPLE_RATE
+    pool: Optional[BufferPool] = None
+    seq: int = -1  # 送去辨識時由 session 指定，結果依 seq 順序送出
+    refs: int = 1  # 還沒 release 的擁有者數
+
+    @property
+    def data(self) -> memoryview:
+        """不複製的 PCM view，release() 之後不能再使用"""
+        return memoryview(self.buffer)[:self.length]
+
+    @property
+    def duration(self) -> float:
+        return self.length / BYTES_PER_SAMPLE / self.sample_rate
+
+    @property
+    def end(self) -> float:
+        return self.start + self.duration
+
+    def retain(self) -> None:
+        self.refs += 1
+
+    def release(self) -> None:
+        if self.pool is None:
+            return
+        self.refs -= 1
+        if self.refs <= 0:
+            self.pool.release(self.buffer)
+            self.pool = None
+
+
+class FrameAssembler:
+    """
+    把任意大小的 PCM 片段接成固定長度的 frame
+    資料直接寫進 pool 的 buffer，從 socket 到模型輸入只複製這一次
+    """
+
+    def __init__(self, frame_bytes: int, pool: Optional[BufferPool] = None):
+        self.frame_bytes = frame_bytes - frame_bytes % BYTES_PER_SAMPLE
+        self.pool = pool or BufferPool(self.frame_bytes)
+        self.total_bytes = 0  # 串流到目前為止收到的 bytes，用來算時間戳記
+        self._buffer: Optional[bytearray] = None
+        self._length = 0
+        self._start = 0.0
+        self._received_at = 0.0
+
+    def __len__(self) -> int:
+        return self._length
+
+    def append(self, data) -> list[AudioFrame]:
+        """接上一段 PCM，回傳湊滿的 frame"""
+        view = memoryview(data)
+        frames = []
+        offset = 0
+        self._received_at = time.monotonic()
+        while offset < len(view):
+            if self._buffer is None:
+                self._buffer = self.pool.acquire()
+                self._start = self.total_bytes / BYTES_PER_SAMPLE / SAMPLE_RATE
+            n = min(self.frame_bytes - self._length, len(view) - offset)
+            self._buffer[self._length:self._length + n] = view[offset:offset + n]
+            self._length += n
+            self.total_bytes += n
+            offset += n
+            if self._length == self.frame_bytes:
+                frames.append(self._emit())
+        return frames
+
+    def flush(self, min_bytes: int = 0) -> Optional[AudioFrame]:
+        """取出不滿一個 frame 的剩餘音訊；少於 min_bytes 就丟掉"""
+        if self._buffer is None:
+            return None
+        if self._length < max(min_bytes, 1):
+            self.clear()
+            return None
+        return self._emit()
+
+    def clear(self) -> None:
+        if self._buffer is not None:
+            self.pool.release(self._buffer)
+        self._buffer = None
+        self._length = 0
+
+    def _emit(self) -> AudioFrame:
+        frame = AudioFrame(
+            buffer=self._buffer,
+            length=self._length,
+            start=self._start,
+            received_at=self._received_at,
+            pool=self.pool,
+        )
+        self._buffer = None
+        self._length = 0
+        return frame
@@ -0,0 +1,304 @@
+"""
+Batch transcription jobs for AprilVoice
+Uploaded recordings are split at silence and transcribed in parallel,
+with interactive WebSocket traffic keeping priority on the inference workers.
+"""
+
+import asyncio
+import logging
+import os
+import tempfile
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+from asr_service import ASRService, decode_audio_file, transcribe_streaming
+from logs import log_scope
+from scheduler import InferenceScheduler, Priority
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 16000
+
+
+def split_on_silence(
+    samples,
+    max_seconds: float = 30.0,
+    min_seconds: float = 5.0,
+    min_silence_ms: int = 400,
+    frame_ms: int = 30,
+    silence_dbfs: float = -40.0,
+    overlap_seconds: float = 1.0,
+    block_seconds: float = 60.0,
+) -> list[tuple[int, int]]:
+    """
+    在靜音處切段，回傳每段的 (開始, 結束) sample 位置
+    samples 可以是 np.memmap，音量分塊計算，記憶體用量不隨音訊長度增加
+    每段不超過 max_seconds (Whisper 一次看 30 秒)；找不到靜音就硬切，
+    硬切時下一段往前重疊 overlap_seconds，避免切在字中間
+    """
+    import numpy as np
+
+    total = len(samples)
+    max_len = int(max_seconds * SAMPLE_RATE)
+    if total <= max_len:
+        return [(0, total)] if total else []
+
+    # 每個 frame 是否靜音，一次只轉一個 block 成 float32
+    frame_len = SAMPLE_RATE * frame_ms // 1000
+    n_frames = total // frame_len
+    frames_per_block = max(1, int(block_seconds * 1000) // frame_ms)
+    threshold = (10 ** (silence_dbfs / 20) * 32768.0) ** 2
+    silent = np.empty(n_frames, dtype=bool)
+    for first in range(0, n_frames, frames_per_block):
+        last = min(first + frames_per_block, n_frames)
+        block = np.asarray(samples[first * frame_len:last * frame_len], dtype=np.float32)
+        block = block.reshape(last - first, frame_len)
+        silent[first:last] = np.mean(block * block, axis=1) < threshold
+
+    # 找出夠長的靜音區，切點放在靜音中間
+    min_silence_frames = max(1, min_silence_ms // frame_ms)
+    cut_points = []
+    run_start = None
+    for i, is_silent in enumerate(np.append(silent, False)):
+        if is_silent and run_start is None:
+            run_start = i
+        elif not is_silent and run_start is not None:
+            if i - run_start >= min_silence_frames:
+                cut_points.append((run_start + i) // 2 * frame_len)
+            run_start = None
+
+    pieces = []
+    start = 0
+    min_len = int(min_seconds * SAMPLE_RATE)
+    overlap = int(overlap_seconds * SAMPLE_RATE)
+    while total - start > max_len:
+        candidates = [c for c in cut_points if start + min_len <= c <= start + max_len]
+        if candidates:
+            end = candidates[-1]
+            pieces.append((start, end))
+            start = end
+        else:
+            end = start + max_len
+            pieces.append((start, end))
+            start = end - overlap
+    pieces.append((start, total))
+    return pieces
+
+
+def merge_overlap(previous: str, text: str, max_chars: int = 20) -> str:
+    """硬切重疊的兩段會重複辨識到同樣的字，去掉 text 開頭與 previous 結尾重複的部分"""
+    for size in range(min(len(previous), len(text), max_chars), 1, -1):
+        if previous.endswith(text[:size]):
+            return text[size:]
+    return text
+
+
+@dataclass
+class Segment:
+    index: int
+    start: float  # 秒
+    end: float
+    text: str = ""
+    overlaps_previous: bool = False
+
+
+@dataclass
+class Job:
+    id: str
+    filename: str
+    status: str = "queued"  # queued | running | done | failed
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    duration: float = 0.0  # 音訊長度 (秒)
+    segments: list[Segment] = field(default_factory=list)
+    completed_segments: int = 0
+    error: str = ""
+    audio_path: Optional[str] = None  # 上傳的原始檔，處理完就刪掉
+
+    @property
+    def text(self) -> str:
+        return "".join(s.text for s in self.segments)
+
+    def stitch(self) -> None:
+        """依序接回各段，去掉硬切重疊造成的重複文字"""
+        previous = ""
+        for segment in self.segments:
+            if segment.overlaps_previous and previous:
+                segment.text = merge_overlap(previous, segment.text)
+            if segment.text:
+                previous = segment.text
+
+    def to_dict(self) -> dict:
+        result = {
+            "job_id": self.id,
+            "filename": self.filename,
+            "status": self.status,
+            "created_at": self.created_at,
+            "duration": round(self.duration, 2),
+            "progress": {
+                "completed": self.completed_segments,
+                "total": len(self.segments),
+            },
+        }
+        if self.started_at and self.finished_at:
+            result["processing_seconds"] = round(self.finished_at - self.started_at, 2)
+        if self.status == "running":
+            # 已經解出來的文字 (逐段更新，重疊的部分要等全部完成才會去除)
+            result["partial_text"] = self.text
+        if self.status == "done":
+            result["text"] = self.text
+            result["segments"] = [
+                {"start": round(s.start, 2), "end": round(s.end, 2), "text": s.text}
+                for s in self.segments
+                if s.text
+            ]
+        if self.error:
+            result["error"] = self.error
+        return result
+
+
+class JobManager:
+    """
+    Batch 工作佇列
+    每個 job 解碼後在靜音處切段，各段平行送進 inference worker，完成後依序接回
+    """
+
+    def __init__(
+        self,
+        get_service: Callable[[], Optional[ASRService]],
+        scheduler: InferenceScheduler,
+        concurrent_jobs: int = 1,
+        max_finished_jobs: int = 100,
+    ):
+        self.get_service = get_service
+        self.scheduler = scheduler
+        self.concurrent_jobs = concurrent_jobs
+        self.max_finished_jobs = max_finished_jobs
+        self.jobs: dict[str, Job] = {}
+        self._queue: asyncio.Queue[str] = asyncio.Queue()
+        self._workers: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        for _ in range(self.concurrent_jobs):
+            self._workers.append(asyncio.create_task(self._worker()))
+        logger.info(f"Batch job manager started ({self.concurrent_jobs} concurrent jobs)")
+
+    async def stop(self) -> None:
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def submit(self, audio_path: str, filename: str = "") -> Job:
+        """audio_path 交給 JobManager 管理，處理完會刪除"""
+        job = Job(id=uuid.uuid4().hex, filename=filename, audio_path=audio_path)
+        self.jobs[job.id] = job
+        self._queue.put_nowait(job.id)
+        self._prune()
+        logger.info(f"Batch job {job.id} queued ({os.path.getsize(audio_path)} bytes, {filename})")
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def _prune(self) -> None:
+        """只保留最近 max_finished_jobs 個完成的 job"""
+        finished = [j for j in self.jobs.values() if j.status in ("done", "failed")]
+        for job in sorted(finished, key=lambda j: j.created_at)[:-self.max_finished_jobs or None]:
+            del self.jobs[job.id]
+
+    async def _worker(self) -> None:
+        while True:
+            job_id = await self._queue.get()
+            job = self.jobs.get(job_id)
+            if job is None:
+                continue
+            try:
+                with log_scope(job=job.id):
+                    await self._run(job)
+            except Exception as e:
+                logger.error(f"Batch job {job.id} failed: {e}")
+                job.status = "failed"
+                job.error = str(e)
+            finally:
+                if job.audio_path:
+                    os.unlink(job.audio_path)
+                    job.audio_path = None
+                job.finished_at = time.time()
+
+    async def _run(self, job: Job) -> None:
+        service = self.get_service()
+        if service is None:
+            raise RuntimeError("ASR service not initialized")
+
+        job.status = "running"
+        job.started_at = time.time()
+        loop = asyncio.get_running_loop()
+
+        # ffmpeg 直接解碼到暫存檔再 memmap，幾小時的錄音也只有用到的部分會進記憶體
+        import numpy as np
+
+        with tempfile.NamedTemporaryFile(suffix='.pcm', delete=False) as f:
+            pcm_path = f.name
+
+        try:
+            pcm_size = await loop.run_in_executor(
+                None, decode_audio_file, job.audio_path, pcm_path
+            )
+            if pcm_size < 2:
+                raise ValueError("Could not decode audio file")
+
+            samples = np.memmap(pcm_path, dtype=np.int16, mode='r')
+            job.duration = len(samples) / SAMPLE_RATE
+            pieces = await loop.run_in_executor(None, split_on_silence, samples)
+            job.segments = [
+                Segment(
+                    index=i,
+                    start=start / SAMPLE_RATE,
+                    end=end / SAMPLE_RATE,
+                    overlaps_previous=i > 0 and start < pieces[i - 1][1],
+                )
+                for i, (start, end) in enumerate(pieces)
+            ]
+            logger.info(f"Batch job {job.id}: {job.duration:.1f}s audio, {len(pieces)} segments")
+
+            async def transcribe_piece_streaming(segment: Segment, piece: bytes):
+                """在 worker thread 執行；支援的服務每解出一段就更新 partial_text"""
+                if not service.streams_segments:
+                    return await service.transcribe_pcm(piece)
+                parts = []
+
+                def on_segment(part):
+                    parts.append(part.text)
+                    loop.call_soon_threadsafe(setattr, segment, "text", "".join(parts))
+
+                return await transcribe_streaming(service, piece, on_segment)
+
+            def run_piece(segment: Segment, start: int, end: int):
+                # 進了 worker 才從 memmap 複製出這一段
+                piece = samples[start:end].tobytes()
+                return asyncio.run(transcribe_piece_streaming(segment, piece))
+
+            async def transcribe_piece(segment: Segment, start: int, end: int):
+                result = await self.scheduler.run(
+                    run_piece, segment, start, end,
+                    priority=Priority.BATCH, flow=f"job:{job.id}", cost=(end - start) / SAMPLE_RATE,
+                )
+                segment.text = result.text
+                job.completed_segments += 1
+
+            # 各段一起排隊，scheduler 只在沒有即時辨識等待時才把 worker 給 batch
+            await asyncio.gather(*(
+                transcribe_piece(segment, start, end)
+                for segment, (start, end) in zip(job.segments, pieces)
+            ))
+            del samples
+        finally:
+            os.unlink(pcm_path)
+
+        job.stitch()
+        job.status = "done"
+        logger.info(f"Batch job {job.id} done in {time.time() - job.started_at:.1f}s")
@@ -0,0 +1,496 @@
+"""
+Benchmarks for AprilVoice
+Run: python benchmark.py <suite> [options]
+"""
+
+import argparse
+import random
+import statistics
+import time
+
+from asr_service import TranscriptionResult
+
+
+def _timeit(fn, iterations: int) -> dict:
+    """執行 fn 多次，回傳每次耗時統計 (微秒)"""
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1e6)
+    samples.sort()
+    return {
+        "mean_us": statistics.fmean(samples),
+        "p50_us": samples[len(samples) // 2],
+        "p99_us": samples[int(len(samples) * 0.99) - 1],
+    }
+
+
+def _format_stats(stats: dict) -> str:
+    return (f"mean={stats['mean_us']:8.2f}us  "
+            f"p50={stats['p50_us']:8.2f}us  p99={stats['p99_us']:8.2f}us")
+
+
+def _print_row(label: str, stats: dict):
+    print(f"  {label:<28} " + _format_stats(stats))
+
+
+def bench_postprocess(args):
+    """後處理規則數量 vs 每筆結果的過濾耗時"""
+    from postprocess import FilterRule, PostProcessor, load_post_processor
+
+    base = load_post_processor()
+    base_patterns = [p for r in base.rules if r.type == "substring" for p in r.patterns]
+
+    rng = random.Random(0)
+    alphabet = "的一是不了人我在有他這中大來上國個到說們為子和你地出道也時年"
+    texts = [
+        "".join(rng.choice(alphabet) for _ in range(rng.randint(5, 40)))
+        for _ in range(200)
+    ]
+    results = [TranscriptionResult(text=t, is_final=True) for t in texts]
+
+    print(f"postprocess: {len(texts)} texts x {args.iterations} iterations")
+    for extra in args.rules:
+        synthetic = [
+            "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(4, 12)))
+            for _ in range(extra)
+        ]
+        patterns = base_patterns + synthetic
+        processor = PostProcessor(base.rules + [
+            FilterRule(name="synthetic", type="substring", patterns=patterns[len(base_patterns):])
+        ])
+        lowered = [p.lower() for p in patterns]
+
+        def compiled():
+            for r in results:
+                processor.process(r, source="local")
+
+        def naive():
+            # 舊寫法：每條規則各自 in 一次
+            for t in texts:
+                lower_text = t.lower()
+                for p in lowered:
+                    if p in lower_text:
+                        break
+
+        compiled()  # 預先編譯
+        print(f" {len(patterns)} rules")
+        _print_row("compiled regex", _timeit(compiled, args.iterations))
+        _print_row("naive loop", _timeit(naive, args.iterations))
+
+
+def bench_decode(args):
+    """長錄音解碼的記憶體峰值：整段讀進記憶體 vs 解碼到檔案再 memmap 分段"""
+    import os
+    import subprocess
+    import tempfile
+    import tracemalloc
+
+    import numpy as np
+
+    from asr_service import decode_audio, decode_audio_file
+    from batch_jobs import split_on_silence
+
+    print("decode: peak traced memory (MB)")
+    for minutes in args.minutes:
+        with tempfile.TemporaryDirectory() as tmp:
+            src = os.path.join(tmp, "input.webm")
+            subprocess.run(
+                ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error',
+                 '-f', 'lavfi', '-i', f'sine=frequency=440:duration={minutes * 60}',
+                 '-c:a', 'libopus', '-ac', '1', src],
+                check=True,
+            )
+            with open(src, 'rb') as f:
+                data = f.read()
+
+            tracemalloc.start()
+            pcm = decode_audio(data, timeout=3600)
+            audio = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+            _, in_memory_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del pcm, audio
+
+            tracemalloc.start()
+            pcm_path = os.path.join(tmp, "output.pcm")
+            decode_audio_file(src, pcm_path)
+            samples = np.memmap(pcm_path, dtype=np.int16, mode='r')
+            for start, end in split_on_silence(samples):
+                piece = samples[start:end].astype(np.float32)
+                piece /= 32768.0
+            _, streaming_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del samples
+
+        print(f"  {minutes:>4} min   in-memory={in_memory_peak / 1e6:8.1f}  "
+              f"memmap+windows={streaming_peak / 1e6:8.1f}")
+
+
+def bench_capture(args):
+    """
+    兩種前端錄音模式的伺服器端成本 (不含辨識)
+    webm: 每 1.5 秒一個完整 WebM，base64 + ffmpeg 解碼
+    pcm: 每 100ms 一個 16 kHz int16 frame，base64 後直接接進 buffer
+    """
+    import base64
+    import json
+    import os
+    import subprocess
+    import tempfile
+
+    from asr_service import decode_audio
+
+    chunk_seconds = 1.5
+    frame_seconds = 0.1
+    frames_per_chunk = int(chunk_seconds / frame_seconds)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, "chunk.webm")
+        subprocess.run(
+            ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error',
+             '-f', 'lavfi', '-i', f'anoisesrc=duration={chunk_seconds}:amplitude=0.1',
+             '-c:a', 'libopus', '-ac', '1', src],
+            check=True,
+        )
+        with open(src, 'rb') as f:
+            webm_chunk = f.read()
+
+    webm_message = json.dumps({"type": "audio", "data": base64.b64encode(webm_chunk).decode()})
+    rng = random.Random(0)
+    pcm_frame = bytes(rng.getrandbits(8) for _ in range(int(frame_seconds * 32000)))
+    pcm_message = json.dumps({
+        "type": "audio", "format": "pcm16", "data": base64.b64encode(pcm_frame).decode()
+    })
+
+    def webm():
+        message = json.loads(webm_message)
+        decode_audio(base64.b64decode(message["data"]))
+
+    def pcm():
+        buffer = bytearray()
+        for _ in range(frames_per_chunk):
+            message = json.loads(pcm_message)
+            buffer.extend(base64.b64decode(message["data"]))
+        bytes(buffer)
+
+    print(f"capture: server ingest per {chunk_seconds}s chunk x {args.iterations} iterations")
+    _print_row("webm (ffmpeg decode)", _timeit(webm, args.iterations))
+    _print_row("pcm frames (no decode)", _timeit(pcm, args.iterations))
+    print(f"  wire bytes per second of audio: "
+          f"webm={len(webm_message) / chunk_seconds:.0f}  "
+          f"pcm={len(pcm_message) / frame_seconds:.0f}")
+    print(f"  messages per second: webm={1 / chunk_seconds:.2f}  pcm={1 / frame_seconds:.0f}")
+
+
+def bench_frames(args):
+    """
+    PCM 串流每個 chunk 的暫時記憶體配置 (tracemalloc peak)
+    舊寫法: bytearray 累積 -> bytes() -> astype(float32) -> /=
+    frame pipeline: 寫進 pool 的 buffer -> memoryview -> 轉進 thread 共用的 float32 buffer
+    超過 --max-bytes 時以 exit code 1 結束 (測試裡的檢查在 tests/test_audio_frames.py)；耗時也一起列出，frame pipeline 比較慢
+    """
+    import sys
+    import tracemalloc
+
+    import numpy as np
+
+    from asr_service import pcm_to_float32
+    from audio_frames import FrameAssembler
+
+    frame_bytes = int(0.1 * 32000)
+    chunk_bytes = int(args.chunk_seconds * 32000)
+    frames_per_chunk = chunk_bytes // frame_bytes
+    rng = random.Random(0)
+    socket_frames = [bytes(rng.getrandbits(8) for _ in range(frame_bytes)) for _ in range(frames_per_chunk)]
+
+    def legacy():
+        buffer = bytearray()
+        for data in socket_frames:
+            buffer.extend(data)
+        audio = np.frombuffer(bytes(buffer), dtype=np.int16).astype(np.float32)
+        audio /= 32768.0
+
+    assembler = FrameAssembler(chunk_bytes)
+
+    def pipeline():
+        for data in socket_frames:
+            for frame in assembler.append(data):
+                pcm_to_float32(frame.data)
+                frame.release()
+
+    def per_chunk_peak(fn) -> float:
+        fn()  # 預熱: pool 與 float32 buffer 第一次配置
+        peaks = []
+        tracemalloc.start()
+        for _ in range(args.iterations):
+            baseline, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            fn()
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - baseline)
+        tracemalloc.stop()
+        return statistics.fmean(peaks)
+
+    legacy_peak = per_chunk_peak(legacy)
+    pipeline_peak = per_chunk_peak(pipeline)
+    print(f"frames: transient allocation per {args.chunk_seconds}s chunk ({chunk_bytes} bytes PCM)")
+    print(f"  {'bytearray + astype':<28} {legacy_peak / 1024:10.1f} KB")
+    print(f"  {'frame pipeline':<28} {pipeline_peak / 1024:10.1f} KB  "
+          f"(pool buffers allocated: {assembler.pool.allocated})")
+    print(f"  {'bytearray + astype':<28} " + _format_stats(_timeit(legacy, args.iterations)))
+    print(f"  {'frame pipeline':<28} " + _format_stats(_timeit(pipeline, args.iterations)))
+
+    if pipeline_peak > args.max_bytes:
+        print(f"FAIL: frame pipeline allocates {pipeline_peak:.0f} bytes per chunk (max {args.max_bytes})")
+        sys.exit(1)
+
+
+def _rss_mb() -> float:
+    """目前的 resident memory (Linux /proc)"""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return float("nan")
+
+
+def _engine_child(args):
+    """在獨立的 process 量一個引擎 x 模型，記憶體才不會混在一起；結果以一行 JSON 印出"""
+    import asyncio
+    import json
+    import resource
+
+    from asr_service import create_asr_service
+    from tuning import _tuning_audio
+
+    pcm = _tuning_audio(args.audio)
+    audio_seconds = len(pcm) / 32000
+    baseline = _rss_mb()
+    start = time.perf_counter()
+    service = create_asr_service(engine=args.child[0], model_size=args.child[1])
+    asyncio.run(service.initialize())
+    load_seconds = time.perf_counter() - start
+    loaded = _rss_mb()
+
+    text = asyncio.run(service.transcribe_pcm(pcm)).text  # 預熱
+    rtfs = []
+    for _ in range(args.iterations):
+        start = time.perf_counter()
+        asyncio.run(service.transcribe_pcm(pcm))
+        rtfs.append((time.perf_counter() - start) / audio_seconds)
+    rtfs.sort()
+    print(json.dumps({
+        "load_s": load_seconds,
+        "model_mb": loaded - baseline,
+        "peak_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "rtf_p50": rtfs[len(rtfs) // 2],
+        "rtf_p95": rtfs[min(len(rtfs) - 1, int(len(rtfs) * 0.95))],
+        "text": text,
+    }, ensure_ascii=False))
+
+
+def bench_engines(args):
+    """
+    本地推論引擎比較: faster-whisper (CTranslate2) vs ONNX Runtime
+    每個組合在新的 process 載入模型，量 real-time factor (辨識耗時 / 音訊長度) 與記憶體
+    CPU 執行緒數與 compute_type 跟伺服器一樣取自 tuning (ASR_CPU_THREADS / ASR_COMPUTE_TYPE)
+    """
+    import json
+    import subprocess
+    import sys
+
+    if args.child:
+        return _engine_child(args)
+
+    print(f"engines: {args.iterations} iterations per combination (RTF lower is better)")
+    print(f"  {'engine':<16} {'model':<8} {'load':>7} {'model MB':>9} {'peak MB':>8} "
+          f"{'RTF p50':>8} {'RTF p95':>8}  text")
+    for model in args.models:
+        for engine in args.engines:
+            command = [sys.executable, __file__, "engines", "--child", engine, model,
+                       "--iterations", str(args.iterations)]
+            if args.audio:
+                command += ["--audio", args.audio]
+            proc = subprocess.run(command, capture_output=True, text=True)
+            if proc.returncode != 0:
+                error = (proc.stderr.strip().splitlines() or ["failed"])[-1]
+                print(f"  {engine:<16} {model:<8} failed: {error}")
+                continue
+            row = json.loads(proc.stdout.strip().splitlines()[-1])
+            print(f"  {engine:<16} {model:<8} {row['load_s']:6.1f}s {row['model_mb']:9.0f} {row['peak_mb']:8.0f} "
+                  f"{row['rtf_p50']:8.3f} {row['rtf_p95']:8.3f}  {row['text'][:20]}")
+
+
+def bench_features(args):
+    """
+    hybrid 一句話累積到 --seconds 秒的過程中，每收到一個 chunk 就要一份 encoder 輸入:
+    每次整段重算 log-mel vs IncrementalLogMel (只算新音訊的 frame)
+    兩者結果不一致時以 exit code 1 結束
+    """
+    import sys
+
+    import numpy as np
+
+    from whisper_features import IncrementalLogMel, log_mel_spectrogram, pad_or_trim
+
+    rng = np.random.default_rng(0)
+    chunk_samples = int(args.chunk_seconds * 16000)
+    chunks = [(rng.standard_normal(chunk_samples) * 3000).astype(np.int16).tobytes()
+              for _ in range(int(args.seconds / args.chunk_seconds))]
+
+    def full():
+        pcm = bytearray()
+        for chunk in chunks:
+            pcm.extend(chunk)
+            audio = np.frombuffer(bytes(pcm), dtype=np.int16).astype(np.float32) / 32768.0
+            log_mel_spectrogram(pad_or_trim(audio))
+
+    def incremental():
+        extractor = IncrementalLogMel()
+        for chunk in chunks:
+            extractor.feed(chunk)
+            extractor.features()
+
+    print(f"features: {len(chunks)} chunks of {args.chunk_seconds}s, features after every chunk")
+    full_stats = _timeit(full, args.iterations)
+    incremental_stats = _timeit(incremental, args.iterations)
+    _print_row("full recompute", full_stats)
+    _print_row("incremental", incremental_stats)
+    print(f"  per chunk: {full_stats['mean_us'] / len(chunks) / 1000:.2f} ms -> "
+          f"{incremental_stats['mean_us'] / len(chunks) / 1000:.2f} ms")
+
+    extractor = IncrementalLogMel()
+    audio = np.zeros(0, dtype=np.float32)
+    worst = 0.0
+    for chunk in chunks:
+        extractor.feed(chunk)
+        audio = np.concatenate([audio, np.frombuffer(chunk, dtype=np.int16).astype(np.float32) / 32768.0])
+        expected = log_mel_spectrogram(pad_or_trim(audio))
+        worst = max(worst, float(np.abs(extractor.features() - expected).max()))
+    print(f"  max abs difference: {worst:.2e}")
+    if worst > 1e-4:
+        print("FAIL: incremental features differ from the full computation")
+        sys.exit(1)
+
+
+def bench_logging(args):
+    """
+    每個 chunk 記 log 的成本 (呼叫端 thread，也就是 event loop / worker 實際付出的時間)
+    舊寫法: 數個 logger.info(f"...") 同步寫進 StreamHandler
+    新寫法: ChunkEvents 經過佇列，由 writer thread 格式化與輸出；另外量抽樣與沒開 DEBUG 的情況
+    """
+    import itertools
+    import logging
+    import os
+    import queue
+    from logging.handlers import QueueListener
+
+    import logs
+
+    sink = open(os.devnull, "w")
+    text = "今天天氣很好我們去公園散步"
+
+    def isolated(name: str, handler: logging.Handler, level: int) -> logging.Logger:
+        logger = logging.getLogger(f"bench.{name}")
+        logger.handlers = [handler]
+        logger.propagate = False
+        logger.setLevel(level)
+        return logger
+
+    stream = logging.StreamHandler(sink)
+    stream.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    sync_logger = isolated("sync", stream, logging.INFO)
+
+    def sync():
+        sync_logger.info(f"Transcribing {48000} bytes...")
+        sync_logger.info(f"Returning transcription: '{text}'")
+        sync_logger.info(f"Transcription result: '{text}' (final=True)")
+        sync_logger.info(f"Queued transcript for client: {text}")
+
+    target = logging.StreamHandler(sink)
+    target.setFormatter(logs.TextFormatter())
+    queued = logs._DroppingQueueHandler(queue.SimpleQueue(), maxsize=100000)
+    listener = QueueListener(queued.queue, logs._Writer(queued, target))
+    listener.start()
+
+    def events(name: str, level: int, sample: float):
+        isolated(name, queued, level)
+        chunk_log = logs.ChunkEvents(f"bench.{name}")
+        sampler = logs._Sampler(sample, 0)
+
+        sessions = itertools.cycle([f"{i:012x}" for i in range(1000)])
+
+        def run():
+            logs._sampler = sampler
+            logs.bind(session=next(sessions), seq=1)
+            chunk_log.event("transcribing", bytes=48000, format="pcm16")
+            chunk_log.event("transcription", engine="faster-whisper-small", text=text)
+            chunk_log.event("inference", audio_s=1.5, infer_ms=300.0, rtf=0.2)
+            chunk_log.event("transcribed", text=text, final=True, sent=True, total_ms=301.2)
+        return run
+
+    def row(label: str, fn) -> None:
+        _print_row(label, _timeit(fn, args.iterations))
+        while not queued.queue.empty():  # writer 寫完再量下一項，不互相搶 GIL
+            time.sleep(0.01)
+
+    print(f"logging: caller-side cost of one chunk's log lines ({args.iterations} chunks)")
+    row("sync f-string info", sync)
+    row("queued, every event", events("all", logging.DEBUG, 1.0))
+    row(f"queued, {args.sample:.0%} sessions", events("sampled", logging.DEBUG, args.sample))
+    row("DEBUG off", events("off", logging.INFO, 1.0))
+    listener.stop()
+    print(f"  dropped (queue full): {queued.dropped}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AprilVoice benchmarks")
+    sub = parser.add_subparsers(dest="suite", required=True)
+
+    p = sub.add_parser("postprocess", help="hallucination filter throughput")
+    p.add_argument("--rules", type=int, nargs="+", default=[0, 100, 500, 2000],
+                   help="extra synthetic rules to add on top of the configured ones")
+    p.add_argument("--iterations", type=int, default=200)
+    p.set_defaults(func=bench_postprocess)
+
+    p = sub.add_parser("decode", help="peak memory of long-file decoding (needs ffmpeg)")
+    p.add_argument("--minutes", type=int, nargs="+", default=[5, 30, 120])
+    p.set_defaults(func=bench_decode)
+
+    p = sub.add_parser("capture", help="server cost of WebM chunks vs PCM frames (needs ffmpeg)")
+    p.add_argument("--iterations", type=int, default=50)
+    p.set_defaults(func=bench_capture)
+
+    p = sub.add_parser("frames", help="per-chunk allocations of the PCM frame pipeline (tracemalloc)")
+    p.add_argument("--chunk-seconds", type=float, default=1.5)
+    p.add_argument("--iterations", type=int, default=100)
+    p.add_argument("--max-bytes", type=int, default=16384,
+                   help="fail if the frame pipeline allocates more than this per chunk")
+    p.set_defaults(func=bench_frames)
+
+    p = sub.add_parser("engines", help="RTF and memory of faster-whisper vs ONNX Runtime")
+    p.add_argument("--engines", nargs="+", default=["faster-whisper", "onnx"])
+    p.add_argument("--models", nargs="+", default=["tiny", "small"])
+    p.add_argument("--iterations", type=int, default=10)
+    p.add_argument("--audio", help="audio file to transcribe (real speech recommended); default is synthetic")
+    p.add_argument("--child", nargs=2, metavar=("ENGINE", "MODEL"), help=argparse.SUPPRESS)
+    p.set_defaults(func=bench_engines)
+
+    p = sub.add_parser("features", help="log-mel for a growing utterance: full recompute vs incremental")
+    p.add_argument("--seconds", type=float, default=15.0)
+    p.add_argument("--chunk-seconds", type=float, default=1.5)
+    p.add_argument("--iterations", type=int, default=5)
+    p.set_defaults(func=bench_features)
+
+    p = sub.add_parser("logging", help="per-chunk logging cost on the event loop / workers: sync vs queued events")
+    p.add_argument("--iterations", type=int, default=20000)
+    p.add_argument("--sample", type=float, default=0.1, help="fraction of sessions with per-chunk events")
+    p.set_defaults(func=bench_logging)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Cancellation for AprilVoice
+A token is shared between the event loop and the worker thread running a job;
+long-running steps (ffmpeg, Whisper segments) check it and stop early.
+"""
+
+import contextvars
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+
+class Cancelled(Exception):
+    """工作被取消 (連線中斷或 reset)"""
+
+
+class CancelToken:
+    """可以跨 thread 使用的取消旗標"""
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self) -> None:
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def raise_if_cancelled(self) -> None:
+        if self._event.is_set():
+            raise Cancelled()
+
+
+# 目前這個工作的 token，asyncio.run 會把 context 帶進 coroutine
+_current: contextvars.ContextVar[Optional[CancelToken]] = contextvars.ContextVar(
+    "cancel_token", default=None
+)
+
+
+@contextmanager
+def cancel_scope(token: Optional[CancelToken]):
+    """在這個 scope 裡呼叫的 decoder / 模型都會檢查 token"""
+    reset = _current.set(token)
+    try:
+        yield
+    finally:
+        _current.reset(reset)
+
+
+def current_token() -> Optional[CancelToken]:
+    return _current.get()
+
+
+def is_cancelled() -> bool:
+    token = _current.get()
+    return token is not None and token.cancelled
+
+
+def check_cancelled() -> None:
+    token = _current.get()
+    if token is not None:
+        token.raise_if_cancelled()
@@ -9,15 +9,22 @@ import json
 import logging
 import os
 import tempfile
+import time
 from abc import ABC, abstractmethod
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from pathlib import Path
 from typing import Optional
 
-from asr_service import ASRService, TranscriptionResult, decode_audio
+from asr_service import ASRService, TranscriptionResult, decode_audio, pcm_to_wav
+from cancellation import check_cancelled
+from logs import ChunkEvents
+from postprocess import get_post_processor
+from startup import profile as startup_profile, timed_import
+from webm import webm_duration
 
 logger = logging.getLogger(__name__)
+chunk_log = ChunkEvents(__name__)
 
 
 @dataclass
@@ -38,6 +45,8 @@ class AccountPool:
     """帳號池，支援多帳號輪換"""
     accounts: list[AccountCredentials] = field(default_factory=list)
     current_index: int = 0
+    consecutive_errors: int = 0  # 連續失敗的請求數，成功一次就歸零
+    last_error_at: float = 0.0  # time.monotonic()
 
     def add_account(self, account: AccountCredentials):
         self.accounts.append(account)
@@ -72,11 +81,35 @@ class AccountPool:
         if self.accounts:
             self.current_index = (self.current_index + 1) % len(self.accounts)
 
+    def record_error(self):
+        """請求失敗：記錄下來並換下一個帳號"""
+        self.consecutive_errors += 1
+        self.last_error_at = time.monotonic()
+        self.rotate_account()
+
     def record_usage(self, minutes: float):
-        """記錄用量"""
+        """記錄用量 (請求成功)"""
+        self.consecutive_errors = 0
         if self.accounts:
             self.accounts[self.current_index].used_minutes += minutes
 
+    def has_quota(self) -> bool:
+        return any(
+            account.enabled and (account.monthly_limit == 0 or account.used_minutes < account.monthly_limit)
+            for account in self.accounts
+        )
+
+    def is_available(self, max_errors: int = 3, cooldown: float = 60.0) -> bool:
+        """
+        還有額度，而且最近沒有連續失敗
+        連續失敗 max_errors 次後視為不可用，cooldown 秒後再給機會
+        """
+        if not self.has_quota():
+            return False
+        if self.consecutive_errors >= max_errors:
+            return time.monotonic() - self.last_error_at > cooldown
+        return True
+
     def get_status(self) -> dict:
         """取得所有帳號狀態"""
         return {
@@ -119,7 +152,7 @@ class AzureSpeechService(ASRService):
             return
 
         try:
-            import azure.cognitiveservices.speech as speechsdk
+            speechsdk = await asyncio.to_thread(timed_import, "azure.cognitiveservices.speech")
             self._speechsdk = speechsdk
             self._initialized = True
             logger.info(f"Azure Speech initialized with {len(self.account_pool.accounts)} accounts")
@@ -128,6 +161,9 @@ class AzureSpeechService(ASRService):
             raise
 
     async def transcribe(self, audio_data: bytes) -> TranscriptionResult:
+        return await self.transcribe_pcm(decode_audio(audio_data))
+
+    async def transcribe_pcm(self, pcm_data: bytes) -> TranscriptionResult:
         if not self._initialized:
             await self.initialize()
 
@@ -137,27 +173,9 @@ class AzureSpeechService(ASRService):
             return TranscriptionResult(text="", is_final=True, confidence=0.0)
 
         try:
-            # 解碼音訊
-            pcm_data = decode_audio(audio_data)
-
-            # 寫入暫存 WAV 檔
+            # 寫入暫存 WAV 檔 (16kHz, 16-bit, mono)
             with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as f:
-                # 寫入 WAV header (16kHz, 16-bit, mono)
-                import struct
-                f.write(b'RIFF')
-                f.write(struct.pack('<I', 36 + len(pcm_data)))
-                f.write(b'WAVE')
-                f.write(b'fmt ')
-                f.write(struct.pack('<I', 16))  # chunk size
-                f.write(struct.pack('<H', 1))   # audio format (PCM)
-                f.write(struct.pack('<H', 1))   # channels
-                f.write(struct.pack('<I', 16000))  # sample rate
-                f.write(struct.pack('<I', 32000))  # byte rate
-                f.write(struct.pack('<H', 2))   # block align
-                f.write(struct.pack('<H', 16))  # bits per sample
-                f.write(b'data')
-                f.write(struct.pack('<I', len(pcm_data)))
-                f.write(pcm_data)
+                f.write(pcm_to_wav(pcm_data))
                 wav_path = f.name
 
             try:
@@ -182,10 +200,13 @@ class AzureSpeechService(ASRService):
                 self.account_pool.record_usage(duration_minutes)
 
                 if result.reason == self._speechsdk.ResultReason.RecognizedSpeech:
-                    logger.info(f"Azure transcription: '{result.text}'")
-                    return TranscriptionResult(text=result.text, is_final=True, confidence=0.9)
+                    chunk_log.event("transcription", provider="azure", text=result.text)
+                    return get_post_processor().process(
+                        TranscriptionResult(text=result.text, is_final=True, confidence=0.9),
+                        source="azure",
+                    )
                 else:
-                    logger.warning(f"Azure no speech: {result.reason}")
+                    chunk_log.event("no speech", provider="azure", reason=str(result.reason))
                     return TranscriptionResult(text="", is_final=True, confidence=0.0)
 
             finally:
@@ -194,7 +215,7 @@ class AzureSpeechService(ASRService):
         except Exception as e:
             logger.error(f"Azure transcription error: {e}")
             # 切換到下一個帳號
-            self.account_pool.rotate_account()
+            self.account_pool.record_error()
             return TranscriptionResult(text="", is_final=True, confidence=0.0)
 
     async def reset(self) -> None:
@@ -227,7 +248,7 @@ class GoogleSpeechService(ASRService):
             return
 
         try:
-            from google.cloud import speech
+            speech = await asyncio.to_thread(timed_import, "google.cloud.speech")
             self._speech = speech
             self._initialized = True
             logger.info(f"Google Speech initialized with {len(self.account_pool.accounts)} accounts")
@@ -236,6 +257,9 @@ class GoogleSpeechService(ASRService):
             raise
 
     async def transcribe(self, audio_data: bytes) -> TranscriptionResult:
+        return await self.transcribe_pcm(decode_audio(audio_data))
+
+    async def transcribe_pcm(self, pcm_data: bytes) -> TranscriptionResult:
         if not self._initialized:
             await self.initialize()
 
@@ -248,9 +272,6 @@ class GoogleSpeechService(ASRService):
             # 設定認證
             os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = account.api_key
 
-            # 解碼音訊
-            pcm_data = decode_audio(audio_data)
-
             # 建立客戶端
             client = self._speech.SpeechClient()
 
@@ -271,14 +292,17 @@ class GoogleSpeechService(ASRService):
             if response.results:
                 text = response.results[0].alternatives[0].transcript
                 confidence = response.results[0].alternatives[0].confidence
-                logger.info(f"Google transcription: '{text}'")
-                return TranscriptionResult(text=text, is_final=True, confidence=confidence)
+                chunk_log.event("transcription", provider="google", text=text)
+                return get_post_processor().process(
+                    TranscriptionResult(text=text, is_final=True, confidence=confidence),
+                    source="google",
+                )
             else:
                 return TranscriptionResult(text="", is_final=True, confidence=0.0)
 
         except Exception as e:
             logger.error(f"Google transcription error: {e}")
-            self.account_pool.rotate_account()
+            self.account_pool.record_error()
             return TranscriptionResult(text="", is_final=True, confidence=0.0)
 
     async def reset(self) -> None:
@@ -309,7 +333,7 @@ class GeminiSpeechService(ASRService):
             return
 
         try:
-            import google.generativeai as genai
+            genai = await asyncio.to_thread(timed_import, "google.generativeai")
             self._genai = genai
             self._initialized = True
             logger.info(f"Gemini Speech initialized with {len(self.account_pool.accounts)} accounts")
@@ -318,6 +342,9 @@ class GeminiSpeechService(ASRService):
             raise
 
     async def transcribe(self, audio_data: bytes) -> TranscriptionResult:
+        return await self.transcribe_pcm(decode_audio(audio_data))
+
+    async def transcribe_pcm(self, pcm_data: bytes) -> TranscriptionResult:
         if not self._initialized:
             await self.initialize()
 
@@ -330,33 +357,12 @@ class GeminiSpeechService(ASRService):
             # 設定 API Key
             self._genai.configure(api_key=account.api_key)
 
-            # 解碼音訊為 PCM
-            pcm_data = decode_audio(audio_data)
-
-            # 轉成 WAV 格式（Gemini 需要）
-            import struct
-            wav_buffer = bytearray()
-            wav_buffer.extend(b'RIFF')
-            wav_buffer.extend(struct.pack('<I', 36 + len(pcm_data)))
-            wav_buffer.extend(b'WAVE')
-            wav_buffer.extend(b'fmt ')
-            wav_buffer.extend(struct.pack('<I', 16))
-            wav_buffer.extend(struct.pack('<H', 1))   # PCM
-            wav_buffer.extend(struct.pack('<H', 1))   # mono
-            wav_buffer.extend(struct.pack('<I', 16000))  # sample rate
-            wav_buffer.extend(struct.pack('<I', 32000))  # byte rate
-            wav_buffer.extend(struct.pack('<H', 2))   # block align
-            wav_buffer.extend(struct.pack('<H', 16))  # bits per sample
-            wav_buffer.extend(b'data')
-            wav_buffer.extend(struct.pack('<I', len(pcm_data)))
-            wav_buffer.extend(pcm_data)
-
             # 使用 Gemini 2.0 Flash（支援音訊）
             model = self._genai.GenerativeModel('gemini-2.0-flash-exp')
 
             # 上傳音訊
             audio_file = self._genai.upload_file(
-                data=bytes(wav_buffer),
+                data=pcm_to_wav(pcm_data),  # Gemini 需要 WAV
                 mime_type="audio/wav"
             )
 
@@ -379,42 +385,18 @@ class GeminiSpeechService(ASRService):
 
             text = response.text.strip()
 
-            # 過濾空白回應和幻覺
-            empty_responses = ["", "空白", "無", "（無）", "(無)", "聽不清楚", "沒有語音", "無法辨識", "..."]
-            if text in empty_responses:
-                return TranscriptionResult(text="", is_final=True, confidence=0.0)
-
-            # 過濾常見幻覺文字（繁體+簡體）
-            hallucinations = [
-                # 繁體
-                "請訂閱", "訂閱", "感謝收看", "感謝觀看", "謝謝收看", "謝謝觀看",
-                "下一集", "敬請期待", "記得按讚", "喜歡的話", "點讚",
-                "字幕", "繁體中文", "簡體中文", "翻譯",
-                # 簡體幻覺
-                "请订阅", "订阅", "感谢收看", "感谢观看", "谢谢收看", "谢谢观看",
-                "点赞", "不吝点赞", "打赏", "打赏支持", "明镜", "点点栏目",
-                "请不吝", "支持明镜", "们白痴",
-                # 英文
-                "please subscribe", "thank you for watching", "like and subscribe",
-            ]
-            for h in hallucinations:
-                if h in text:
-                    logger.warning(f"Filtered hallucination: '{text}'")
-                    return TranscriptionResult(text="", is_final=True, confidence=0.0)
-
-            # 偵測簡體字（常見簡體字元）
-            simplified_chars = "请订阅谢观赞们这个来说为会对"
-            simplified_count = sum(1 for c in text if c in simplified_chars)
-            if simplified_count >= 2:
-                logger.warning(f"Filtered simplified Chinese: '{text}'")
-                return TranscriptionResult(text="", is_final=True, confidence=0.0)
-
-            logger.info(f"Gemini transcription: '{text}'")
-            return TranscriptionResult(text=text, is_final=True, confidence=0.9)
+            # 空白回應、幻覺、簡體字由共用後處理過濾
+            result = get_post_processor().process(
+                TranscriptionResult(text=text, is_final=True, confidence=0.9),
+                source="gemini",
+            )
+            if result.text:
+                chunk_log.event("transcription", provider="gemini", text=text)
+            return result
 
         except Exception as e:
             logger.error(f"Gemini transcription error: {e}")
-            self.account_pool.rotate_account()
+            self.account_pool.record_error()
             return TranscriptionResult(text="", is_final=True, confidence=0.0)
 
     async def reset(self) -> None:
@@ -428,6 +410,9 @@ class OpenAIWhisperService(ASRService):
     無免費額度，但新用戶有 $5 額度
     """
 
+    # 可以直接上傳 MediaRecorder 的 WebM/Opus，不用先解碼成 WAV
+    accepts_compressed = True
+
     def __init__(self, account_pool: Optional[AccountPool] = None):
         self.account_pool = account_pool or AccountPool()
         self._initialized = False
@@ -445,7 +430,7 @@ class OpenAIWhisperService(ASRService):
             return
 
         try:
-            import openai
+            openai = await asyncio.to_thread(timed_import, "openai")
             self._openai = openai
             self._initialized = True
             logger.info(f"OpenAI Whisper initialized with {len(self.account_pool.accounts)} accounts")
@@ -454,6 +439,16 @@ class OpenAIWhisperService(ASRService):
             raise
 
     async def transcribe(self, audio_data: bytes) -> TranscriptionResult:
+        return await self.transcribe_pcm(decode_audio(audio_data))
+
+    async def transcribe_pcm(self, pcm_data: bytes) -> TranscriptionResult:
+        return await self._request(("audio.wav", pcm_to_wav(pcm_data)), len(pcm_data) / 32000)
+
+    async def transcribe_compressed(self, audio_data: bytes, duration: float) -> TranscriptionResult:
+        """直接上傳原始 WebM/Opus，duration (秒) 由容器資訊取得，用來記錄用量"""
+        return await self._request(("audio.webm", audio_data), duration)
+
+    async def _request(self, audio_file: tuple[str, bytes], duration: float) -> TranscriptionResult:
         if not self._initialized:
             await self.initialize()
 
@@ -463,53 +458,27 @@ class OpenAIWhisperService(ASRService):
             return TranscriptionResult(text="", is_final=True, confidence=0.0)
 
         try:
-            # 解碼音訊並轉為 WAV
-            pcm_data = decode_audio(audio_data)
-
-            # 寫入暫存 WAV 檔
-            with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as f:
-                import struct
-                f.write(b'RIFF')
-                f.write(struct.pack('<I', 36 + len(pcm_data)))
-                f.write(b'WAVE')
-                f.write(b'fmt ')
-                f.write(struct.pack('<I', 16))
-                f.write(struct.pack('<H', 1))
-                f.write(struct.pack('<H', 1))
-                f.write(struct.pack('<I', 16000))
-                f.write(struct.pack('<I', 32000))
-                f.write(struct.pack('<H', 2))
-                f.write(struct.pack('<H', 16))
-                f.write(b'data')
-                f.write(struct.pack('<I', len(pcm_data)))
-                f.write(pcm_data)
-                wav_path = f.name
-
-            try:
-                # 使用 OpenAI API
-                client = self._openai.OpenAI(api_key=account.api_key)
-
-                with open(wav_path, "rb") as audio_file:
-                    response = client.audio.transcriptions.create(
-                        model="whisper-1",
-                        file=audio_file,
-                        language="zh",
-                    )
-
-                # 記錄用量
-                duration_minutes = len(pcm_data) / 32000 / 60
-                self.account_pool.record_usage(duration_minutes)
+            # 使用 OpenAI API
+            client = self._openai.OpenAI(api_key=account.api_key)
+            response = client.audio.transcriptions.create(
+                model="whisper-1",
+                file=audio_file,
+                language="zh",
+            )
 
-                text = response.text.strip()
-                logger.info(f"OpenAI transcription: '{text}'")
-                return TranscriptionResult(text=text, is_final=True, confidence=0.95)
+            # 記錄用量
+            self.account_pool.record_usage(duration / 60)
 
-            finally:
-                os.unlink(wav_path)
+            text = response.text.strip()
+            chunk_log.event("transcription", provider="openai", text=text, file=audio_file[0], bytes=len(audio_file[1]))
+            return get_post_processor().process(
+                TranscriptionResult(text=text, is_final=True, confidence=0.95, duration=duration),
+                source="openai",
+            )
 
         except Exception as e:
             logger.error(f"OpenAI transcription error: {e}")
-            self.account_pool.rotate_account()
+            self.account_pool.record_error()
             return TranscriptionResult(text="", is_final=True, confidence=0.0)
 
     async def reset(self) -> None:
@@ -526,11 +495,21 @@ class MultiProviderASRService(ASRService):
         self.providers: dict[str, ASRService] = {}
         self.provider_order: list[str] = []
         self.current_provider_index: int = 0
+        self.passthrough: dict[str, bool] = {}
+        self.failed_init: set[str] = set()  # 初始化失敗的提供商
         self._initialized = False
-
-    def add_provider(self, name: str, service: ASRService, priority: int = 0):
-        """新增提供商"""
+        self._background: Optional[asyncio.Future] = None  # 其餘提供商的背景初始化
+
+    def add_provider(
+        self, name: str, service: ASRService, priority: int = 0, passthrough: Optional[bool] = None
+    ):
+        """
+        新增提供商
+        passthrough: 是否直接轉送原始壓縮音訊 (None = 服務支援就開啟)
+        """
         self.providers[name] = service
+        supported = getattr(service, "accepts_compressed", False)
+        self.passthrough[name] = supported if passthrough is None else (passthrough and supported)
         # 按優先順序排序
         self.provider_order.append((priority, name))
         self.provider_order.sort(key=lambda x: x[0])
@@ -543,28 +522,56 @@ class MultiProviderASRService(ASRService):
         return name, self.providers[name]
 
     async def initialize(self) -> None:
+        """
+        依優先順序初始化到第一個成功的提供商就可以開始辨識；
+        其餘的在背景同時初始化 (SDK 在 thread 裡 import)，不用等所有 SDK 載入完
+        切換到還沒初始化好的提供商時，它的 transcribe 會自己初始化
+        """
         if self._initialized:
             return
 
-        for name, service in self.providers.items():
-            try:
-                await service.initialize()
-                logger.info(f"Initialized provider: {name}")
-            except Exception as e:
-                logger.warning(f"Failed to initialize {name}: {e}")
+        remaining = [name for _, name in self.provider_order]
+        while remaining:
+            if await self._initialize_provider(remaining.pop(0)):
+                break
+        if remaining:
+            self._background = asyncio.gather(*(self._initialize_provider(name) for name in remaining))
 
         self._initialized = True
 
+    async def _initialize_provider(self, name: str) -> bool:
+        try:
+            with startup_profile.phase(f"provider {name}"):
+                await self.providers[name].initialize()
+        except Exception as e:
+            self.failed_init.add(name)
+            logger.warning(f"Failed to initialize {name}: {e}")
+            return False
+        self.failed_init.discard(name)
+        logger.info(f"Initialized provider: {name}")
+        return True
+
     async def transcribe(self, audio_data: bytes) -> TranscriptionResult:
         if not self._initialized:
             await self.initialize()
 
+        # 原始音訊的長度 (秒)，只有轉送壓縮音訊時才需要；None = 不是 WebM 或看不出長度
+        duration = webm_duration(audio_data) if any(self.passthrough.values()) else None
+        pcm_data = None
+
         # 嘗試所有提供商
         for _ in range(len(self.provider_order)):
+            check_cancelled()
             name, service = self.get_current_provider()
-            logger.info(f"Using provider: {name}")
+            chunk_log.event("using provider", provider=name)
 
-            result = await service.transcribe(audio_data)
+            if duration and self.passthrough.get(name):
+                result = await service.transcribe_compressed(audio_data, duration)
+            else:
+                # 只解碼一次，換提供商重試時沿用
+                if pcm_data is None:
+                    pcm_data = decode_audio(audio_data)
+                result = await service.transcribe_pcm(pcm_data)
 
             if result.text:
                 return result
@@ -574,16 +581,54 @@ class MultiProviderASRService(ASRService):
 
         return TranscriptionResult(text="", is_final=True, confidence=0.0)
 
+    async def transcribe_pcm(self, pcm_data: bytes) -> TranscriptionResult:
+        """
+        hybrid 模式的 final 已經是 PCM：直接交給提供商，不再包成 WAV 給 ffmpeg 解一次
+        PCM 串流的 chunk 是 pool buffer 的 memoryview，只有本地引擎在工作裡直接讀；
+        雲端 SDK 只收 bytes (例如 Google 的 proto-plus bytes 欄位)，這裡複製一份，換提供商重試時沿用
+        """
+        if not self._initialized:
+            await self.initialize()
+
+        pcm_data = bytes(pcm_data)
+        for _ in range(len(self.provider_order)):
+            check_cancelled()
+            name, service = self.get_current_provider()
+            chunk_log.event("using provider", provider=name)
+
+            result = await service.transcribe_pcm(pcm_data)
+            if result.text:
+                return result
+
+            self.current_provider_index = (self.current_provider_index + 1) % len(self.provider_order)
+
+        return TranscriptionResult(text="", is_final=True, confidence=0.0)
+
     async def reset(self) -> None:
         for service in self.providers.values():
             await service.reset()
 
+    def available_providers(self, max_errors: int = 3, cooldown: float = 60.0) -> list[str]:
+        """初始化成功、還有額度、最近沒有連續失敗的提供商 (依優先順序)"""
+        available = []
+        for _, name in self.provider_order:
+            if name in self.failed_init:
+                continue
+            pool = getattr(self.providers[name], 'account_pool', None)
+            if pool is None or pool.is_available(max_errors, cooldown):
+                available.append(name)
+        return available
+
     def get_status(self) -> dict:
         """取得所有提供商狀態"""
         status = {}
+        available = self.available_providers()
         for name, service in self.providers.items():
             if hasattr(service, 'account_pool'):
                 status[name] = service.account_pool.get_status()
+                status[name]["passthrough"] = self.passthrough.get(name, False)
+                status[name]["consecutive_errors"] = service.account_pool.consecutive_errors
+                status[name]["available"] = name in available
         return status
 
 
@@ -634,7 +679,10 @@ def load_cloud_config(config_path: str = "cloud_asr_config.json") -> MultiProvid
                 monthly_limit=acc.get("monthly_limit", 0),
             )
         if openai_service.account_pool.accounts:
-            multi_service.add_provider("openai", openai_service, priority=3)
+            multi_service.add_provider(
+                "openai", openai_service, priority=3,
+                passthrough=config["openai"].get("passthrough"),
+            )
 
     # 載入 Gemini 帳號（最簡單，只要 API Key）
     if "gemini" in config:
@@ -0,0 +1,109 @@
+"""
+ONNX export for AprilVoice
+Exports a Whisper checkpoint to ONNX (encoder, decoder, decoder with KV cache),
+writes int8 dynamically-quantized copies for OnnxWhisperService and stores the
+weights as external data so workers can memory-map and share them.
+Run: python export_onnx.py --model small [--output models/whisper-small-onnx]
+Needs: pip install "optimum[exporters]" onnxruntime (only on the machine doing the export)
+"""
+
+import argparse
+import logging
+import os
+
+from asr_service import default_onnx_model_dir
+
+logger = logging.getLogger(__name__)
+
+MODELS = ["encoder_model", "decoder_model", "decoder_with_past_model"]
+
+
+def model_id(model: str) -> str:
+    """tiny / base / small ... 對應 openai/whisper-*；其他值當作 Hugging Face 的 model id 或本地路徑"""
+    if "/" in model or os.path.isdir(model):
+        return model
+    return f"openai/whisper-{model}"
+
+
+def export(model: str, output: str) -> None:
+    """
+    匯出 encoder / decoder / decoder_with_past 三個模型 (不合併 decoder，推論時不需要 if 分支)
+    tokenizer.json 與 config.json 一起放在 output
+    """
+    from optimum.exporters.onnx import main_export
+
+    logger.info(f"Exporting {model_id(model)} to {output}...")
+    main_export(
+        model_id(model),
+        output=output,
+        task="automatic-speech-recognition-with-past",
+        no_post_process=True,
+    )
+    missing = [name for name in MODELS if not os.path.exists(os.path.join(output, f"{name}.onnx"))]
+    if missing:
+        raise RuntimeError(f"Export did not produce: {', '.join(missing)}")
+
+
+def quantize(output: str) -> None:
+    """每個模型存一份 int8 動態量化 (權重 int8、activation 執行時量化) 的 *_int8.onnx"""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    for name in MODELS:
+        source = os.path.join(output, f"{name}.onnx")
+        target = os.path.join(output, f"{name}_int8.onnx")
+        logger.info(f"Quantizing {name} -> int8")
+        quantize_dynamic(source, target, weight_type=QuantType.QInt8)
+        logger.info(f"  {os.path.getsize(source) / 1e6:.0f} MB -> {os.path.getsize(target) / 1e6:.0f} MB")
+
+
+def save_external_data(output: str) -> None:
+    """
+    每個模型的權重另存成 <name>.onnx.data (external data)
+    ONNX Runtime 載入時直接 mmap 這個檔案，serve.py 的多個 worker 共用 page cache 裡的同一份權重
+    (見 OnnxWhisperService 的 share_weights)
+    """
+    import onnx
+    from onnx.external_data_helper import ExternalDataInfo, uses_external_data
+
+    for name in MODELS:
+        for suffix in ("", "_int8"):
+            path = os.path.join(output, f"{name}{suffix}.onnx")
+            if not os.path.exists(path):
+                continue
+            old = {
+                ExternalDataInfo(tensor).location
+                for tensor in onnx.load(path, load_external_data=False).graph.initializer
+                if uses_external_data(tensor)
+            }
+            model = onnx.load(path)  # 連同原本的 external data 一起讀進記憶體
+            location = f"{name}{suffix}.onnx.data"
+            # 已經存在的 .data 會被接在後面寫，先刪掉
+            for stale in old | {location}:
+                if os.path.exists(os.path.join(output, stale)):
+                    os.remove(os.path.join(output, stale))
+            onnx.save_model(model, path, save_as_external_data=True, location=location)
+            logger.info(f"Saved {name}{suffix} weights to {location}")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Export Whisper to ONNX for OnnxWhisperService")
+    parser.add_argument("--model", default="small", help="tiny/base/small/medium/large-v3 or a Hugging Face model id")
+    parser.add_argument("--output", help="output directory (default backend/models/whisper-<model>-onnx)")
+    parser.add_argument("--no-quantize", action="store_true", help="skip the int8 copies")
+    args = parser.parse_args()
+
+    output = args.output or default_onnx_model_dir(os.path.basename(args.model.rstrip("/")))
+    export(args.model, output)
+    if not args.no_quantize:
+        quantize(output)
+    save_external_data(output)
+    # 預設位置的標準模型大小，OnnxWhisperService(model_size=...) 會自己找到
+    if output == default_onnx_model_dir(args.model):
+        print(f"exported to {output}; use with ASR_ENGINE=onnx")
+    else:
+        print(f"exported to {output}; use with ASR_ENGINE=onnx ONNX_MODEL_DIR={output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Health signals for AprilVoice
+Liveness (is the process making progress) and readiness (should a load balancer
+send new sessions here) with configurable thresholds.
+"""
+
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass
+class HealthThresholds:
+    """readiness / liveness 門檻，都可以用環境變數調整"""
+    max_queue: int = 2  # READY_MAX_QUEUE: 在 scheduler 排隊等 worker 的即時辨識數
+    max_rtf: float = 0.9  # READY_MAX_RTF: 最近的 real-time factor (辨識耗時 / 音訊長度)
+    max_load: float = 0.9  # READY_MAX_LOAD: 連線用量 / 容量
+    min_cloud_providers: int = 1  # READY_MIN_CLOUD_PROVIDERS: 雲端是主要辨識來源時至少要有幾個可用
+    rtf_stale_after: float = 30.0  # READY_RTF_STALE_AFTER: 這麼久沒有辨識就不參考舊的 RTF
+    max_inference_seconds: float = 120.0  # LIVE_MAX_INFERENCE_SECONDS: 單次辨識超過就當作卡住
+
+    @classmethod
+    def from_env(cls) -> "HealthThresholds":
+        defaults = cls()
+        return cls(
+            max_queue=int(os.getenv("READY_MAX_QUEUE", str(defaults.max_queue))),
+            max_rtf=float(os.getenv("READY_MAX_RTF", str(defaults.max_rtf))),
+            max_load=float(os.getenv("READY_MAX_LOAD", str(defaults.max_load))),
+            min_cloud_providers=int(os.getenv("READY_MIN_CLOUD_PROVIDERS", str(defaults.min_cloud_providers))),
+            rtf_stale_after=float(os.getenv("READY_RTF_STALE_AFTER", str(defaults.rtf_stale_after))),
+            max_inference_seconds=float(
+                os.getenv("LIVE_MAX_INFERENCE_SECONDS", str(defaults.max_inference_seconds))
+            ),
+        )
+
+
+class InferenceMonitor:
+    """
+    記錄每次辨識 (在 worker thread 呼叫)
+    最近的 RTF 用指數移動平均；進行中的辨識記下開始時間，用來判斷 worker 是否卡住
+    """
+
+    def __init__(self, alpha: float = 0.3):
+        self.alpha = alpha
+        self.rtf = 0.0
+        self.completed = 0
+        self._last_sample = 0.0
+        self._running: dict[int, float] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def start(self) -> int:
+        with self._lock:
+            job_id = self._next_id
+            self._next_id += 1
+            self._running[job_id] = time.monotonic()
+        return job_id
+
+    def finish(self, job_id: int, audio_seconds: float, elapsed: float) -> None:
+        with self._lock:
+            self._running.pop(job_id, None)
+            self.completed += 1
+            if audio_seconds <= 0:
+                return
+            sample = elapsed / audio_seconds
+            self.rtf = sample if self._last_sample == 0 else (
+                self.alpha * sample + (1 - self.alpha) * self.rtf
+            )
+            self._last_sample = time.monotonic()
+
+    def recent_rtf(self, stale_after: float) -> Optional[float]:
+        """最近的 RTF；太久沒有辨識回傳 None (閒置的節點不該因為舊資料被判定忙碌)"""
+        if not self._last_sample or time.monotonic() - self._last_sample > stale_after:
+            return None
+        return self.rtf
+
+    def longest_running(self) -> float:
+        """進行中最久的一次辨識已經跑了幾秒"""
+        with self._lock:
+            if not self._running:
+                return 0.0
+            return time.monotonic() - min(self._running.values())
+
+    @property
+    def running(self) -> int:
+        return len(self._running)
+
+
+def check(ok: bool, **details) -> dict:
+    return {"ok": ok, **details}
@@ -0,0 +1,147 @@
+"""
+Load shedding for AprilVoice
+Steps transcription quality down under CPU pressure and back up when load drops.
+"""
+
+import json
+import logging
+import time
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ShedLevel:
+    """一個降級等級，None 表示沿用正常設定"""
+    name: str
+    model_size: Optional[str] = None  # 改用較小的本地模型
+    beam_size: Optional[int] = None
+    skip_partials: bool = False  # hybrid 模式不送 partial
+    accumulate_chunks: int = 1  # 累積幾個 chunk 才辨識一次
+    use_cloud: bool = False  # 交給雲端 (需要 cloud_asr_config.json)
+
+
+DEFAULT_LEVELS = [
+    ShedLevel("normal"),
+    ShedLevel("no-partials", skip_partials=True, accumulate_chunks=2),
+    ShedLevel("small-model", model_size="base", skip_partials=True, accumulate_chunks=2),
+    ShedLevel("cloud", use_cloud=True, skip_partials=True),
+]
+
+
+class LoadController:
+    """
+    依照排隊深度與 real-time factor (辨識耗時 / 音訊長度) 調整降級等級
+    壓力持續 step_down_after 秒就降一級，負載低持續 step_up_after 秒才升一級
+    """
+
+    def __init__(
+        self,
+        levels: Optional[list[ShedLevel]] = None,
+        queue_high: int = 4,
+        queue_low: int = 1,
+        rtf_high: float = 0.8,
+        rtf_low: float = 0.4,
+        step_down_after: float = 3.0,
+        step_up_after: float = 15.0,
+        rtf_alpha: float = 0.3,
+        rtf_stale_after: float = 10.0,
+    ):
+        self.levels = levels or list(DEFAULT_LEVELS)
+        self.queue_high = queue_high
+        self.queue_low = queue_low
+        self.rtf_high = rtf_high
+        self.rtf_low = rtf_low
+        self.step_down_after = step_down_after
+        self.step_up_after = step_up_after
+        self.rtf_alpha = rtf_alpha
+        self.rtf_stale_after = rtf_stale_after
+
+        self.level_index = 0
+        self.rtf = 0.0
+        self.queue_depth = 0
+        self._last_sample = 0.0
+        self._pressure_since: Optional[float] = None
+        self._relaxed_since: Optional[float] = None
+
+    @property
+    def level(self) -> ShedLevel:
+        return self.levels[self.level_index]
+
+    def record_inference(self, audio_seconds: float, elapsed: float) -> None:
+        """記錄一次辨識耗時 (在 worker thread 呼叫)"""
+        if audio_seconds <= 0:
+            return
+        sample = elapsed / audio_seconds
+        self.rtf = sample if self._last_sample == 0 else (
+            self.rtf_alpha * sample + (1 - self.rtf_alpha) * self.rtf
+        )
+        self._last_sample = time.monotonic()
+
+    def update(self, queue_depth: int, now: Optional[float] = None) -> ShedLevel:
+        """定期呼叫，回傳目前的等級"""
+        now = time.monotonic() if now is None else now
+        self.queue_depth = queue_depth
+
+        # 一陣子沒有辨識就不再參考舊的 RTF，否則閒下來也升不回去
+        if self._last_sample and now - self._last_sample > self.rtf_stale_after:
+            self.rtf = 0.0
+            self._last_sample = 0.0
+
+        overloaded = queue_depth >= self.queue_high or self.rtf >= self.rtf_high
+        relaxed = queue_depth <= self.queue_low and self.rtf <= self.rtf_low
+
+        if overloaded:
+            self._relaxed_since = None
+            if self._pressure_since is None:
+                self._pressure_since = now
+            if now - self._pressure_since >= self.step_down_after:
+                self._step(+1)
+                self._pressure_since = now
+        elif relaxed:
+            self._pressure_since = None
+            if self._relaxed_since is None:
+                self._relaxed_since = now
+            if now - self._relaxed_since >= self.step_up_after:
+                self._step(-1)
+                self._relaxed_since = now
+        else:
+            self._pressure_since = None
+            self._relaxed_since = None
+
+        return self.level
+
+    def _step(self, direction: int) -> None:
+        index = min(max(self.level_index + direction, 0), len(self.levels) - 1)
+        if index == self.level_index:
+            return
+        previous = self.level.name
+        self.level_index = index
+        logger.warning(
+            f"Load level {previous} -> {self.level.name} "
+            f"(queue={self.queue_depth}, rtf={self.rtf:.2f})"
+        )
+
+    def get_status(self) -> dict:
+        return {
+            "level": self.level.name,
+            "level_index": self.level_index,
+            "queue_depth": self.queue_depth,
+            "rtf": round(self.rtf, 3),
+            "levels": [asdict(level) for level in self.levels],
+        }
+
+
+def load_controller_config(config_path: Optional[str] = None) -> LoadController:
+    """從設定檔載入降級等級與門檻，沒有設定檔就用預設值"""
+    if not config_path:
+        return LoadController()
+
+    with open(config_path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    levels = [ShedLevel(**level) for level in config.pop("levels", [])] or None
+    config = {k: v for k, v in config.items() if not k.startswith("_")}
+    return LoadController(levels=levels, **config)
@@ -0,0 +1,322 @@
+"""
+Load generator for AprilVoice
+Opens N concurrent /ws/transcribe connections, streams audio at real-time pace and
+reports chunk-to-transcript latency, missing transcripts and server CPU per level.
+Run: python loadtest.py --sessions 1 2 4 8 --duration 30 [--server-pid PID]
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import math
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+import websockets
+
+SAMPLE_RATE = 16000
+BYTES_PER_SECOND = SAMPLE_RATE * 2
+PCM_FRAME_SECONDS = 0.1  # 跟前端 AudioWorklet 一樣，每 100ms 送一個 frame
+
+
+@dataclass
+class ClientStats:
+    expected: int = 0  # 伺服器應該產生的 chunk (seq) 數
+    latencies: list[float] = field(default_factory=list)  # 秒
+    rejected: bool = False
+    errors: int = 0
+    late_sends: int = 0  # client 自己來不及照時間送 (負載產生器過載)
+
+
+# --- 音訊來源 ---
+
+def synthetic_pcm(seconds: float, seed: int = 0) -> bytes:
+    """像語音的合成音訊: 幾個會變動的音調加上雜訊，讓 VAD / 編碼器不會當成靜音"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    pitch = 160 + 40 * np.sin(2 * np.pi * 0.5 * t)
+    voice = np.sin(2 * np.pi * np.cumsum(pitch) / SAMPLE_RATE)
+    voice += 0.5 * np.sin(4 * np.pi * np.cumsum(pitch) / SAMPLE_RATE)
+    envelope = 0.5 + 0.5 * np.sin(2 * np.pi * 3 * t) ** 2
+    audio = 0.3 * voice * envelope + 0.02 * rng.standard_normal(len(t))
+    return (np.clip(audio, -1, 1) * 32767).astype(np.int16).tobytes()
+
+
+def load_pcm(path: str) -> bytes:
+    """任意音訊檔轉成 PCM 16-bit 16kHz mono (需要 ffmpeg)"""
+    from asr_service import decode_audio_file
+
+    fd, output_path = tempfile.mkstemp(suffix=".pcm")
+    os.close(fd)
+    try:
+        decode_audio_file(path, output_path)
+        with open(output_path, "rb") as f:
+            return f.read()
+    finally:
+        os.unlink(output_path)
+
+
+def encode_webm(pcm: bytes) -> bytes:
+    """PCM 編成獨立的 WebM/Opus 檔，跟 MediaRecorder 每次重啟送出的 chunk 一樣 (需要 ffmpeg)"""
+    result = subprocess.run(
+        [
+            'ffmpeg', '-y', '-hide_banner', '-loglevel', 'error',
+            '-f', 's16le', '-ar', str(SAMPLE_RATE), '-ac', '1', '-i', 'pipe:0',
+            '-c:a', 'libopus', '-b:a', '32k', '-f', 'webm', 'pipe:1'
+        ],
+        input=pcm,
+        capture_output=True,
+        timeout=30
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr.decode(errors='replace')}")
+    return result.stdout
+
+
+def build_schedule(pcm: bytes, audio_format: str, chunk_seconds: float) -> tuple[list[tuple[dict, list[int]]], float]:
+    """
+    切成要送出的訊息，回傳 ([(message, 這則訊息送完後完成的 seq)], 送出間隔)
+    pcm: 每 100ms 一個 frame，伺服器每 chunk_seconds 產生一個 seq
+    webm: 每 chunk_seconds 一個獨立 WebM 檔，一個檔就是一個 seq
+    """
+    chunk_bytes = int(chunk_seconds * BYTES_PER_SECOND)
+    chunk_bytes -= chunk_bytes % 2
+    schedule = []
+    if audio_format == "pcm":
+        frame_bytes = int(PCM_FRAME_SECONDS * BYTES_PER_SECOND)
+        sent = 0
+        for offset in range(0, len(pcm), frame_bytes):
+            frame = pcm[offset:offset + frame_bytes]
+            before = sent // chunk_bytes
+            sent += len(frame)
+            # 這個 frame 湊滿的 chunk；最後不滿一個 chunk 的部分伺服器閒置後會 flush (少於 0.1 秒丟掉)
+            completes = list(range(before, sent // chunk_bytes))
+            if offset + frame_bytes >= len(pcm) and sent % chunk_bytes >= BYTES_PER_SECOND // 10:
+                completes.append(sent // chunk_bytes)
+            message = {
+                "type": "audio",
+                "format": "pcm16",
+                "data": base64.b64encode(frame).decode("ascii"),
+            }
+            schedule.append((message, completes))
+        return schedule, PCM_FRAME_SECONDS
+
+    seq = 0
+    for offset in range(0, len(pcm), chunk_bytes):
+        webm = encode_webm(pcm[offset:offset + chunk_bytes])
+        if len(webm) <= 1000:  # 伺服器會忽略太小的 chunk
+            continue
+        message = {"type": "audio", "data": base64.b64encode(webm).decode("ascii")}
+        schedule.append((message, [seq]))
+        seq += 1
+    return schedule, chunk_seconds
+
+
+# --- 伺服器 CPU ---
+
+def _descendants(pid: int) -> list[int]:
+    pids = [pid]
+    for task in os.listdir(f"/proc/{pid}/task"):
+        try:
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children = f.read().split()
+        except OSError:
+            continue
+        for child in children:
+            pids.extend(_descendants(int(child)))
+    return pids
+
+
+def process_cpu_seconds(pid: int) -> float:
+    """pid 與所有子 process 用掉的 CPU 秒數 (serve.py 的 worker 也算進去)"""
+    total = 0
+    for child in _descendants(pid):
+        try:
+            with open(f"/proc/{child}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        total += int(fields[11]) + int(fields[12])  # utime + stime
+    return total / os.sysconf("SC_CLK_TCK")
+
+
+# --- client ---
+
+async def run_client(url: str, schedule: list, interval: float, start_delay: float,
+                     drain: float, stats: ClientStats) -> None:
+    sent_at: dict[int, float] = {}
+    received: set[int] = set()
+    stats.expected = sum(len(seqs) for _, seqs in schedule)
+    all_received = asyncio.Event()
+
+    async def receive(ws):
+        async for raw in ws:
+            message = json.loads(raw)
+            msg_type = message.get("type")
+            if msg_type == "transcript" and "seq" in message:
+                seq = message["seq"]
+                # merge 或 partial 可能讓同一個 seq 出現多次，只算第一次
+                if seq in sent_at and seq not in received:
+                    received.add(seq)
+                    stats.latencies.append(time.monotonic() - sent_at[seq])
+                    if len(received) == stats.expected:
+                        all_received.set()
+            elif msg_type == "error":
+                if message.get("code") in ("capacity", "draining"):
+                    stats.rejected = True
+                    all_received.set()
+                    return
+                stats.errors += 1
+
+    await asyncio.sleep(start_delay)
+    async with websockets.connect(url, max_size=None) as ws:
+        receiver = asyncio.create_task(receive(ws))
+        start = time.monotonic()
+        try:
+            for index, (message, seqs) in enumerate(schedule):
+                if stats.rejected:
+                    return
+                # 照絕對時間送，不會因為 send 的延遲越來越慢
+                delay = start + index * interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                elif delay < -interval:
+                    stats.late_sends += 1
+                try:
+                    await ws.send(json.dumps(message))
+                except websockets.ConnectionClosed:
+                    if stats.rejected:  # 被 admission control 拒絕，已經記錄過
+                        return
+                    raise
+                for seq in seqs:
+                    sent_at[seq] = time.monotonic()
+            try:
+                await asyncio.wait_for(all_received.wait(), drain)
+            except asyncio.TimeoutError:
+                pass
+        finally:
+            receiver.cancel()
+
+
+def _percentile(samples: list[float], q: float) -> float:
+    if not samples:
+        return float("nan")
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, max(0, math.ceil(q * len(samples)) - 1))]
+
+
+async def run_level(args, sessions: int, schedule: list, interval: float) -> dict:
+    clients = [ClientStats() for _ in range(sessions)]
+    cpu_start = process_cpu_seconds(args.server_pid) if args.server_pid else None
+    wall_start = time.monotonic()
+
+    # 錯開開始時間，避免所有 client 同一瞬間送 chunk
+    rng = random.Random(sessions)
+    results = await asyncio.gather(
+        *(run_client(args.url, schedule, interval, rng.uniform(0, args.chunk_seconds), args.drain, stats)
+          for stats in clients),
+        return_exceptions=True,
+    )
+
+    wall = time.monotonic() - wall_start
+    failed = [r for r in results if isinstance(r, Exception)]
+    latencies = [latency for stats in clients for latency in stats.latencies]
+    expected = sum(stats.expected for stats in clients if not stats.rejected)
+    report = {
+        "sessions": sessions,
+        "rejected": sum(stats.rejected for stats in clients) + len(failed),
+        "chunks": expected,
+        "missing": expected - len(latencies),
+        "errors": sum(stats.errors for stats in clients),
+        "late_sends": sum(stats.late_sends for stats in clients),
+        "p50": _percentile(latencies, 0.50),
+        "p95": _percentile(latencies, 0.95),
+        "p99": _percentile(latencies, 0.99),
+        "mean": statistics.fmean(latencies) if latencies else float("nan"),
+        "server_cpu": None,
+    }
+    if cpu_start is not None:
+        report["server_cpu"] = (process_cpu_seconds(args.server_pid) - cpu_start) / wall * 100
+    for error in failed:
+        print(f"  connection failed: {error}", file=sys.stderr)
+    report["ok"] = (
+        report["rejected"] == 0
+        and report["missing"] <= args.max_missing * max(expected, 1)
+        and report["p95"] <= args.max_p95
+    )
+    return report
+
+
+def _print_report(report: dict) -> None:
+    cpu = f"{report['server_cpu']:6.1f}%" if report["server_cpu"] is not None else "     -"
+    print(f"  {report['sessions']:>8}  {report['p50']:7.3f}s {report['p95']:7.3f}s {report['p99']:7.3f}s  "
+          f"{report['missing']:>4}/{report['chunks']:<5} {report['rejected']:>8}  {cpu}  "
+          f"{'ok' if report['ok'] else 'OVERLOADED'}")
+
+
+async def run(args) -> None:
+    if args.audio:
+        pcm = load_pcm(args.audio)
+        repeats = math.ceil(args.duration * BYTES_PER_SECOND / max(len(pcm), 1))
+        pcm = (pcm * repeats)[:int(args.duration * BYTES_PER_SECOND)]
+    else:
+        pcm = synthetic_pcm(args.duration)
+    pcm = pcm[:len(pcm) - len(pcm) % 2]
+    schedule, interval = build_schedule(pcm, args.format, args.chunk_seconds)
+
+    print(f"loadtest: {args.url}  format={args.format}  {len(pcm) / BYTES_PER_SECOND:.1f}s audio per session  "
+          f"max p95={args.max_p95}s")
+    print(f"  {'sessions':>8}  {'p50':>8} {'p95':>8} {'p99':>8}  {'missing':>10} {'rejected':>8}  {'cpu':>7}")
+    reports = []
+    capacity = 0
+    for sessions in args.sessions:
+        report = await run_level(args, sessions, schedule, interval)
+        reports.append(report)
+        _print_report(report)
+        if report["late_sends"]:
+            print(f"  warning: load generator fell behind {report['late_sends']} times, results are pessimistic")
+        if report["ok"]:
+            capacity = sessions
+        elif not args.keep_going:
+            break
+        await asyncio.sleep(args.pause)
+
+    print(f"capacity: {capacity} concurrent sessions (p95 <= {args.max_p95}s, no rejections)")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"capacity": capacity, "levels": reports}, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AprilVoice WebSocket load generator")
+    parser.add_argument("--url", default="ws://localhost:8000/ws/transcribe")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 2, 4, 8, 16],
+                        help="concurrent sessions per level, run in order")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of audio per session")
+    parser.add_argument("--format", choices=["pcm", "webm"], default="pcm",
+                        help="pcm = AudioWorklet frames, webm = one WebM file per chunk (needs ffmpeg)")
+    parser.add_argument("--audio", help="audio file to stream (looped); default is synthetic speech-like audio")
+    parser.add_argument("--chunk-seconds", type=float, default=1.5,
+                        help="must match the server's PCM_CHUNK_SECONDS / the frontend chunk length")
+    parser.add_argument("--server-pid", type=int, help="server process (and its workers) to measure CPU for")
+    parser.add_argument("--max-p95", type=float, default=2.0, help="p95 latency (s) a level must stay under")
+    parser.add_argument("--max-missing", type=float, default=0.01,
+                        help="fraction of chunks allowed without a transcript (dropped or merged)")
+    parser.add_argument("--drain", type=float, default=10, help="seconds to wait for late transcripts")
+    parser.add_argument("--pause", type=float, default=2, help="seconds between levels")
+    parser.add_argument("--keep-going", action="store_true", help="run all levels even after overload")
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
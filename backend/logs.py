@@ -0,0 +1,258 @@
+"""
+Logging for AprilVoice
+Records go through a bounded queue to one writer thread, so formatting and stream I/O
+never block the event loop or the inference workers (formatting still shares the GIL,
+so per-chunk DEBUG events should be sampled in production). Records carry structured fields
+(session, seq, stage timings) from a context variable; per-chunk events are DEBUG,
+sampled per session and rate limited, so their cost stays flat as connections grow.
+"""
+
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+# 目前這個 task 的欄位 (session、seq ...)；asyncio 的 task 與 scheduler 的工作都會帶著 context
+_fields: contextvars.ContextVar[dict] = contextvars.ContextVar("log_fields", default={})
+
+
+def bind(**fields) -> contextvars.Token:
+    """之後在這個 context (含它建立的 task 與送進 scheduler 的工作) 記錄的 log 都帶這些欄位"""
+    return _fields.set({**_fields.get(), **fields})
+
+
+@contextmanager
+def log_scope(**fields):
+    """只在這個 scope 裡帶這些欄位 (同一個 task 依序處理多個工作時用)"""
+    reset = bind(**fields)
+    try:
+        yield
+    finally:
+        _fields.reset(reset)
+
+
+class _ContextFilter(logging.Filter):
+    """在呼叫端的 thread 把 context 欄位與 extra={"fields": ...} 合併到 record.fields"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        context = _fields.get()
+        extra = getattr(record, "fields", None)
+        record.fields = {**context, **extra} if extra else context
+        return True
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """
+    佇列滿了就丟掉，不讓記錄 log 的 event loop / worker 等 I/O；丟掉的數量由 writer 補記一筆 warning
+    prepare 只合併 %-args 與例外，時間格式、欄位、JSON 都留給 writer thread
+    佇列用 SimpleQueue (C 實作，put 不用 lock 與 condition)，上限由 enqueue 自己檢查
+    """
+
+    def __init__(self, log_queue: queue.SimpleQueue, maxsize: int = 0):
+        super().__init__(log_queue)
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.listener: Optional[QueueListener] = None
+        self.addFilter(_ContextFilter())
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # root 只有這個 handler，直接改 record 不用先複製；沒有 %-args (ChunkEvents、f-string) 就不用合併
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        # 多個 thread 同時檢查時可能略超過上限，不影響
+        if self.maxsize and self.queue.qsize() >= self.maxsize:
+            self.dropped += 1
+            return
+        self.queue.put_nowait(record)
+
+    def close(self) -> None:
+        # logging.shutdown (結束時) 會呼叫：等 writer 把佇列寫完
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
+        super().close()
+
+
+class _Writer(logging.Handler):
+    """writer thread 上的 handler：補記丟掉的數量後交給真正輸出的 handler"""
+
+    def __init__(self, source: _DroppingQueueHandler, target: logging.Handler):
+        super().__init__()
+        self.source = source
+        self.target = target
+        self._reported = 0
+
+    def handle(self, record: logging.LogRecord) -> bool:
+        dropped = self.source.dropped
+        if dropped > self._reported:
+            warning = logging.LogRecord(
+                __name__, logging.WARNING, __file__, 0,
+                f"Log queue full, dropped {dropped - self._reported} records", None, None,
+            )
+            warning.fields = {}
+            self._reported = dropped
+            self.target.handle(warning)
+        return self.target.handle(record)
+
+
+class TextFormatter(logging.Formatter):
+    """原本的格式，欄位以 key=value 接在訊息後面"""
+
+    def __init__(self):
+        super().__init__("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        line = super().formatMessage(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{key}={value!r}" if isinstance(value, str) else f"{key}={value}"
+                                   for key, value in fields.items())
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """一行一個 JSON 物件，欄位放在最上層，方便 log 收集系統直接索引"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+_handler: Optional[_DroppingQueueHandler] = None
+_target: Optional[logging.Handler] = None
+
+
+def _start_listener() -> None:
+    _handler.queue = queue.SimpleQueue()
+    _handler.maxsize = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+    _handler.listener = QueueListener(_handler.queue, _Writer(_handler, _target))
+    _handler.listener.start()
+
+
+def _restart_after_fork() -> None:
+    """serve.py fork 出的 worker 沒有父 process 的 writer thread，換新的佇列重新啟動"""
+    if _handler is not None:
+        _handler.dropped = 0
+        _sampler._lock = threading.Lock()
+        _start_listener()
+
+
+def setup_logging() -> None:
+    """
+    root logger 改成經過佇列輸出，可以重複呼叫
+    LOG_LEVEL: INFO (預設) / DEBUG (含每個 chunk 的事件) ...，LOG_FORMAT: text (預設) / json
+    LOG_QUEUE_SIZE: 佇列最多幾筆，滿了就丟掉並補記數量
+    """
+    global _handler, _target
+    if _handler is not None:
+        return
+    _target = logging.StreamHandler(sys.stderr)
+    _target.setFormatter(JsonFormatter() if os.getenv("LOG_FORMAT", "text") == "json" else TextFormatter())
+    _handler = _DroppingQueueHandler(queue.SimpleQueue())
+    _start_listener()
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(_handler)
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    # run_asr 每次 asyncio.run 都會記一筆 "Using selector"，DEBUG 時也不要
+    logging.getLogger("asyncio").setLevel(max(root.level, logging.INFO))
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+class _Sampler:
+    """
+    每個 chunk 事件的抽樣與限速
+    以 session 抽樣 (同一個 session 的事件要嘛全記、要嘛全不記，追一個連線才完整)，
+    再用 token bucket 限制整個 process 每秒的事件數；被限速掉的數量記在下一筆事件的 suppressed
+    """
+
+    def __init__(self, sample: float, per_second: float):
+        self.sample = sample
+        self.per_second = per_second
+        self._tokens = per_second
+        self._last = time.monotonic()
+        self._suppressed = 0
+        self._lock = threading.Lock()
+
+    def sampled(self, session: Optional[str]) -> bool:
+        if self.sample >= 1.0:
+            return True
+        if session is None:
+            return random.random() < self.sample
+        digest = hashlib.blake2b(session.encode(), digest_size=4).digest()
+        return int.from_bytes(digest, "big") / 2 ** 32 < self.sample
+
+    def admit(self) -> tuple[bool, int]:
+        """(可以記錄, 之前被限速掉的數量)"""
+        if self.per_second <= 0:
+            return True, 0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.per_second, self._tokens + (now - self._last) * self.per_second)
+            self._last = now
+            if self._tokens < 1:
+                self._suppressed += 1
+                return False, 0
+            self._tokens -= 1
+            suppressed, self._suppressed = self._suppressed, 0
+            return True, suppressed
+
+
+# LOG_CHUNK_SAMPLE: 記錄每個 chunk 事件的 session 比例 (0-1)；LOG_CHUNK_RATE: 每秒最多幾筆 (0 = 不限)
+_sampler = _Sampler(
+    float(os.getenv("LOG_CHUNK_SAMPLE", "1.0")),
+    float(os.getenv("LOG_CHUNK_RATE", "50")),
+)
+
+
+class ChunkEvents:
+    """
+    音訊熱路徑上的事件 (每個 chunk 的辨識、解碼、結果)，DEBUG 等級
+    沒開 DEBUG、沒抽中或被限速時只花一次判斷，不組字串
+    直接建立 record，不經過 logger.debug 的 findCaller (逐層找呼叫端的檔名行號，格式裡沒有用到)
+    """
+
+    def __init__(self, name: str):
+        self.logger = logging.getLogger(name)
+
+    def event(self, message: str, **fields) -> None:
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        if not _sampler.sampled(_fields.get().get("session")):
+            return
+        admitted, suppressed = _sampler.admit()
+        if not admitted:
+            return
+        if suppressed:
+            fields["suppressed"] = suppressed
+        record = self.logger.makeRecord(
+            self.logger.name, logging.DEBUG, "(chunk event)", 0, message, None, None, extra={"fields": fields},
+        )
+        self.logger.handle(record)
@@ -7,25 +7,78 @@ import base64
 import json
 import logging
 import os
+import tempfile
+import time
 from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 from typing import Optional
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, File, HTTPException, UploadFile, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 
-from asr_service import create_asr_service, ASRService
-from cloud_asr import load_cloud_config, MultiProviderASRService
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+from asr_service import (
+    create_asr_service, decode_audio, default_onnx_model_dir, transcribe_streaming, ASRService,
+    FasterWhisperService, HybridASRService, OnnxWhisperService, TranscriptionResult, TranscriptSegment,
+    WebMStreamDecoder
 )
+from audio_frames import AudioFrame, FrameAssembler
+from cancellation import Cancelled, CancelToken, cancel_scope
+from batch_jobs import JobManager
+from cloud_asr import load_cloud_config, MultiProviderASRService
+from health import HealthThresholds, InferenceMonitor, check
+from load_control import LoadController, ShedLevel, load_controller_config
+from logs import ChunkEvents, bind, setup_logging
+from postprocess import get_post_processor
+from scheduler import InferenceScheduler, Priority
+from session_capture import open_capture
+from sessions import Session, SessionRegistry
+from startup import profile as startup_profile
+from tuning import active_tuning, run_autotune
+
+setup_logging()
 logger = logging.getLogger(__name__)
+# 每個 chunk 的事件 (DEBUG，抽樣 + 限速)
+chunk_log = ChunkEvents(__name__)
 
 asr_service: Optional[ASRService] = None
-executor = ThreadPoolExecutor(max_workers=2)
+# 同時辨識的數量；與每個模型的 cpu_threads 一起由 tuning.py 依這台機器決定
+# (ASR_AUTOTUNE=1 時在背景調校完再用 apply_tuning 換掉)
+EXECUTOR_WORKERS = active_tuning().workers
+job_manager: Optional[JobManager] = None
+# 背景載入 ASR 服務的 task (lifespan 啟動時建立)
+asr_init_task: Optional[asyncio.Task] = None
+# 模型載入失敗、改用 mock 時為 True (能回應但辨識結果是假的)
+_asr_fallback = False
+
+# /health/live 與 /health/ready 用的辨識紀錄與門檻
+inference_monitor = InferenceMonitor()
+health_thresholds = HealthThresholds.from_env()
+
+# hybrid 模式：多久沒收到音訊就把目前這句送去做 final
+HYBRID_IDLE_FLUSH_SECONDS = float(os.getenv("HYBRID_IDLE_FLUSH_SECONDS", "3.0"))
+
+# PCM 串流 (AudioWorklet)：累積多少秒辨識一次；多久沒有新 frame 就把剩下的送出去
+PCM_CHUNK_SECONDS = float(os.getenv("PCM_CHUNK_SECONDS", "1.5"))
+PCM_IDLE_FLUSH_SECONDS = float(os.getenv("PCM_IDLE_FLUSH_SECONDS", "0.5"))
+PCM_BYTES_PER_SECOND = 32000  # 16kHz * 2 bytes
+
+# 負載降級累積 chunk 時：多久沒有新 chunk (例如停止錄音) 就把累積到一半的送去辨識
+PENDING_FLUSH_SECONDS = float(os.getenv("PENDING_FLUSH_SECONDS", "3.0"))
+
+# 所有辨識都經過 scheduler 再進 executor：final > partial > batch，同一等級內各連線輪流 (deficit round robin)
+# 每輪給每個連線 SCHEDULER_QUANTUM 秒音訊的額度，預設一個 chunk
+SCHEDULER_QUANTUM = float(os.getenv("SCHEDULER_QUANTUM", str(PCM_CHUNK_SECONDS)))
+# executor 只交給 scheduler (不另外保留)，調校後換大小時只要換 scheduler 裡的這一個
+scheduler = InferenceScheduler(
+    ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS), workers=EXECUTOR_WORKERS, quantum=SCHEDULER_QUANTUM
+)
+EBML_MAGIC = b"\x1a\x45\xdf\xa3"
+
+# 負載降級 (LOAD_SHEDDING=1 或設定 LOAD_SHEDDING_CONFIG 時啟用)
+load_controller: Optional[LoadController] = None
+_shed_services: dict[str, ASRService] = {}  # 降級等級用的服務: 模型大小或 "cloud"
 
 
 def create_cloud_asr_service() -> Optional[ASRService]:
@@ -49,19 +102,207 @@ def create_cloud_asr_service() -> Optional[ASRService]:
         return None
 
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    global asr_service
-    logger.info("Starting AprilVoice Backend...")
+def create_hybrid_asr_service() -> ASRService:
+    """
+    hybrid: 本地小模型出 partial，整句再交給雲端 (或本地大模型) 出 final
+    HYBRID_FAST_MODEL: partial 用的模型 (預設 tiny)
+    HYBRID_FINAL: cloud 或模型大小 (預設 cloud，沒有雲端設定時用 small)
+    本地模型依 ASR_ENGINE 選擇引擎；onnx 的 final 會用每個 chunk 進來時就算好的 log-mel
+    """
+    fast = create_asr_service(model_size=os.getenv("HYBRID_FAST_MODEL", "tiny"))
+    final_choice = os.getenv("HYBRID_FINAL", "cloud")
+
+    final = None
+    if final_choice == "cloud":
+        final = create_cloud_asr_service()
+        if final is None:
+            logger.warning("Cloud ASR not available, hybrid final pass uses local small model")
+            final_choice = "small"
+
+    if final is None:
+        final = create_asr_service(model_size=final_choice)
+
+    logger.info(f"Hybrid ASR: fast={fast.model_size}, final={type(final).__name__}")
+    return HybridASRService(fast, final)
+
+
+def shed_model(model_size: str) -> ASRService:
+    """降級等級用的較小本地模型，引擎與目前的服務相同"""
+    if isinstance(asr_service, OnnxWhisperService):
+        # ONNX_MODEL_DIR 指向的是主要模型，小模型用 export_onnx.py 的預設目錄
+        return OnnxWhisperService(model_size=model_size, model_dir=default_onnx_model_dir(model_size))
+    return FasterWhisperService(model_size=model_size)
+
+
+async def setup_load_shedding() -> None:
+    """
+    預先載入各降級等級要用的模型 (同時載入)，不要等到 CPU 滿載才載入
+    換模型 / beam size / 雲端只對本地引擎有效 (beam size 只有 faster-whisper)；
+    做不到的等級不列入，免得 controller 與 log 顯示沒有作用的降級
+    """
+    local = isinstance(asr_service, (FasterWhisperService, OnnxWhisperService))
+    candidates = []
+    pending: dict[str, ASRService] = {}
+    for level in load_controller.levels:
+        unsupported = [
+            field for field, value, supported in (
+                ("use_cloud", level.use_cloud, local),
+                ("model_size", level.model_size, local),
+                ("beam_size", level.beam_size, isinstance(asr_service, FasterWhisperService)),
+            ) if value and not supported
+        ]
+        if unsupported:
+            logger.warning(
+                f"Load level {level.name} skipped: {', '.join(unsupported)} "
+                f"has no effect with {type(asr_service).__name__}"
+            )
+            continue
+        if level.use_cloud:
+            if "cloud" not in _shed_services and "cloud" not in pending:
+                cloud = create_cloud_asr_service()
+                if cloud is None:
+                    logger.warning(f"Load level {level.name} needs cloud ASR, skipping")
+                    continue
+                pending["cloud"] = cloud
+        elif level.model_size:
+            if level.model_size != asr_service.model_size and level.model_size not in _shed_services:
+                pending.setdefault(level.model_size, shed_model(level.model_size))
+        candidates.append(level)
+
+    # 載入失敗 (例如小的 ONNX 模型還沒匯出) 只去掉用到它的等級
+    names = list(pending)
+    results = await asyncio.gather(*(pending[name].initialize() for name in names), return_exceptions=True)
+    failed = set()
+    for name, result in zip(names, results):
+        if isinstance(result, Exception):
+            logger.warning(f"Load shedding service {name} failed to load: {result}")
+            failed.add(name)
+        else:
+            _shed_services[name] = pending[name]
+
+    usable = [
+        level for level in candidates
+        if ("cloud" if level.use_cloud else level.model_size) not in failed
+    ]
+    load_controller.levels = usable or [ShedLevel("normal")]
+    logger.info(f"Load shedding levels: {[level.name for level in usable]}")
+
+
+async def monitor_load() -> None:
+    """每秒依排隊深度更新降級等級"""
+    try:
+        await wait_for_asr()
+    except Exception:
+        return  # 載入失敗已經記錄過
+    if load_controller is None:
+        return
+    while True:
+        await asyncio.sleep(1.0)
+        load_controller.update(scheduler.interactive_inflight)
+
+
+def current_load_level() -> Optional[ShedLevel]:
+    return load_controller.level if load_controller else None
+
+
+def select_asr_service(level: Optional[ShedLevel]) -> Optional[ASRService]:
+    """本地模式依降級等級換模型 / beam size / 雲端，其他模式不變"""
+    if level is None or not isinstance(asr_service, (FasterWhisperService, OnnxWhisperService)):
+        return asr_service
+
+    if level.use_cloud and "cloud" in _shed_services:
+        return _shed_services["cloud"]
+
+    service = _shed_services.get(level.model_size, asr_service) if level.model_size else asr_service
+    if level.beam_size and isinstance(service, FasterWhisperService) and level.beam_size != service.beam_size:
+        service = service.with_beam_size(level.beam_size)
+    return service
+
+
+def run_asr(
+    make_coro, session: Optional[Session] = None, token: Optional[CancelToken] = None
+) -> TranscriptionResult:
+    """
+    在 worker thread 執行一次辨識，順便記錄 real-time factor 與連線用掉的辨識時間
+    token 已經取消 (連線中斷或 reset) 就不開始；執行中 decoder 與模型會在段落之間檢查
+    """
+    if token:
+        token.raise_if_cancelled()
+    job_id = inference_monitor.start()
+    start = time.perf_counter()
+    result = None
+    try:
+        with cancel_scope(token):
+            result = asyncio.run(make_coro())
+    finally:
+        elapsed = time.perf_counter() - start
+        inference_monitor.finish(job_id, result.duration if result else 0.0, elapsed)
+    if load_controller:
+        load_controller.record_inference(result.duration, elapsed)
+    if session:
+        session.record_inference(elapsed)
+    chunk_log.event(
+        "inference", audio_s=round(result.duration, 2), infer_ms=round(elapsed * 1000, 1),
+        rtf=round(elapsed / result.duration, 3) if result.duration else None,
+    )
+    return result
+
+
+def run_asr_decode(audio_chunk: bytes, token: Optional[CancelToken] = None) -> bytes:
+    """在 worker thread 解碼 WebM chunk，token 取消時中止 ffmpeg"""
+    if token:
+        token.raise_if_cancelled()
+    with cancel_scope(token):
+        return decode_audio(audio_chunk)
+
+
+def apply_tuning(tuning) -> None:
+    """
+    背景調校完成後改用調校出的 worker 數 (import 時用的是預設值或舊的調校結果)
+    所有辨識 (即時與 batch) 都經過 scheduler，換掉 scheduler 的 executor 就不會有人送進已關閉的舊 pool
+    """
+    global EXECUTOR_WORKERS
+    if tuning.workers == EXECUTOR_WORKERS:
+        return
+    EXECUTOR_WORKERS = tuning.workers
+    scheduler.resize(ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS), EXECUTOR_WORKERS)
+    if "SESSION_CAPACITY" not in os.environ:
+        sessions.capacity = EXECUTOR_WORKERS * 0.9
+    logger.info(f"Inference workers: {EXECUTOR_WORKERS}")
+
+
+async def init_asr_service() -> None:
+    """
+    依環境變數建立並初始化 ASR 服務 (含負載降級要用的模型)
+    雲端的次要提供商在背景初始化
+    ASR_AUTOTUNE=1 且還沒有調校結果時先調校 (模型用調校出的設定載入)
+    """
+    global asr_service, _current_mode, load_controller, _asr_fallback
+
+    if os.getenv("ASR_AUTOTUNE", "0") == "1":
+        try:
+            with startup_profile.phase("autotune"):
+                tuning = await asyncio.to_thread(run_autotune)
+        except Exception as e:
+            logger.error(f"Autotune failed, using default CPU settings: {e}")
+            tuning = None
+        if tuning:
+            apply_tuning(tuning)
 
     # ASR 模式優先順序:
-    # 1. USE_CLOUD_ASR=1 -> 使用雲端 API
-    # 2. USE_MOCK_ASR=1 -> 使用假的 ASR (開發用)
-    # 3. 預設 -> 使用本地 faster-whisper
+    # 1. USE_HYBRID_ASR=1 -> 本地 partial + 雲端/大模型 final
+    # 2. USE_CLOUD_ASR=1 -> 使用雲端 API
+    # 3. USE_MOCK_ASR=1 -> 使用假的 ASR (開發用)
+    # 4. 預設 -> 使用本地 faster-whisper
 
-    use_cloud = os.getenv("USE_CLOUD_ASR", "0") == "1"
+    use_hybrid = os.getenv("USE_HYBRID_ASR", "0") == "1"
+    use_cloud = os.getenv("USE_CLOUD_ASR", "0") == "1" and not use_hybrid
     use_mock = os.getenv("USE_MOCK_ASR", "0") == "1"
 
+    if use_hybrid:
+        logger.info("Hybrid ASR mode enabled")
+        asr_service = create_hybrid_asr_service()
+
     if use_cloud:
         logger.info("Cloud ASR mode enabled")
         asr_service = create_cloud_asr_service()
@@ -69,12 +310,13 @@ async def lifespan(app: FastAPI):
             logger.warning("Cloud ASR not available, falling back to local")
             use_cloud = False
 
-    if not use_cloud:
+    if not use_cloud and not use_hybrid:
         asr_service = create_asr_service(use_mock=use_mock)
 
     try:
         await asr_service.initialize()
-        mode = "cloud" if use_cloud else ("mock" if use_mock else "local")
+        mode = "hybrid" if use_hybrid else ("cloud" if use_cloud else ("mock" if use_mock else "local"))
+        _current_mode = mode
         logger.info(f"ASR service initialized (mode: {mode})")
     except Exception as e:
         logger.error(f"Failed to initialize ASR: {e}")
@@ -82,10 +324,57 @@ async def lifespan(app: FastAPI):
             logger.info("Falling back to mock ASR")
             asr_service = create_asr_service(use_mock=True)
             await asr_service.initialize()
+            _current_mode = "mock"
+            _asr_fallback = True
+
+    shed_config = os.getenv("LOAD_SHEDDING_CONFIG")
+    if os.getenv("LOAD_SHEDDING", "0") == "1" or shed_config:
+        load_controller = load_controller_config(shed_config)
+        await setup_load_shedding()
+
+    startup_profile.mark("asr ready")
+
+
+async def wait_for_asr() -> None:
+    """ASR 服務還在背景載入就等它完成；載入失敗時丟出原本的例外"""
+    if asr_init_task is not None and not asr_init_task.done():
+        await asyncio.shield(asr_init_task)
+    elif asr_init_task is not None and not asr_init_task.cancelled() and asr_init_task.exception():
+        raise asr_init_task.exception()
+
+
+def _asr_init_done(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"ASR initialization failed: {task.exception()}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global job_manager, asr_init_task
+    logger.info("Starting AprilVoice Backend...")
+
+    # uvicorn 要等 lifespan 啟動完才開始接受連線：模型與雲端提供商改在背景載入，port 先開
+    # 載入完成前 /health/live 正常回應、/health/ready 回 503，已經連上的 WebSocket 等載入完成
+    asr_init_task = asyncio.create_task(init_asr_service())
+    asr_init_task.add_done_callback(_asr_init_done)
+
+    job_manager = JobManager(
+        get_service=lambda: asr_service,
+        scheduler=scheduler,
+        concurrent_jobs=int(os.getenv("BATCH_CONCURRENT_JOBS", "1")),
+    )
+    job_manager.start()
+
+    monitor_task = asyncio.create_task(monitor_load())
+    startup_profile.mark("accepting connections")
 
     yield
 
     logger.info("Shutting down...")
+    monitor_task.cancel()
+    if asr_init_task and not asr_init_task.done():
+        asr_init_task.cancel()
+    await job_manager.stop()
 
 
 app = FastAPI(
@@ -108,17 +397,127 @@ class HealthResponse(BaseModel):
     status: str
     service: str
     asr_ready: bool
+    ready: bool
+    load_level: Optional[str] = None
+
+
+def cloud_services() -> list[tuple[str, MultiProviderASRService, bool]]:
+    """目前用到的雲端服務: (用途, 服務, 是否為主要辨識來源)"""
+    services = []
+    if isinstance(asr_service, MultiProviderASRService):
+        services.append(("primary", asr_service, True))
+    if isinstance(asr_service, HybridASRService) and isinstance(asr_service.final, MultiProviderASRService):
+        services.append(("hybrid-final", asr_service.final, True))
+    shed_cloud = _shed_services.get("cloud")
+    if isinstance(shed_cloud, MultiProviderASRService):
+        services.append(("load-shedding", shed_cloud, False))
+    return services
+
+
+def readiness_report() -> dict:
+    """
+    各項 readiness 檢查；任何一項不通過就不該再分配新的連線過來
+    model: 模型載入完成 (不是載入失敗改用的 mock)
+    queue: 排隊等 worker 的即時辨識數 (不含 batch)
+    rtf: 最近的辨識速度，接近 1 表示快跟不上即時
+    sessions: 連線用量 / 容量，以及是否正在關閉
+    cloud: 雲端是主要辨識來源時，可用的提供商數量
+    """
+    limits = health_thresholds
+    queued = scheduler.waiting(Priority.FINAL, Priority.PARTIAL)
+    rtf = inference_monitor.recent_rtf(limits.rtf_stale_after)
+
+    checks = {
+        "model": check(
+            asr_service is not None and asr_service.ready and not _asr_fallback,
+            mode=_current_mode,
+            fallback=_asr_fallback,
+            loading=asr_init_task is not None and not asr_init_task.done(),
+        ),
+        "queue": check(queued <= limits.max_queue, value=queued, limit=limits.max_queue),
+        "rtf": check(
+            rtf is None or rtf <= limits.max_rtf,
+            value=round(rtf, 3) if rtf is not None else None,
+            limit=limits.max_rtf,
+        ),
+        "sessions": check(
+            not sessions.draining and sessions.load <= limits.max_load * sessions.capacity,
+            load=round(sessions.load, 3),
+            limit=round(limits.max_load * sessions.capacity, 3),
+            draining=sessions.draining,
+        ),
+    }
+    for role, service, required in cloud_services():
+        available = service.available_providers()
+        checks[f"cloud:{role}"] = check(
+            not required or len(available) >= limits.min_cloud_providers,
+            available=available,
+            limit=limits.min_cloud_providers if required else 0,
+        )
+
+    return {
+        "ready": all(item["ok"] for item in checks.values()),
+        "checks": checks,
+    }
 
 
 @app.get("/health", response_model=HealthResponse)
 async def health_check():
+    level = current_load_level()
     return HealthResponse(
         status="healthy",
         service="AprilVoice API",
-        asr_ready=asr_service is not None
+        asr_ready=asr_service is not None and asr_service.ready,
+        ready=readiness_report()["ready"],
+        load_level=level.name if level else None
+    )
+
+
+@app.get("/health/live")
+async def liveness():
+    """
+    process 還在運作: event loop 回應得了，而且沒有卡住的辨識
+    失敗時應該重啟這個 process
+    """
+    longest = inference_monitor.longest_running()
+    # 背景載入失敗 (例如設定錯誤) 時 process 永遠不會 ready，讓 orchestrator 重啟
+    init_failed = (
+        asr_init_task is not None and asr_init_task.done()
+        and not asr_init_task.cancelled() and asr_init_task.exception() is not None
+    )
+    alive = longest <= health_thresholds.max_inference_seconds and not init_failed
+    return JSONResponse(
+        {
+            "alive": alive,
+            "longest_inference": round(longest, 1),
+            "limit": health_thresholds.max_inference_seconds,
+            "init_failed": init_failed,
+        },
+        status_code=200 if alive else 503,
     )
 
 
+@app.get("/health/ready")
+async def readiness():
+    """可以接受新連線；503 時 load balancer 應該把新連線導到其他節點 (既有連線不受影響)"""
+    report = readiness_report()
+    return JSONResponse(report, status_code=200 if report["ready"] else 503)
+
+
+@app.get("/startup")
+async def startup_status():
+    """啟動里程碑 (process 啟動後幾秒) 與各 import / 模型 / 雲端提供商的載入耗時"""
+    return {"loading": asr_init_task is not None and not asr_init_task.done(), **startup_profile.get_status()}
+
+
+@app.get("/load/status")
+async def load_status():
+    """查看負載降級狀態"""
+    if load_controller is None:
+        return {"enabled": False}
+    return {"enabled": True, **load_controller.get_status()}
+
+
 @app.get("/")
 async def root():
     return {
@@ -127,7 +526,11 @@ async def root():
         "endpoints": {
             "health": "/health",
             "websocket": "/ws/transcribe",
-            "cloud_status": "/cloud/status"
+            "cloud_status": "/cloud/status",
+            "postprocess_stats": "/postprocess/stats",
+            "jobs": "/jobs",
+            "sessions": "/sessions",
+            "startup": "/startup"
         }
     }
 
@@ -138,12 +541,14 @@ async def cloud_status():
     if asr_service is None:
         return {"error": "ASR service not initialized"}
 
-    if isinstance(asr_service, MultiProviderASRService):
+    cloud = asr_service.final if isinstance(asr_service, HybridASRService) else asr_service
+
+    if isinstance(cloud, MultiProviderASRService):
         return {
-            "mode": "cloud",
-            "providers": asr_service.get_status(),
-            "current_provider": asr_service.provider_order[asr_service.current_provider_index][1]
-            if asr_service.provider_order else None
+            "mode": _current_mode,
+            "providers": cloud.get_status(),
+            "current_provider": cloud.provider_order[cloud.current_provider_index][1]
+            if cloud.provider_order else None
         }
     else:
         return {
@@ -152,9 +557,50 @@ async def cloud_status():
         }
 
 
+@app.get("/postprocess/stats")
+async def postprocess_stats():
+    """查看後處理規則命中次數"""
+    return get_post_processor().get_stats()
+
+
+@app.post("/jobs")
+async def create_job(file: UploadFile = File(...)):
+    """上傳錄音檔做批次辨識，回傳 job id"""
+    if job_manager is None:
+        raise HTTPException(status_code=503, detail="Job manager not ready")
+    if asr_service is None:
+        raise HTTPException(status_code=503, detail="ASR service is still loading, please retry later")
+
+    # 分塊寫到暫存檔，長錄音不整個讀進記憶體
+    suffix = os.path.splitext(file.filename or "")[1] or ".bin"
+    size = 0
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+        while chunk := await file.read(1024 * 1024):
+            f.write(chunk)
+            size += len(chunk)
+        audio_path = f.name
+
+    if not size:
+        os.unlink(audio_path)
+        raise HTTPException(status_code=400, detail="Empty file")
+
+    job = job_manager.submit(audio_path, filename=file.filename or "")
+    return {"job_id": job.id, "status": job.status}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """查看批次辨識狀態，完成時包含各段時間戳記與文字"""
+    job = job_manager.get(job_id) if job_manager else None
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+
 # 儲存兩種服務實例
 _local_asr: Optional[ASRService] = None
 _cloud_asr: Optional[ASRService] = None
+_hybrid_asr: Optional[ASRService] = None
 _current_mode: str = "local"
 
 
@@ -166,13 +612,22 @@ async def get_asr_mode():
 
 @app.post("/asr/mode/{mode}")
 async def set_asr_mode(mode: str):
-    """切換 ASR 模式: local 或 cloud"""
-    global asr_service, _local_asr, _cloud_asr, _current_mode
+    """切換 ASR 模式: local、cloud 或 hybrid"""
+    global asr_service, _local_asr, _cloud_asr, _hybrid_asr, _current_mode, _asr_fallback
+
+    if mode not in ["local", "cloud", "hybrid"]:
+        return {"error": "Invalid mode. Use 'local', 'cloud' or 'hybrid'"}
 
-    if mode not in ["local", "cloud"]:
-        return {"error": "Invalid mode. Use 'local' or 'cloud'"}
+    if mode == "hybrid":
+        if _hybrid_asr is None:
+            _hybrid_asr = create_hybrid_asr_service()
+            await _hybrid_asr.initialize()
 
-    if mode == "cloud":
+        asr_service = _hybrid_asr
+        _current_mode = "hybrid"
+        logger.info("Switched to hybrid ASR")
+
+    elif mode == "cloud":
         if _cloud_asr is None:
             _cloud_asr = create_cloud_asr_service()
             if _cloud_asr:
@@ -194,63 +649,403 @@ async def set_asr_mode(mode: str):
         _current_mode = "local"
         logger.info("Switched to local ASR")
 
+    _asr_fallback = False
     return {"mode": _current_mode, "success": True}
 
 
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: list[WebSocket] = []
+# 每秒可用的辨識秒數 (預設約等於 worker 數)，超過就拒絕新連線
+SESSION_CAPACITY = float(os.getenv("SESSION_CAPACITY", str(EXECUTOR_WORKERS * 0.9)))
+# 還沒有任何連線量到實際用量時，預估新連線每秒會用掉幾秒辨識時間 (RTF × 送音訊的時間比例)
+# 之後改用已經量到的連線平均；預設對應 CPU 上 small 模型 RTF 約 0.15、持續錄音
+SESSION_COST_ESTIMATE = float(os.getenv("SESSION_COST_ESTIMATE", "0.15"))
+
+sessions = SessionRegistry(capacity=SESSION_CAPACITY, cost_estimate=SESSION_COST_ESTIMATE)
 
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
-        logger.info(f"Client connected. Total: {len(self.active_connections)}")
 
-    def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
-        logger.info(f"Client disconnected. Total: {len(self.active_connections)}")
+@app.get("/sessions")
+async def sessions_status():
+    """查看目前連線與容量使用狀況"""
+    return sessions.get_status()
 
 
-manager = ConnectionManager()
+@app.get("/scheduler/status")
+async def scheduler_status():
+    """各優先等級排隊中 / 執行中的辨識數與最近的排隊時間，以及每個連線 (batch job) 排隊中的工作數"""
+    return scheduler.get_status()
 
 
 @app.websocket("/ws/transcribe")
 async def websocket_transcribe(websocket: WebSocket):
-    await manager.connect(websocket)
-    is_connected = True
+    session = await sessions.open(websocket)
+    if session is None:
+        return
+    # 這個連線 (含它建立的 task 與 scheduler 的工作) 的 log 都帶 session id
+    bind(session=session.id)
+    if asr_init_task is not None and not asr_init_task.done():
+        # 剛啟動、模型還在載入：先告訴前端，載入完再開始處理 (送來的音訊留在 WebSocket 的 buffer)
+        session.send({"type": "status", "message": "Loading model"})
+    try:
+        await wait_for_asr()
+    except Exception:
+        sessions.close(session)
+        try:
+            await websocket.send_json({"type": "error", "message": "ASR service failed to start"})
+            await websocket.close(code=1011)
+        except Exception:
+            pass
+        return
+    session.capture = open_capture(session.id, {
+        "mode": _current_mode,
+        "pcm_chunk_seconds": PCM_CHUNK_SECONDS,
+        "pcm_idle_flush_seconds": PCM_IDLE_FLUSH_SECONDS,
+    })
+
+    hybrid = asr_service.new_session() if isinstance(asr_service, HybridASRService) else None
+    idle_flush_task: Optional[asyncio.Task] = None
+    pending_pcm: list[bytes] = []  # 降級時累積的 chunk
+    pending_flush_timer: Optional[asyncio.TimerHandle] = None
+    # PCM 串流收到、還沒送去辨識的音訊，直接寫進預先配置的 buffer
+    pcm_frames = FrameAssembler(int(PCM_CHUNK_SECONDS * PCM_BYTES_PER_SECOND))
+    pcm_flush_timer: Optional[asyncio.TimerHandle] = None
+    stream_decoder: Optional[WebMStreamDecoder] = None  # 連續 MediaRecorder 串流
+    stream_lock = asyncio.Lock()  # 串流解碼有狀態，必須依序執行
+    # hybrid: 等待 fast 模型的 chunk (seq, WebM chunk, PCM frame)，拿到 lock 的 task 一次處理全部
+    hybrid_inbox: list[tuple[int, Optional[bytes], Optional[AudioFrame]]] = []
+    jobs: set[asyncio.Task] = set()  # 進行中的辨識 task，reset / 斷線時取消
+    streamed_seqs: set[int] = set()  # 已經送出段落的 seq，最後的結果是空的也要送，讓前端清掉段落
+    main_loop = asyncio.get_running_loop()
+
+    def start_job(coro) -> None:
+        task = asyncio.create_task(coro)
+        jobs.add(task)
+        task.add_done_callback(jobs.discard)
+
+    def schedule(fn, *args, priority: Priority = Priority.FINAL, cost: float = PCM_CHUNK_SECONDS, frames=()):
+        """
+        這個連線的辨識工作交給 scheduler 排隊，跟其他連線輪流使用 worker
+        cost 是音訊秒數 (WebM 解碼前不知道長度，用一個 chunk 估計)；解碼這類小工作傳 0
+        frames: 工作會讀的 AudioFrame，executor 真的跑完才歸還 (等結果的 task 被取消時工作可能還在讀)
+        """
+        retained = list(frames)
+        for frame in retained:
+            frame.retain()
+        return scheduler.run(
+            fn, *args, priority=priority, flow=session.id, cost=cost,
+            on_done=(lambda: release_frames(retained)) if retained else None,
+        )
+
+    def release_frames(frames: list[AudioFrame]) -> None:
+        """歸還並清空 frames，同一個 list 再呼叫一次不會重複歸還"""
+        while frames:
+            frames.pop().release()
+
+    def job_cancelled(what: str) -> None:
+        logger.info(f"{what} cancelled")
+
+    def cancel_jobs() -> None:
+        """
+        取消這個連線所有的辨識工作：還在排隊的 executor 工作直接移除，
+        已經在跑的由 token 在下一個段落邊界停下來
+        """
+        nonlocal idle_flush_task, pcm_flush_timer, pending_flush_timer
+        session.reset_token()
+        session.cancelled_jobs += len(jobs)
+        for task in list(jobs):
+            task.cancel()
+        if idle_flush_task:
+            idle_flush_task.cancel()
+            idle_flush_task = None
+        if pcm_flush_timer:
+            pcm_flush_timer.cancel()
+            pcm_flush_timer = None
+        if pending_flush_timer:
+            pending_flush_timer.cancel()
+            pending_flush_timer = None
+        pcm_frames.clear()
+        pending_pcm.clear()
+        # 還在 inbox 的 frame 沒有 task 取走，也還沒送進 executor，由這裡歸還
+        release_frames([frame for _, _, frame in hybrid_inbox if frame])
+        hybrid_inbox.clear()
+
+    def send_result(result, seq: Optional[int] = None) -> None:
+        """
+        有 seq 的結果經過 reorder buffer，依 chunk 順序送出
+        hybrid 的 final 用 utterance_id 取代 partial，不需要排序，直接送
+        """
+        message = {
+            "type": "transcript",
+            "text": result.text,
+            "is_final": result.is_final
+        }
+        if seq is not None:
+            message["seq"] = seq
+        if result.utterance_id is not None:
+            message["utterance_id"] = result.utterance_id
+        level = current_load_level()
+        if level:
+            message["load_level"] = level.name
+        if seq is None:
+            session.send(message)
+        else:
+            session.reorder.complete(seq, message)
 
-    async def process_audio(audio_chunk: bytes):
-        """在背景處理音訊辨識"""
-        nonlocal is_connected
-        if not asr_service or not is_connected:
+    def send_segment(seq: int, segment: TranscriptSegment) -> None:
+        """辨識途中解出的段落，輪到這個 seq 就先送出；之後同一個 seq 的 transcript 會取代它"""
+        if not session.is_connected or seq < session.reorder.next_seq:
             return
-
+        streamed_seqs.add(seq)
+        session.reorder.stream(seq, {
+            "type": "segment",
+            "seq": seq,
+            "text": segment.text,
+            "start": round(segment.start, 2),
+            "end": round(segment.end, 2),
+        })
+
+    def transcribe_job(service: ASRService, seq: int, audio_chunk, pcm_data=None):
+        """
+        要在 worker thread 執行的辨識 (給 run_asr)
+        支援的服務 (本地 faster-whisper) 邊解碼邊把段落交回 event loop 送出，不等整段做完
+        """
+        if service.streams_segments:
+            def on_segment(segment: TranscriptSegment) -> None:
+                main_loop.call_soon_threadsafe(send_segment, seq, segment)
+            if pcm_data is None:
+                pcm_data = decode_audio(audio_chunk)
+            return transcribe_streaming(service, pcm_data, on_segment)
+        if pcm_data is not None:
+            return service.transcribe_pcm(pcm_data)
+        return service.transcribe(audio_chunk)
+
+    def flush_pending() -> None:
+        """降級時累積到一半的 chunk 不再等湊滿，拿一個新的 seq 送去辨識 (結果一樣依 seq 順序送出)"""
+        nonlocal pending_flush_timer
+        pending_flush_timer = None
+        if pending_pcm and session.is_connected:
+            start_job(process_audio(session.reorder.reserve(), None, flush=True))
+
+    def schedule_pending_flush() -> None:
+        nonlocal pending_flush_timer
+        if pending_flush_timer:
+            pending_flush_timer.cancel()
+        pending_flush_timer = main_loop.call_later(PENDING_FLUSH_SECONDS, flush_pending)
+
+    async def process_audio(
+        seq: int, audio_chunk: Optional[bytes], frame: Optional[AudioFrame] = None, flush: bool = False,
+    ):
+        """
+        在背景處理音訊辨識；有 frame 表示已經是 PCM 16-bit 16kHz，不用 ffmpeg 解碼
+        flush: 降級累積的 chunk 不等湊滿，連同這個 chunk 一起辨識 (audio_chunk 與 frame 都是 None 時只送累積的)
+        """
+        nonlocal pending_flush_timer
+        token = session.token
+        bind(seq=seq)
+        started = time.perf_counter()
         try:
-            logger.info(f"Transcribing {len(audio_chunk)} bytes...")
-            # 在線程池中執行同步的辨識操作
-            loop = asyncio.get_event_loop()
-            result = await loop.run_in_executor(
-                executor,
-                lambda: asyncio.run(asr_service.transcribe(audio_chunk))
-            )
-            logger.info(f"Transcription result: '{result.text}' (final={result.is_final})")
-            logger.info(f"is_connected={is_connected}, text_bool={bool(result.text)}")
-
-            if result.text and is_connected:
-                try:
-                    await websocket.send_json({
-                        "type": "transcript",
-                        "text": result.text,
-                        "is_final": result.is_final
-                    })
-                    logger.info(f"Sent transcript to client: {result.text}")
-                except Exception as send_err:
-                    logger.error(f"Failed to send: {send_err}")
+            if not asr_service or not session.is_connected:
+                return
+            is_pcm = frame is not None
+            if is_pcm:
+                audio_chunk = frame.data
+            if audio_chunk is not None:
+                chunk_log.event("transcribing", bytes=len(audio_chunk), format="pcm16" if is_pcm else "webm")
+            level = current_load_level()
+            service = select_asr_service(level)
+            accumulate = level.accumulate_chunks if level else 1
+            # 經過 scheduler 在線程池中執行同步的辨識操作
+            if accumulate > 1 or pending_pcm or audio_chunk is None:
+                # 降級時累積多個 chunk 一起辨識，減少辨識次數；等級升回來後第一個 chunk 會帶走累積的部分
+                if is_pcm:
+                    pending_pcm.append(bytes(audio_chunk))
+                elif audio_chunk is not None:
+                    pending_pcm.append(await schedule(run_asr_decode, audio_chunk, token, cost=0.0))
+                if not pending_pcm:
+                    return
+                if len(pending_pcm) < accumulate and not flush:
+                    # 停止錄音後不會再有 chunk 來湊滿，一段時間沒有新的就直接送
+                    schedule_pending_flush()
+                    return
+                if pending_flush_timer:
+                    pending_flush_timer.cancel()
+                    pending_flush_timer = None
+                pcm_data = b"".join(pending_pcm)
+                pending_pcm.clear()
+                result = await schedule(
+                    run_asr, lambda: transcribe_job(service, seq, None, pcm_data), session, token,
+                    cost=len(pcm_data) / PCM_BYTES_PER_SECOND,
+                )
+            elif is_pcm:
+                result = await schedule(
+                    run_asr, lambda: transcribe_job(service, seq, None, audio_chunk), session, token,
+                    cost=len(audio_chunk) / PCM_BYTES_PER_SECOND, frames=(frame,),
+                )
             else:
-                logger.warning(f"Skipped sending: text={bool(result.text)}, connected={is_connected}")
+                result = await schedule(run_asr, lambda: transcribe_job(service, seq, audio_chunk), session, token)
+            sent = bool(result.text or seq in streamed_seqs) and session.is_connected
+            if sent:
+                send_result(result, seq)
+            chunk_log.event(
+                "transcribed", text=result.text, final=result.is_final, sent=sent,
+                total_ms=round((time.perf_counter() - started) * 1000, 1),
+            )
+        except Cancelled:
+            job_cancelled(f"chunk #{seq}")
         except Exception as e:
             logger.error(f"Transcription error: {e}")
+        finally:
+            # 沒有結果也要讓出這個 seq，後面的結果才送得出去
+            session.reorder.complete(seq)
+            streamed_seqs.discard(seq)
+            if frame:
+                frame.release()
+
+    async def finalize_utterance(utterance: tuple[int, bytes]):
+        """hybrid: 整句送去 final 辨識，空字串也要送，讓前端清掉 partial"""
+        utterance_id, pcm_data = utterance
+        token = session.token
+        bind(utterance=utterance_id)
+        started = time.perf_counter()
+        result = await schedule(
+            run_asr, lambda: hybrid.finalize(utterance_id, pcm_data), session, token,
+            cost=len(pcm_data) / PCM_BYTES_PER_SECOND,
+        )
+        chunk_log.event(
+            "hybrid final", text=result.text, audio_s=round(len(pcm_data) / PCM_BYTES_PER_SECOND, 2),
+            total_ms=round((time.perf_counter() - started) * 1000, 1),
+        )
+        if session.is_connected:
+            send_result(result)
+
+    async def feed_hybrid(items: list[tuple[int, Optional[bytes], Optional[AudioFrame]]]):
+        """hybrid: 排隊中的 chunk 合併成一個視窗，fast 模型只跑一次"""
+        if len(items) == 1:
+            _, chunk, frame = items[0]
+            return await (hybrid.feed_pcm(frame.data) if frame else hybrid.feed(chunk))
+        pcm_data = b"".join(
+            bytes(frame.data) if frame else decode_audio(chunk) for _, chunk, frame in items
+        )
+        return await hybrid.feed_pcm(pcm_data)
+
+    async def process_audio_hybrid(seq: int, audio_chunk: bytes, frame: Optional[AudioFrame] = None):
+        """
+        hybrid: 先送本地 partial，句子結束再送 final
+        fast 模型忙的時候新的 chunk 會排隊；下一個拿到 lock 的 task 把排隊的全部合併處理，
+        其他 task 的音訊已經被涵蓋，不再各自跑一次 (partial 只需要最新的結果)
+        """
+        hybrid_inbox.append((seq, audio_chunk, frame))
+        items = []
+        owned: list[AudioFrame] = []  # 這個 task 從 inbox 取出的 frame，由它歸還一次
+        token = session.token
+        bind(seq=seq)
+        try:
+            async with hybrid.lock:
+                items = hybrid_inbox[:]
+                hybrid_inbox.clear()
+                owned = [item_frame for _, _, item_frame in items if item_frame]
+                if not items or not session.is_connected:
+                    return
+                if len(items) > 1:
+                    chunk_log.event("hybrid merge", chunks=len(items), first_seq=items[0][0])
+                # feed_pcm 在 executor 裡讀 frame 的 memoryview，schedule 保留 frame 到工作結束
+                partial = await schedule(
+                    run_asr, lambda: feed_hybrid(items), session, token,
+                    priority=Priority.PARTIAL,
+                    cost=sum(frame.duration if frame else PCM_CHUNK_SECONDS for _, _, frame in items),
+                    frames=owned,
+                )
+                utterance = hybrid.pop_utterance()
+            release_frames(owned)
+
+            level = current_load_level()
+            if partial.text and session.is_connected and not (level and level.skip_partials):
+                send_result(partial, items[-1][0])
+            for item_seq, _, _ in items:
+                session.reorder.complete(item_seq)
+            if utterance:
+                await finalize_utterance(utterance)
+        except Cancelled:
+            job_cancelled(f"hybrid chunk #{seq}")
+        except Exception as e:
+            logger.error(f"Hybrid transcription error: {e}")
+        finally:
+            for item_seq, _, _ in items:
+                session.reorder.complete(item_seq)
+            release_frames(owned)
+
+    async def flush_when_idle():
+        """hybrid: 一段時間沒有新音訊 (例如停止錄音) 就把最後一句送去 final"""
+        await asyncio.sleep(HYBRID_IDLE_FLUSH_SECONDS)
+        async with hybrid.lock:
+            utterance = hybrid.pop_utterance(force=True)
+        if utterance:
+            try:
+                # 已經取出的句子不能因為新 chunk 進來被取消
+                await asyncio.shield(finalize_utterance(utterance))
+            except Cancelled:
+                job_cancelled(f"hybrid final #{utterance[0]}")
+            except Exception as e:
+                logger.error(f"Hybrid final error: {e}")
+
+    def dispatch(audio_chunk: Optional[bytes], frame: Optional[AudioFrame] = None, flush: bool = False) -> None:
+        """
+        在背景處理，不阻塞主迴圈；PCM 串流傳 frame，辨識完會歸還 buffer
+        每個 chunk 拿一個 seq，結果依 seq 順序送出
+        """
+        nonlocal idle_flush_task
+        seq = session.reorder.reserve()
+        if frame:
+            frame.seq = seq
+        if session.capture:
+            session.capture.dispatch(seq, frame.length if frame else len(audio_chunk))
+        if hybrid:
+            start_job(process_audio_hybrid(seq, audio_chunk, frame))
+            if idle_flush_task:
+                idle_flush_task.cancel()
+            idle_flush_task = asyncio.create_task(flush_when_idle())
+        else:
+            start_job(process_audio(seq, audio_chunk, frame, flush=flush))
+
+    def flush_pcm() -> None:
+        """PCM 串流：把累積的音訊送去辨識 (停止錄音後剩下不滿一個 chunk 的也會送)"""
+        nonlocal pcm_flush_timer
+        if pcm_flush_timer:
+            pcm_flush_timer.cancel()
+            pcm_flush_timer = None
+        frame = pcm_frames.flush(min_bytes=PCM_BYTES_PER_SECOND // 10)  # 少於 0.1 秒不辨識
+        if frame:
+            # 串流停下來了：降級累積中的 chunk 也一起送出，不等湊滿
+            dispatch(None, frame, flush=True)
+        elif pending_pcm:
+            flush_pending()
+
+    def receive_pcm(data: bytes) -> None:
+        """PCM 串流：直接寫進 frame buffer，滿 PCM_CHUNK_SECONDS 就送去辨識"""
+        nonlocal pcm_flush_timer
+        for frame in pcm_frames.append(data):
+            dispatch(None, frame)
+        if pcm_flush_timer:
+            pcm_flush_timer.cancel()
+            pcm_flush_timer = None
+        if len(pcm_frames):
+            pcm_flush_timer = asyncio.get_running_loop().call_later(PCM_IDLE_FLUSH_SECONDS, flush_pcm)
+
+    async def receive_stream(data: bytes) -> None:
+        """連續 WebM 串流：只解新到的 packet，解出來的 PCM 走 PCM 串流的路徑"""
+        nonlocal stream_decoder
+        async with stream_lock:
+            # 第一個 chunk 或重新開始錄音 (新的串流從 EBML header 開始)
+            if stream_decoder is None or data.startswith(EBML_MAGIC):
+                stream_decoder = WebMStreamDecoder()
+            try:
+                pcm = await schedule(stream_decoder.feed, data, cost=0.0)
+            except Exception as e:
+                # 前端收到 code=stream 會重新開始錄音，下一個片段帶新的 EBML header
+                logger.error(f"WebM stream error: {e}")
+                stream_decoder = None
+                session.send({"type": "error", "code": "stream", "message": str(e)})
+                return
+        if pcm and session.is_connected:
+            receive_pcm(pcm)
 
     try:
         if asr_service:
@@ -266,13 +1061,12 @@ async def websocket_transcribe(websocket: WebSocket):
                 message = json.loads(data)
             except asyncio.TimeoutError:
                 # 發送心跳
-                try:
-                    await websocket.send_json({"type": "heartbeat"})
-                except:
+                if not session.is_connected:
                     break
+                session.send({"type": "heartbeat"})
                 continue
             except json.JSONDecodeError:
-                await websocket.send_json({"type": "error", "message": "Invalid JSON"})
+                session.send({"type": "error", "message": "Invalid JSON"})
                 continue
 
             msg_type = message.get("type", "")
@@ -288,29 +1082,48 @@ async def websocket_transcribe(websocket: WebSocket):
                     logger.error(f"Failed to decode audio: {e}")
                     continue
 
-                # 在背景處理，不阻塞主迴圈
-                if len(audio_chunk) > 1000:
-                    asyncio.create_task(process_audio(audio_chunk))
+                audio_format = message.get("format")
+                if session.capture:
+                    session.capture.audio(audio_format, audio_chunk)
+                if audio_format == "pcm16":
+                    receive_pcm(audio_chunk)
+                elif audio_format == "webm-stream":
+                    start_job(receive_stream(audio_chunk))
+                elif len(audio_chunk) > 1000:
+                    dispatch(audio_chunk)
 
             elif msg_type == "reset":
+                if session.capture:
+                    session.capture.control(message)
+                # 重設之前送出的音訊不再需要結果
+                cancel_jobs()
+                session.reorder.skip_issued()
                 if asr_service:
                     await asr_service.reset()
-                await websocket.send_json({"type": "status", "message": "Reset"})
+                if hybrid:
+                    hybrid.clear()
+                session.send({"type": "status", "message": "Reset"})
 
             elif msg_type == "ping":
-                await websocket.send_json({"type": "pong"})
+                session.send({"type": "pong"})
 
     except WebSocketDisconnect:
         logger.info("Client disconnected")
     except Exception as e:
         logger.error(f"WebSocket error: {e}")
     finally:
-        is_connected = False
-        manager.disconnect(websocket)
+        # 連線已經斷了，排隊中與進行中的辨識都不用做完
+        cancel_jobs()
+        sessions.close(session)
+        if session.capture:
+            session.capture.close()
         if asr_service:
             await asr_service.reset()
 
 
+startup_profile.mark("app imported")
+
+
 if __name__ == "__main__":
     import uvicorn
 
@@ -0,0 +1,228 @@
+"""
+Post-processing filters for AprilVoice
+Hallucination / empty-response / script filters shared by every ASR backend.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+from collections import Counter
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+from typing import Optional
+
+from asr_service import TranscriptionResult
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RULES_PATH = Path(__file__).with_name("postprocess_rules.json")
+
+
+def _trie_regex(words: list[str]) -> str:
+    """
+    把多個字串合併成前綴樹形狀的 regex
+    例如 訂閱 / 請訂閱 / 請不吝 -> (?:訂閱|請(?:不吝|訂閱))
+    re 的 alternation 每個位置都會逐一嘗試所有分支，
+    先依前綴分岔後，每個位置只要看第一個字元就能排除絕大部分規則
+    """
+    trie: dict = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+    return _trie_node_regex(trie)
+
+
+def _trie_node_regex(node: dict) -> str:
+    is_end = "" in node
+    children = [(ch, child) for ch, child in sorted(node.items()) if ch]
+    if not children:
+        return ""
+
+    leaves = [ch for ch, child in children if list(child) == [""]]
+    branches = [re.escape(ch) + _trie_node_regex(child) for ch, child in children if list(child) != [""]]
+
+    if len(leaves) == 1:
+        branches.append(re.escape(leaves[0]))
+    elif leaves:
+        branches.append("[" + "".join(re.escape(ch) for ch in leaves) + "]")
+
+    if len(branches) == 1 and not is_end:
+        return branches[0]
+    body = "(?:" + "|".join(branches) + ")"
+    # 自己也是一條規則時後面可有可無，貪婪比對會優先命中較長的規則
+    return body + "?" if is_end else body
+
+
+@dataclass
+class FilterRule:
+    """單一規則群組 (一個設定檔裡的 rules 項目)"""
+    name: str
+    type: str  # substring | exact | charset
+    patterns: list[str] = field(default_factory=list)
+    chars: str = ""
+    min_count: int = 1
+    sources: Optional[frozenset[str]] = None  # None = 套用到所有後端
+
+    def applies_to(self, source: str) -> bool:
+        return self.sources is None or source in self.sources
+
+
+@dataclass
+class _CompiledRules:
+    """某個 source 實際要跑的規則，全部預先編譯好"""
+    substring_regex: Optional[re.Pattern]
+    substring_keys: dict[str, str]  # 小寫的規則文字 -> 計數器 key
+    exact: dict[str, str]
+    charsets: list[tuple[re.Pattern, int, str]]
+
+
+class PostProcessor:
+    """
+    辨識結果後處理
+    所有 substring 規則合併成單一前綴樹 regex，不論規則有幾條都只掃一次文字
+    """
+
+    def __init__(self, rules: Optional[list[FilterRule]] = None):
+        self.rules: list[FilterRule] = rules or []
+        self._compiled: dict[str, _CompiledRules] = {}
+        self._hits: Counter = Counter()
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: dict) -> "PostProcessor":
+        rules = []
+        for item in config.get("rules", []):
+            sources = item.get("sources")
+            rules.append(FilterRule(
+                name=item["name"],
+                type=item.get("type", "substring"),
+                patterns=list(item.get("patterns", [])),
+                chars=item.get("chars", ""),
+                min_count=item.get("min_count", 1),
+                sources=frozenset(sources) if sources else None,
+            ))
+        return cls(rules)
+
+    def _compile(self, source: str) -> _CompiledRules:
+        substring_keys: dict[str, str] = {}
+        exact: dict[str, str] = {}
+        charsets = []
+
+        for rule in self.rules:
+            if not rule.applies_to(source):
+                continue
+            if rule.type == "substring":
+                for pattern in rule.patterns:
+                    substring_keys.setdefault(pattern.lower(), f"{rule.name}:{pattern}")
+            elif rule.type == "exact":
+                for pattern in rule.patterns:
+                    exact.setdefault(pattern, f"{rule.name}:{pattern}")
+            elif rule.type == "charset":
+                if rule.chars:
+                    charsets.append((
+                        re.compile(f"[{re.escape(rule.chars)}]"),
+                        rule.min_count,
+                        rule.name,
+                    ))
+            else:
+                logger.warning(f"Unknown post-process rule type: {rule.type} ({rule.name})")
+
+        substring_regex = None
+        if substring_keys:
+            substring_regex = re.compile(_trie_regex(list(substring_keys)))
+
+        return _CompiledRules(substring_regex, substring_keys, exact, charsets)
+
+    def _rules_for(self, source: str) -> _CompiledRules:
+        compiled = self._compiled.get(source)
+        if compiled is None:
+            compiled = self._compile(source)
+            self._compiled[source] = compiled
+        return compiled
+
+    def match(self, text: str, source: str = "") -> Optional[str]:
+        """回傳命中的規則 key，沒命中回傳 None"""
+        compiled = self._rules_for(source)
+
+        key = compiled.exact.get(text)
+        if key:
+            return key
+
+        if compiled.substring_regex is not None:
+            # 規則都是小寫，先轉小寫就不用 re.IGNORECASE
+            m = compiled.substring_regex.search(text.lower())
+            if m:
+                return compiled.substring_keys[m.group(0)]
+
+        for regex, min_count, name in compiled.charsets:
+            if len(regex.findall(text)) >= min_count:
+                return name
+
+        return None
+
+    def process(self, result: TranscriptionResult, source: str = "") -> TranscriptionResult:
+        """過濾辨識結果，命中任何規則就回傳空結果"""
+        text = result.text.strip()
+        if not text:
+            return result
+
+        key = self.match(text, source)
+        with self._lock:
+            self._checked += 1
+            if key:
+                self._hits[key] += 1
+
+        if key:
+            logger.warning(f"Filtered ({key}) from {source or 'unknown'}: '{text}'")
+            return replace(result, text="", confidence=0.0)
+
+        if text != result.text:
+            return replace(result, text=text)
+        return result
+
+    def get_stats(self) -> dict:
+        """取得各規則命中次數"""
+        with self._lock:
+            return {
+                "checked": self._checked,
+                "filtered": sum(self._hits.values()),
+                "hits": dict(self._hits.most_common()),
+            }
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self._hits.clear()
+            self._checked = 0
+
+
+def load_post_processor(config_path: Optional[str] = None) -> PostProcessor:
+    """從設定檔載入後處理規則"""
+    path = Path(config_path or os.getenv("POSTPROCESS_RULES", str(DEFAULT_RULES_PATH)))
+
+    if not path.exists():
+        logger.warning(f"Post-process rules not found: {path}")
+        return PostProcessor()
+
+    with open(path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    processor = PostProcessor.from_config(config)
+    total = sum(len(r.patterns) or 1 for r in processor.rules)
+    logger.info(f"Loaded {total} post-process rules from {path}")
+    return processor
+
+
+_post_processor: Optional[PostProcessor] = None
+
+
+def get_post_processor() -> PostProcessor:
+    """全域共用的後處理器 (第一次使用時載入)"""
+    global _post_processor
+    if _post_processor is None:
+        _post_processor = load_post_processor()
+    return _post_processor
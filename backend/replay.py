@@ -0,0 +1,465 @@
+"""
+Replay tool for AprilVoice
+Feeds sessions captured with SESSION_CAPTURE_DIR back through a running server or
+straight into an ASRService, at original or accelerated speed, and reports per-stage timings.
+Run: python replay.py captures/*.avcap [--url ws://localhost:8000/ws/transcribe] [--speed 4]
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Optional
+
+from session_capture import (
+    AUDIO_FORMATS, AUDIO_PCM, AUDIO_STREAM, AUDIO_WEBM, CONTROL, DISPATCH, RESULT, CaptureRecord, read_capture
+)
+
+BYTES_PER_SECOND = 32000  # PCM 16-bit 16kHz
+EBML_MAGIC = b"\x1a\x45\xdf\xa3"
+
+
+@dataclass
+class Capture:
+    path: str
+    metadata: dict
+    records: list[CaptureRecord]
+
+    @property
+    def duration(self) -> float:
+        return self.records[-1].t if self.records else 0.0
+
+    def dispatch_times(self) -> dict[int, float]:
+        return {record.json()["seq"]: record.t for record in self.records if record.kind == DISPATCH}
+
+    def captured_latencies(self) -> dict[str, list[float]]:
+        """正式環境當時的延遲: chunk 送去辨識到送出第一個段落 / transcript"""
+        dispatched = self.dispatch_times()
+        first: dict[str, dict[int, float]] = {"segment": {}, "transcript": {}}
+        for record in self.records:
+            if record.kind != RESULT:
+                continue
+            message = record.json()
+            seq = message.get("seq")
+            if seq in dispatched:
+                first[message["type"]].setdefault(seq, record.t - dispatched[seq])
+        return {
+            "first_segment": list(first["segment"].values()),
+            "transcript": list(first["transcript"].values()),
+        }
+
+    def captured_texts(self) -> dict[int, str]:
+        return {
+            message["seq"]: message.get("text", "")
+            for message in (record.json() for record in self.records if record.kind == RESULT)
+            if message.get("type") == "transcript" and "seq" in message
+        }
+
+
+def load_capture(path: str) -> Capture:
+    metadata, records = read_capture(path)
+    return Capture(path=path, metadata=metadata, records=list(records))
+
+
+@dataclass
+class ChunkTiming:
+    """一個 chunk 在每個階段花的時間 (秒)；沒有經過的階段是 None"""
+    session: int
+    seq: int
+    audio_seconds: float = 0.0
+    wait: Optional[float] = None  # 可以辨識到拿到 worker
+    decode: Optional[float] = None  # ffmpeg / 串流 demux
+    first_segment: Optional[float] = None  # 可以辨識到第一個段落
+    inference: Optional[float] = None  # 模型 (含後處理)
+    transcript: Optional[float] = None  # 可以辨識到完整結果
+    text: str = ""
+
+    @property
+    def rtf(self) -> Optional[float]:
+        if self.inference is None or not self.audio_seconds:
+            return None
+        return self.inference / self.audio_seconds
+
+
+@dataclass
+class ReplayStats:
+    chunks: list[ChunkTiming] = field(default_factory=list)
+    expected: int = 0
+    errors: int = 0
+    rejected: int = 0
+
+
+async def _wait_until(start: float, t: float, speed: float) -> None:
+    """照 capture 裡的時間 (除以 speed) 送出；speed <= 0 表示不等，越快越好"""
+    if speed <= 0:
+        return
+    delay = start + t / speed - time.perf_counter()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+# --- 透過伺服器重播 ---
+
+async def replay_server(url: str, index: int, capture: Capture, delay: float, speed: float,
+                        drain: float, stats: ReplayStats) -> None:
+    """
+    照原本的時間把 client 的訊息送給伺服器
+    每個 seq 的起點是原本 chunk 送去辨識的時間 (伺服器要用相同的 PCM_CHUNK_SECONDS，seq 才對得上)
+    """
+    import websockets
+
+    dispatched = capture.dispatch_times()
+    stats.expected += len(dispatched)
+    timings: dict[int, ChunkTiming] = {}
+    ready_at: dict[int, float] = {}
+    done = asyncio.Event()
+
+    def timing(seq: int) -> ChunkTiming:
+        if seq not in timings:
+            timings[seq] = ChunkTiming(session=index, seq=seq)
+            stats.chunks.append(timings[seq])
+        return timings[seq]
+
+    async def receive(ws):
+        async for raw in ws:
+            message = json.loads(raw)
+            msg_type = message.get("type")
+            seq = message.get("seq")
+            if msg_type in ("segment", "transcript") and seq in ready_at:
+                chunk = timing(seq)
+                elapsed = time.perf_counter() - ready_at[seq]
+                if msg_type == "segment" and chunk.first_segment is None:
+                    chunk.first_segment = elapsed
+                elif msg_type == "transcript" and chunk.transcript is None:
+                    chunk.transcript = elapsed
+                    chunk.text = message.get("text", "")
+                    if sum(c.transcript is not None for c in timings.values()) == len(dispatched):
+                        done.set()
+            elif msg_type == "error":
+                if message.get("code") in ("capacity", "draining"):
+                    stats.rejected += 1
+                    done.set()
+                    return
+                stats.errors += 1
+
+    await asyncio.sleep(delay)
+    async with websockets.connect(url, max_size=None) as ws:
+        receiver = asyncio.create_task(receive(ws))
+        start = time.perf_counter()
+        last_sent = start
+        try:
+            for record in capture.records:
+                await _wait_until(start, record.t, speed)
+                if record.kind in AUDIO_FORMATS or record.kind == CONTROL:
+                    await ws.send(json.dumps(record.to_message()))
+                    last_sent = time.perf_counter()
+                elif record.kind == DISPATCH:
+                    # 不等時間 (speed <= 0) 時沒有原本的節奏，以觸發這個 chunk 的訊息送出時間為起點
+                    seq = record.json()["seq"]
+                    ready_at[seq] = start + record.t / speed if speed > 0 else last_sent
+            try:
+                await asyncio.wait_for(done.wait(), drain)
+            except asyncio.TimeoutError:
+                pass
+        finally:
+            receiver.cancel()
+
+
+# --- 直接餵給 ASRService ---
+
+def _transcribe_chunk(service, chunk: ChunkTiming, ready: float, audio: bytes, is_pcm: bool) -> ChunkTiming:
+    """在 worker thread 執行，跟伺服器一樣先解碼 (WebM) 再邊辨識邊收段落"""
+    from asr_service import decode_audio, transcribe_streaming
+
+    started = time.perf_counter()
+    chunk.wait = started - ready
+    pcm = audio if is_pcm else decode_audio(audio)
+    decoded = time.perf_counter()
+    if not is_pcm:
+        chunk.decode = decoded - started
+    chunk.audio_seconds = len(pcm) / BYTES_PER_SECOND
+
+    def on_segment(segment) -> None:
+        if chunk.first_segment is None:
+            chunk.first_segment = time.perf_counter() - ready
+
+    result = asyncio.run(transcribe_streaming(service, pcm, on_segment))
+    finished = time.perf_counter()
+    chunk.inference = finished - decoded
+    chunk.transcript = finished - ready
+    chunk.text = result.text
+    return chunk
+
+
+async def replay_direct(service, scheduler, index: int, capture: Capture,
+                        delay: float, speed: float, stats: ReplayStats) -> None:
+    """
+    不經過網路，照伺服器的切法 (PCM_CHUNK_SECONDS、閒置 flush、WebM 串流 demux) 把 capture 切成 chunk，
+    交給跟伺服器一樣的 scheduler 辨識；多個 capture 同時重播時會跟正式環境一樣輪流使用 worker
+    """
+    from asr_service import WebMStreamDecoder
+    from audio_frames import FrameAssembler
+    from scheduler import Priority
+
+    chunk_seconds = capture.metadata.get("pcm_chunk_seconds", 1.5)
+    idle_flush = capture.metadata.get("pcm_idle_flush_seconds", 0.5)
+    frames = FrameAssembler(int(chunk_seconds * BYTES_PER_SECOND))
+    stream_decoder = None
+    last_pcm_t: Optional[float] = None
+    jobs = []
+    seq = 0
+
+    def submit(audio: bytes, is_pcm: bool) -> None:
+        nonlocal seq
+        chunk = ChunkTiming(session=index, seq=seq)
+        seq += 1
+        stats.chunks.append(chunk)
+        stats.expected += 1
+        jobs.append(asyncio.ensure_future(scheduler.run(
+            _transcribe_chunk, service, chunk, time.perf_counter(), audio, is_pcm,
+            priority=Priority.FINAL, flow=index, cost=len(audio) / BYTES_PER_SECOND if is_pcm else chunk_seconds,
+        )))
+
+    def receive_pcm(pcm: bytes, t: float) -> None:
+        nonlocal last_pcm_t
+        for frame in frames.append(pcm):
+            submit(bytes(frame.data), True)
+            frame.release()
+        last_pcm_t = t
+
+    def flush_pcm() -> None:
+        nonlocal last_pcm_t
+        frame = frames.flush(min_bytes=BYTES_PER_SECOND // 10)
+        if frame:
+            submit(bytes(frame.data), True)
+            frame.release()
+        last_pcm_t = None
+
+    await asyncio.sleep(delay)
+    start = time.perf_counter()
+    for record in capture.records:
+        # 伺服器在最後一個 frame 之後閒置 idle_flush 秒會把不滿一個 chunk 的音訊送出
+        if last_pcm_t is not None and record.t - last_pcm_t >= idle_flush:
+            await _wait_until(start, last_pcm_t + idle_flush, speed)
+            flush_pcm()
+        await _wait_until(start, record.t, speed)
+
+        if record.kind == AUDIO_PCM:
+            receive_pcm(record.payload, record.t)
+        elif record.kind == AUDIO_WEBM:
+            if len(record.payload) > 1000:
+                submit(record.payload, False)
+        elif record.kind == AUDIO_STREAM:
+            if stream_decoder is None or record.payload.startswith(EBML_MAGIC):
+                stream_decoder = WebMStreamDecoder()
+            demux_start = time.perf_counter()
+            try:
+                pcm = await scheduler.run(stream_decoder.feed, record.payload,
+                                          priority=Priority.FINAL, flow=index, cost=0.0)
+            except ValueError as e:
+                print(f"  {capture.path}: WebM stream error at {record.t:.2f}s: {e}", file=sys.stderr)
+                stream_decoder = None
+                stats.errors += 1
+                continue
+            stats.chunks.append(ChunkTiming(session=index, seq=-1, decode=time.perf_counter() - demux_start))
+            if pcm:
+                receive_pcm(pcm, record.t)
+        elif record.kind == CONTROL and record.json().get("type") == "reset":
+            frames.clear()
+            last_pcm_t = None
+    if last_pcm_t is not None:
+        flush_pcm()
+
+    for result in await asyncio.gather(*jobs, return_exceptions=True):
+        if isinstance(result, Exception):
+            print(f"  {capture.path}: transcription failed: {result}", file=sys.stderr)
+            stats.errors += 1
+
+
+def create_service(args):
+    from asr_service import create_asr_service
+
+    return create_asr_service(use_mock=args.mock, engine=args.engine, model_size=args.model)
+
+
+# --- 報告 ---
+
+STAGES = ["wait", "decode", "first_segment", "inference", "transcript", "rtf"]
+
+
+def _percentile(samples: list[float], q: float) -> float:
+    if not samples:
+        return float("nan")
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, max(0, math.ceil(q * len(samples)) - 1))]
+
+
+def summarize(samples: list[float]) -> dict:
+    return {
+        "n": len(samples),
+        "p50": _percentile(samples, 0.50),
+        "p95": _percentile(samples, 0.95),
+        "max": max(samples) if samples else float("nan"),
+        "mean": statistics.fmean(samples) if samples else float("nan"),
+    }
+
+
+def stage_report(chunks: list[ChunkTiming]) -> dict:
+    report = {}
+    for stage in STAGES:
+        samples = [value for value in (getattr(chunk, stage) for chunk in chunks) if value is not None]
+        if samples:
+            report[stage] = summarize(samples)
+    return report
+
+
+def _print_stages(title: str, report: dict) -> None:
+    print(title)
+    print(f"  {'stage':<14} {'n':>5} {'p50':>8} {'p95':>8} {'max':>8} {'mean':>8}")
+    for stage, row in report.items():
+        unit = "x" if stage == "rtf" else "s"
+        print(f"  {stage:<14} {row['n']:>5} {row['p50']:7.3f}{unit} {row['p95']:7.3f}{unit} "
+              f"{row['max']:7.3f}{unit} {row['mean']:7.3f}{unit}")
+
+
+async def run(args) -> None:
+    captures = [load_capture(path) for path in args.captures]
+    captures = [capture for capture in captures if capture.records]
+    if not captures:
+        print("no records in the given captures", file=sys.stderr)
+        sys.exit(1)
+
+    # 保留 session 之間原本的先後關係，重現當時的並行程度
+    first = min(capture.metadata.get("started_at", 0) for capture in captures)
+    delays = [
+        (capture.metadata.get("started_at", first) - first) / args.speed if args.speed > 0 and not args.sequential
+        else 0.0
+        for capture in captures
+    ]
+    session_seconds = sum(capture.duration for capture in captures)
+    target = args.url or ("mock ASR" if args.mock else f"{args.engine or os.getenv('ASR_ENGINE', 'faster-whisper')} {args.model}")
+    print(f"replay: {len(captures)} session(s), {session_seconds:.1f}s of traffic, "
+          f"speed {'max' if args.speed <= 0 else f'{args.speed:g}x'} -> {target}")
+
+    stats = ReplayStats()
+    wall_start = time.perf_counter()
+    if args.url:
+        coros = [
+            replay_server(args.url, index, capture, delay, args.speed, args.drain, stats)
+            for index, (capture, delay) in enumerate(zip(captures, delays))
+        ]
+    else:
+        from scheduler import InferenceScheduler
+        from tuning import active_tuning
+
+        service = create_service(args)
+        await service.initialize()
+        workers = args.workers or active_tuning().workers
+        scheduler = InferenceScheduler(ThreadPoolExecutor(max_workers=workers), workers=workers,
+                                       quantum=captures[0].metadata.get("pcm_chunk_seconds", 1.5))
+        print(f"  {workers} inference workers")
+        coros = [
+            replay_direct(service, scheduler, index, capture, delay, args.speed, stats)
+            for index, (capture, delay) in enumerate(zip(captures, delays))
+        ]
+    if args.sequential:
+        results = [await coro for coro in coros]
+    else:
+        results = await asyncio.gather(*coros, return_exceptions=True)
+    wall = time.perf_counter() - wall_start
+    for capture, result in zip(captures, results):
+        if isinstance(result, Exception):
+            print(f"  {capture.path}: replay failed: {result}", file=sys.stderr)
+            stats.errors += 1
+
+    chunks = [chunk for chunk in stats.chunks if chunk.seq >= 0]
+    replayed = stage_report(stats.chunks)
+    captured_samples = {"first_segment": [], "transcript": []}
+    for capture in captures:
+        for stage, samples in capture.captured_latencies().items():
+            captured_samples[stage].extend(samples)
+    captured = {stage: summarize(samples) for stage, samples in captured_samples.items() if samples}
+
+    _print_stages("replayed:", replayed)
+    if captured:
+        _print_stages("captured (production):", captured)
+    missing = stats.expected - sum(chunk.transcript is not None for chunk in chunks)
+    print(f"chunks: {stats.expected}  missing: {missing}  errors: {stats.errors}  rejected: {stats.rejected}  "
+          f"wall: {wall:.1f}s ({session_seconds / wall if wall else 0:.2f}x real time)")
+
+    if args.show_text:
+        for index, capture in enumerate(captures):
+            original = capture.captured_texts()
+            print(f"{capture.path}:")
+            for chunk in sorted((c for c in chunks if c.session == index), key=lambda c: c.seq):
+                before = original.get(chunk.seq)
+                marker = " " if before is None or before == chunk.text else "*"
+                print(f"  {marker}#{chunk.seq:<4} {chunk.text}" + (f"  (was: {before})" if marker == "*" else ""))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({
+                "target": target,
+                "speed": args.speed,
+                "sessions": len(captures),
+                "session_seconds": session_seconds,
+                "wall": wall,
+                "chunks": stats.expected,
+                "missing": missing,
+                "errors": stats.errors,
+                "rejected": stats.rejected,
+                "replayed": replayed,
+                "captured": captured,
+            }, f, indent=2)
+
+
+def print_info(paths: list[str]) -> None:
+    """capture 檔的內容摘要"""
+    names = {AUDIO_WEBM: "webm", AUDIO_PCM: "pcm16", AUDIO_STREAM: "webm-stream", CONTROL: "control",
+             DISPATCH: "dispatch", RESULT: "result"}
+    for path in paths:
+        capture = load_capture(path)
+        counts: dict[str, int] = {}
+        for record in capture.records:
+            name = names.get(record.kind, "close")
+            counts[name] = counts.get(name, 0) + 1
+        started = capture.metadata.get("started_at")
+        print(f"{path}: session {capture.metadata.get('session_id')}  "
+              f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started)) if started else '?'}  "
+              f"mode={capture.metadata.get('mode')}  {capture.duration:.1f}s  "
+              + " ".join(f"{name}={count}" for name, count in counts.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured AprilVoice sessions")
+    parser.add_argument("captures", nargs="+", help=".avcap files written with SESSION_CAPTURE_DIR")
+    parser.add_argument("--url", help="replay through a running server (ws://host:port/ws/transcribe); "
+                                      "default is to feed the ASR service in this process")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="1 = original timing, 4 = four times faster, 0 = as fast as possible")
+    parser.add_argument("--sequential", action="store_true",
+                        help="replay captures one after another instead of with their original overlap")
+    parser.add_argument("--model", default="small", help="model size for direct replay")
+    parser.add_argument("--engine", choices=["faster-whisper", "onnx"],
+                        help="local engine for direct replay (default: ASR_ENGINE)")
+    parser.add_argument("--mock", action="store_true", help="direct replay with the mock ASR (MOCK_ASR_LATENCY)")
+    parser.add_argument("--workers", type=int, help="inference workers for direct replay (default: tuned value)")
+    parser.add_argument("--drain", type=float, default=30, help="seconds to wait for late transcripts (server)")
+    parser.add_argument("--show-text", action="store_true", help="print transcripts, marking ones that changed")
+    parser.add_argument("--info", action="store_true", help="only summarize the captures")
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+    if args.info:
+        print_info(args.captures)
+        return
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""
+Inference scheduler for AprilVoice
+Sits in front of the inference executor: strict priority between classes
+(interactive final > interactive partial > batch) and deficit round robin
+between sessions inside a class, so one fast sender cannot starve the others.
+"""
+
+import asyncio
+import contextvars
+import logging
+import time
+from collections import deque
+from concurrent.futures import Executor
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any, Callable, Hashable, Optional
+
+from logs import bind
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    FINAL = 0  # 使用者等著看的結果 (一般 chunk、hybrid 的整句 final)
+    PARTIAL = 1  # hybrid 的即時 partial，之後會被 final 取代
+    BATCH = 2  # 上傳檔案的批次辨識
+
+
+@dataclass
+class _Job:
+    fn: Callable
+    args: tuple
+    priority: Priority
+    flow: Hashable
+    cost: float
+    future: asyncio.Future
+    on_done: Optional[Callable[[], None]] = None
+    # 呼叫端的 context (session、seq 等 log 欄位)，在 worker thread 裡照樣看得到
+    context: contextvars.Context = field(default_factory=contextvars.copy_context)
+    enqueued_at: float = field(default_factory=time.monotonic)
+    started_at: Optional[float] = None
+    cancelled: bool = False
+
+
+class _ClassQueue:
+    """
+    一個優先等級的 deficit round robin
+    每個 flow (session / batch job) 一個佇列；輪到的 flow 先加 quantum 的額度，
+    額度夠付隊首工作的 cost (音訊秒數) 就執行，不夠就換下一個 flow，額度留到下一輪
+    """
+
+    def __init__(self, quantum: float, history: int):
+        self.quantum = quantum
+        self.flows: dict[Hashable, deque[_Job]] = {}
+        self.deficit: dict[Hashable, float] = {}
+        self.active: deque[Hashable] = deque()  # 有工作在排隊的 flow，輪流服務
+        self._turn_started = False
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.waits: deque[float] = deque(maxlen=history)  # 最近的排隊時間 (秒)
+
+    def push(self, job: _Job) -> None:
+        if job.flow not in self.flows:
+            self.flows[job.flow] = deque()
+            self.deficit[job.flow] = 0.0
+            self.active.append(job.flow)
+        self.flows[job.flow].append(job)
+        self.waiting += 1
+
+    def pop(self) -> Optional[_Job]:
+        while self.active:
+            flow = self.active[0]
+            jobs = self.flows[flow]
+            # 取消的工作直接丟掉，不扣額度
+            while jobs and jobs[0].cancelled:
+                jobs.popleft()
+            if not jobs:
+                self._drop(flow)
+                continue
+            if not self._turn_started:
+                self.deficit[flow] += self.quantum
+                self._turn_started = True
+            if jobs[0].cost <= self.deficit[flow]:
+                job = jobs.popleft()
+                self.deficit[flow] -= job.cost
+                self.waiting -= 1
+                if not jobs:
+                    self._drop(flow)
+                return job
+            # 額度不夠，換下一個 flow
+            self.active.rotate(-1)
+            self._turn_started = False
+        return None
+
+    def _drop(self, flow: Hashable) -> None:
+        """flow 沒有工作了：移出輪替，額度歸零 (閒置的 flow 不能存額度)"""
+        self.active.remove(flow)
+        del self.flows[flow]
+        del self.deficit[flow]
+        self._turn_started = False
+
+
+class InferenceScheduler:
+    """
+    所有辨識工作都經過這裡再交給 executor
+    同時執行的數量不超過 workers (= executor 的 thread 數)，排隊發生在 scheduler 裡而不是 executor 的 FIFO，
+    worker 空出來時從最高優先等級挑下一個工作；同一等級內各 session 依 cost (音訊秒數) 公平分配
+    """
+
+    def __init__(self, executor: Executor, workers: int, quantum: float = 1.5, history: int = 500):
+        # 額度不會增加的話，cost > 0 的工作永遠付不起，pop 會在這裡一直轉
+        if not quantum > 0:
+            raise ValueError(f"Scheduler quantum must be positive, got {quantum!r}")
+        self.executor = executor
+        self.workers = workers
+        self.running = 0
+        self._queues = {priority: _ClassQueue(quantum, history) for priority in Priority}
+        self._flow_waiting: dict[Hashable, int] = {}
+
+    async def run(
+        self, fn: Callable, *args, priority: Priority, flow: Hashable, cost: float = 1.0,
+        on_done: Optional[Callable[[], None]] = None,
+    ) -> Any:
+        """
+        排隊等 worker，在 executor 執行 fn(*args) 並回傳結果；排隊中被取消就不會執行
+        on_done 在工作不會再執行時 (executor 跑完，或排隊中被取消) 在 event loop 上呼叫一次；
+        已經開始執行的工作不會因為呼叫端被取消而停下，它讀的 buffer 要等 on_done 才能歸還
+        """
+        loop = asyncio.get_running_loop()
+        job = _Job(
+            fn=fn, args=args, priority=priority, flow=flow, cost=max(cost, 0.0),
+            future=loop.create_future(), on_done=on_done,
+        )
+        self._queues[priority].push(job)
+        self._flow_waiting[flow] = self._flow_waiting.get(flow, 0) + 1
+        self._dispatch()
+        try:
+            return await job.future
+        except asyncio.CancelledError:
+            if job.started_at is None and not job.cancelled:
+                job.cancelled = True
+                self._queues[priority].waiting -= 1
+                self._flow_done_waiting(flow)
+                if on_done:
+                    on_done()
+            raise
+
+    def resize(self, executor: Executor, workers: int) -> None:
+        """
+        改用新的 executor 與同時執行數 (背景 CPU 調校完成時)
+        scheduler 是唯一拿著 executor 的地方，之後的工作 (含已經在排隊的) 都送進新的；
+        舊 executor 裡執行中的工作照常跑完，結果一樣經過 _finished
+        """
+        previous = self.executor
+        self.executor = executor
+        self.workers = workers
+        previous.shutdown(wait=False)
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self.running < self.workers:
+            job = self._next_job()
+            if job is None:
+                return
+            queue = self._queues[job.priority]
+            job.started_at = time.monotonic()
+            wait = job.started_at - job.enqueued_at
+            queue.waits.append(wait)
+            job.context.run(bind, wait_ms=round(wait * 1000, 1))
+            queue.running += 1
+            self.running += 1
+            self._flow_done_waiting(job.flow)
+            future = loop.run_in_executor(self.executor, job.context.run, job.fn, *job.args)
+            future.add_done_callback(lambda f, job=job: self._finished(job, f))
+
+    def _next_job(self) -> Optional[_Job]:
+        for priority in Priority:
+            job = self._queues[priority].pop()
+            if job is not None:
+                return job
+        return None
+
+    def _finished(self, job: _Job, future: asyncio.Future) -> None:
+        queue = self._queues[job.priority]
+        queue.running -= 1
+        queue.completed += 1
+        self.running -= 1
+        if job.on_done:
+            job.on_done()
+        # 等結果的 task 可能已經被取消 (斷線)，例外還是要取出來，不然 asyncio 會警告
+        exception = None if future.cancelled() else future.exception()
+        if not job.future.done():
+            if future.cancelled():
+                job.future.cancel()
+            elif exception is not None:
+                job.future.set_exception(exception)
+            else:
+                job.future.set_result(future.result())
+        self._dispatch()
+
+    def _flow_done_waiting(self, flow: Hashable) -> None:
+        remaining = self._flow_waiting.get(flow, 0) - 1
+        if remaining > 0:
+            self._flow_waiting[flow] = remaining
+        else:
+            self._flow_waiting.pop(flow, None)
+
+    # --- 狀態 ---
+
+    def waiting(self, *priorities: Priority) -> int:
+        """排隊中 (還沒拿到 worker) 的工作數"""
+        return sum(self._queues[p].waiting for p in priorities or Priority)
+
+    def inflight(self, *priorities: Priority) -> int:
+        """排隊中 + 執行中"""
+        return sum(self._queues[p].waiting + self._queues[p].running for p in priorities or Priority)
+
+    @property
+    def interactive_inflight(self) -> int:
+        return self.inflight(Priority.FINAL, Priority.PARTIAL)
+
+    def get_status(self) -> dict:
+        classes = {}
+        for priority, queue in self._queues.items():
+            waits = sorted(queue.waits)
+            classes[priority.name.lower()] = {
+                "waiting": queue.waiting,
+                "running": queue.running,
+                "completed": queue.completed,
+                "flows": len(queue.active),
+                "wait_p50": round(waits[len(waits) // 2], 4) if waits else None,
+                "wait_p95": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 4) if waits else None,
+                "wait_max": round(waits[-1], 4) if waits else None,
+            }
+        return {
+            "workers": self.workers,
+            "running": self.running,
+            "classes": classes,
+            "flows_waiting": {str(flow): count for flow, count in self._flow_waiting.items()},
+        }
@@ -0,0 +1,205 @@
+"""
+Production launcher for AprilVoice
+Binds the listening socket once, then forks several uvicorn workers sharing it.
+Each worker loads its ASR model after fork; ONNX weights are memory-mapped so
+workers share one copy in the page cache, CTranslate2 weights cannot be shared.
+Run: python serve.py --workers 4
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+from typing import Optional
+
+import uvicorn
+
+import main
+from tuning import active_tuning, pin_worker
+
+logger = logging.getLogger("serve")
+
+
+def memory_usage() -> dict:
+    """
+    目前 process 的記憶體 (MB)
+    rss 會把和其他 worker 共用的 page 也算進去，pss 把共用的部分平均分攤，比較接近實際用量
+    """
+    usage = {}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                if key in ("Rss", "Pss", "Shared_Clean", "Shared_Dirty"):
+                    usage[key.lower()] = int(value.split()[0]) / 1024
+    except OSError:
+        # 非 Linux：只有 peak RSS 可用
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        usage["max_rss"] = peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return usage
+
+
+def _format_memory(usage: dict) -> str:
+    return ", ".join(f"{key}={value:.0f}MB" for key, value in usage.items())
+
+
+class WorkerServer(uvicorn.Server):
+    """
+    收到 SIGTERM / SIGINT 先停止接受新連線，等進行中的 session 結束 (最多 drain_timeout 秒) 才關閉
+    再收到一次信號就直接關閉
+    """
+
+    def __init__(self, config: uvicorn.Config, drain_timeout: float):
+        super().__init__(config)
+        self.drain_timeout = drain_timeout
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._drain_task: Optional[asyncio.Task] = None
+
+    async def serve(self, sockets=None) -> None:
+        self._loop = asyncio.get_running_loop()
+        await super().serve(sockets=sockets)
+
+    def handle_exit(self, sig, frame) -> None:
+        if self._drain_task is not None or self._loop is None:
+            self.force_exit = self._drain_task is not None
+            self.should_exit = True
+            return
+        logger.info(f"Worker {os.getpid()}: draining sessions before exit")
+        self._drain_task = self._loop.create_task(self._drain())
+
+    async def _drain(self) -> None:
+        await main.sessions.drain(self.drain_timeout)
+        self.should_exit = True
+
+
+def run_worker(sock: socket.socket, args, started_at: float) -> None:
+    config = uvicorn.Config(main.app, log_config=None, timeout_graceful_shutdown=args.drain_timeout)
+    server = WorkerServer(config, drain_timeout=args.drain_timeout)
+
+    async def serve():
+        serving = asyncio.create_task(server.serve(sockets=[sock]))
+        while not server.started and not serving.done():
+            await asyncio.sleep(0.05)
+        if server.started:
+            logger.info(
+                f"Worker {os.getpid()} accepting connections in {time.monotonic() - started_at:.2f}s "
+                f"({_format_memory(memory_usage())})"
+            )
+        await serving
+
+    asyncio.run(serve())
+
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def spawn(sock: socket.socket, args, index: int) -> int:
+    started_at = time.monotonic()
+    pid = os.fork()
+    if pid == 0:
+        # worker: 還原預設信號處理，交給 uvicorn 接手
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        if args.pin_cores:
+            # 之後建立的 thread (CTranslate2 的計算 thread) 也只會用這些核心
+            cores = pin_worker(index, args.workers)
+            logger.info(f"Worker {os.getpid()} pinned to cores {cores}")
+        code = 0
+        try:
+            run_worker(sock, args, started_at)
+        except Exception as e:
+            logger.error(f"Worker {os.getpid()} crashed: {e}")
+            code = 1
+        finally:
+            logging.shutdown()
+            os._exit(code)
+    return pid
+
+
+def share_weights(workers: int) -> None:
+    """
+    fork 前決定 worker 之間怎麼共用模型權重
+    模型不能在 fork 前載入: CTranslate2 的計算 thread 在 fork 後不存在，worker 第一次辨識就卡住
+    ONNX: 權重留在 mmap 的模型檔 (見 OnnxWhisperService)，每個 worker 各自載入仍只佔一份實體記憶體；
+      不 prepack 權重辨識會慢一些，所以只在多 worker 時預設開啟 (ONNX_SHARE_WEIGHTS 可覆寫)
+    faster-whisper: CTranslate2 載入時把權重複製到自己的記憶體，無法跨 process 共用，
+      只有同一個 process 內的 inference worker (EXECUTOR_WORKERS) 共用一份
+    """
+    os.environ.setdefault("ONNX_SHARE_WEIGHTS", "1" if workers > 1 else "0")
+    local = not any(os.getenv(flag, "0") == "1" for flag in ("USE_MOCK_ASR", "USE_CLOUD_ASR"))
+    if workers > 1 and local and os.getenv("ASR_ENGINE", "faster-whisper") == "faster-whisper":
+        logger.warning(
+            f"faster-whisper weights are not shared between processes: {workers} workers load "
+            f"{workers} copies; fewer --workers with more EXECUTOR_WORKERS share one copy per process"
+        )
+
+
+def main_process(args) -> None:
+    sock = bind_socket(args.host, args.port)
+    logger.info(f"Listening on {args.host}:{args.port} with {args.workers} workers")
+
+    share_weights(args.workers)
+
+    # pid -> worker 編號，重啟時沿用同一組核心
+    workers = {spawn(sock, args, index): index for index in range(args.workers)}
+    stopping = False
+
+    def forward(sig, frame):
+        nonlocal stopping
+        if stopping:
+            logger.warning("Second signal, stopping workers immediately")
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        index = workers.pop(pid, None)
+        if not stopping and index is not None:
+            logger.error(f"Worker {pid} exited unexpectedly (status {status}), restarting")
+            workers[spawn(sock, args, index)] = index
+
+    sock.close()
+    logger.info("All workers stopped")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="AprilVoice production server")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WORKERS", "2")))
+    parser.add_argument("--drain-timeout", type=float,
+                        default=float(os.getenv("DRAIN_TIMEOUT", "30")),
+                        help="seconds to wait for open sessions on shutdown")
+    parser.add_argument("--pin-cores", action="store_true", default=None,
+                        help="pin each worker to its own cores (default from asr_tuning.json / ASR_PIN_CORES)")
+    args = parser.parse_args()
+    if args.pin_cores is None:
+        args.pin_cores = active_tuning().pin_cores
+    return args
+
+
+if __name__ == "__main__":
+    main_process(parse_args())
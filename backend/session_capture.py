@@ -0,0 +1,154 @@
+"""
+Session capture for AprilVoice
+Opt-in recording of /ws/transcribe sessions (incoming audio with arrival times,
+chunk dispatches and outgoing results) to a compact append-only file,
+so real traffic can be replayed offline with replay.py.
+"""
+
+import base64
+import json
+import logging
+import os
+import random
+import struct
+import time
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"AVCAP\x01"
+# 每筆紀錄: 距離 session 開始的毫秒數, 種類, payload 長度
+RECORD_HEADER = struct.Struct("<IBI")
+
+# 紀錄種類
+AUDIO_WEBM = 1  # 每次重啟 MediaRecorder 的獨立 WebM 檔
+AUDIO_PCM = 2  # AudioWorklet 的 PCM 16-bit 16kHz frame
+AUDIO_STREAM = 3  # 連續 MediaRecorder 串流的 WebM 片段
+CONTROL = 4  # 音訊以外的訊息 (reset 等)，JSON
+DISPATCH = 5  # 伺服器把一個 chunk 送去辨識，JSON {"seq", "bytes"}
+RESULT = 6  # 送給 client 的 transcript / segment，JSON
+CLOSE = 7  # 連線結束
+
+AUDIO_KINDS = {None: AUDIO_WEBM, "pcm16": AUDIO_PCM, "webm-stream": AUDIO_STREAM}
+AUDIO_FORMATS = {kind: audio_format for audio_format, kind in AUDIO_KINDS.items()}
+
+
+@dataclass
+class CaptureRecord:
+    t: float  # 距離 session 開始的秒數
+    kind: int
+    payload: bytes
+
+    def json(self) -> dict:
+        return json.loads(self.payload)
+
+    def to_message(self) -> dict:
+        """還原成 client 原本送出的訊息"""
+        if self.kind in AUDIO_FORMATS:
+            message = {"type": "audio", "data": base64.b64encode(self.payload).decode("ascii")}
+            if AUDIO_FORMATS[self.kind]:
+                message["format"] = AUDIO_FORMATS[self.kind]
+            return message
+        return self.json()
+
+
+class CaptureWriter:
+    """
+    一個連線的 capture 檔；只在 event loop 上呼叫
+    音訊存解碼後的原始 bytes (不存 base64)，寫滿 max_bytes 就停止記錄
+    檔案只會往後寫，process 中途結束最多少掉最後一筆
+    """
+
+    def __init__(self, path: str, metadata: dict, max_bytes: int = 0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.written = 0
+        self.truncated = False
+        self._start = time.monotonic()
+        self._file = open(path, "ab")
+        header = json.dumps(metadata, ensure_ascii=False).encode("utf-8")
+        self._file.write(MAGIC + struct.pack("<I", len(header)) + header)
+
+    def _write(self, kind: int, payload: bytes) -> None:
+        if self._file is None or self.truncated:
+            return
+        if self.max_bytes and self.written + len(payload) > self.max_bytes and kind != CLOSE:
+            self.truncated = True
+            logger.warning(f"Capture {self.path}: reached {self.max_bytes} bytes, stopped recording")
+            return
+        t_ms = int((time.monotonic() - self._start) * 1000)
+        self._file.write(RECORD_HEADER.pack(t_ms, kind, len(payload)))
+        self._file.write(payload)
+        self.written += RECORD_HEADER.size + len(payload)
+
+    def _write_json(self, kind: int, data: dict) -> None:
+        self._write(kind, json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+    def audio(self, audio_format: Optional[str], data: bytes) -> None:
+        self._write(AUDIO_KINDS.get(audio_format, AUDIO_WEBM), data)
+
+    def control(self, message: dict) -> None:
+        self._write_json(CONTROL, message)
+
+    def dispatch(self, seq: int, size: int) -> None:
+        self._write_json(DISPATCH, {"seq": seq, "bytes": size})
+
+    def result(self, message: dict) -> None:
+        self._write_json(RESULT, message)
+
+    def close(self) -> None:
+        if self._file is None:
+            return
+        self._write(CLOSE, b"")
+        self._file.close()
+        self._file = None
+
+
+def open_capture(session_id: str, metadata: dict) -> Optional[CaptureWriter]:
+    """
+    SESSION_CAPTURE_DIR 有設定才記錄 (預設關閉，capture 檔含使用者的語音)
+    SESSION_CAPTURE_SAMPLE: 記錄多少比例的連線 (0-1)，SESSION_CAPTURE_MAX_MB: 每個連線最多記錄幾 MB
+    """
+    directory = os.getenv("SESSION_CAPTURE_DIR")
+    if not directory:
+        return None
+    if random.random() >= float(os.getenv("SESSION_CAPTURE_SAMPLE", "1.0")):
+        return None
+    try:
+        os.makedirs(directory, exist_ok=True)
+        started = time.time()
+        name = time.strftime("%Y%m%d-%H%M%S", time.localtime(started))
+        path = os.path.join(directory, f"{name}-{session_id}.avcap")
+        metadata = {"session_id": session_id, "started_at": started, **metadata}
+        max_bytes = int(float(os.getenv("SESSION_CAPTURE_MAX_MB", "50")) * 1024 * 1024)
+        writer = CaptureWriter(path, metadata, max_bytes)
+    except OSError as e:
+        logger.error(f"Failed to open session capture: {e}")
+        return None
+    logger.info(f"Session {session_id}: capturing to {path}")
+    return writer
+
+
+def read_capture(path: str) -> tuple[dict, Iterator[CaptureRecord]]:
+    """回傳 (metadata, 依時間排列的紀錄)；檔尾不完整的紀錄 (process 中途結束) 直接略過"""
+    f = open(path, "rb")
+    if f.read(len(MAGIC)) != MAGIC:
+        f.close()
+        raise ValueError(f"{path} is not a session capture")
+    (length,) = struct.unpack("<I", f.read(4))
+    metadata = json.loads(f.read(length))
+
+    def records() -> Iterator[CaptureRecord]:
+        with f:
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                t_ms, kind, size = RECORD_HEADER.unpack(header)
+                payload = f.read(size)
+                if len(payload) < size:
+                    return
+                yield CaptureRecord(t=t_ms / 1000, kind=kind, payload=payload)
+
+    return metadata, records()
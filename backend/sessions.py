@@ -0,0 +1,301 @@
+"""
+WebSocket sessions for AprilVoice
+Each connection gets an id, an outbound queue drained by a single writer task,
+and a share of the server's inference capacity.
+"""
+
+import asyncio
+import logging
+import time
+import uuid
+from typing import Callable, Optional
+
+from fastapi import WebSocket
+
+from cancellation import CancelToken
+from session_capture import CaptureWriter
+
+logger = logging.getLogger(__name__)
+
+# WebSocket close codes
+CLOSE_TRY_AGAIN_LATER = 1013
+CLOSE_POLICY_VIOLATION = 1008
+
+# 連線超過幾秒才用實測的辨識耗時計算用量，之前用預估值
+COST_MEASURE_AFTER = 10.0
+
+
+class ReorderBuffer:
+    """
+    依 seq 順序送出辨識結果
+    chunk 平行辨識，後面的可能先做完；先到的結果暫存，等前面的 seq 都有結果才送出
+    每個發出去的 seq 都必須 complete (沒有結果就傳 None)，否則後面的會一直等
+    辨識途中的段落 (stream) 輪到這個 seq 就馬上送，不用等它 complete
+    """
+
+    def __init__(self, send: Callable[[dict], None]):
+        self._send = send
+        self._issued = 0
+        self.next_seq = 0  # 下一個要送出的 seq
+        self._ready: dict[int, Optional[dict]] = {}
+        self._streamed: dict[int, list[dict]] = {}  # 還沒輪到的 seq 先產生的段落
+
+    def reserve(self) -> int:
+        seq = self._issued
+        self._issued += 1
+        return seq
+
+    def stream(self, seq: int, message: dict) -> None:
+        """seq 還在辨識中產生的訊息 (例如段落)，一定在同一個 seq 的 complete 之前送出"""
+        if seq < self.next_seq or seq in self._ready:
+            return
+        if seq == self.next_seq:
+            self._send(message)
+        else:
+            self._streamed.setdefault(seq, []).append(message)
+
+    def complete(self, seq: int, message: Optional[dict] = None) -> None:
+        if seq < self.next_seq or seq in self._ready:
+            return
+        self._ready[seq] = message
+        while self.next_seq in self._ready:
+            message = self._ready.pop(self.next_seq)
+            if message is not None:
+                self._send(message)
+            self.next_seq += 1
+            # 輪到下一個 seq，先送出它已經產生的段落
+            for streamed in self._streamed.pop(self.next_seq, []):
+                self._send(streamed)
+
+    def skip_issued(self) -> None:
+        """reset: 丟掉還沒送出的結果，已經發出去的 seq 都當作沒有結果"""
+        self._ready.clear()
+        self._streamed.clear()
+        self.next_seq = self._issued
+
+    @property
+    def waiting(self) -> int:
+        """已經做完、還在等前面 seq 的結果數"""
+        return sum(1 for message in self._ready.values() if message is not None)
+
+
+class Session:
+    """
+    單一 WebSocket 連線
+    所有送出的訊息都進 outbound 佇列，由唯一的 writer task 依序送出，
+    慢的 client 只會卡住自己的 writer，不會卡住辨識 task
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        max_outbound: int = 100,
+        send_timeout: float = 10.0,
+        cost_estimate: float = 0.5,
+    ):
+        self.id = uuid.uuid4().hex[:12]
+        self.websocket = websocket
+        self.created_at = time.monotonic()
+        self.send_timeout = send_timeout
+        self.cost_estimate = cost_estimate
+        self.is_connected = True
+        self.inference_seconds = 0.0  # 累計辨識耗時
+        self.slow_consumer = False
+        self._outbound: asyncio.Queue[dict] = asyncio.Queue(maxsize=max_outbound)
+        self._writer: Optional[asyncio.Task] = None
+        self._closing: Optional[asyncio.Task] = None
+        self.reorder = ReorderBuffer(self.send)
+        # 這個連線送出的辨識工作共用的取消旗標；reset 時換一個新的
+        self.token = CancelToken()
+        self.cancelled_jobs = 0
+        # SESSION_CAPTURE_DIR 開啟時記錄這個連線的流量 (replay.py 重播用)
+        self.capture: Optional[CaptureWriter] = None
+
+    def start(self) -> None:
+        self._writer = asyncio.create_task(self._write_loop())
+
+    def send(self, message: dict) -> None:
+        """
+        放進 outbound 佇列，不會阻塞
+        佇列滿了表示 client 跟不上，跟送出逾時一樣以 slow consumer 關閉連線；
+        不丟訊息，丟掉的可能是 final 或後面要取代的段落，client 會少字又不知道
+        """
+        if not self.is_connected:
+            return
+        if self.capture and message.get("type") in ("transcript", "segment"):
+            self.capture.result(message)
+        if self._outbound.full():
+            logger.warning(f"Session {self.id}: outbound queue full, slow consumer, closing")
+            self.slow_consumer = True
+            self.is_connected = False
+            if self._writer:
+                self._writer.cancel()
+            self._closing = asyncio.create_task(self._close(CLOSE_POLICY_VIOLATION, "Slow consumer"))
+            return
+        self._outbound.put_nowait(message)
+
+    async def _write_loop(self) -> None:
+        try:
+            while True:
+                message = await self._outbound.get()
+                try:
+                    await asyncio.wait_for(self.websocket.send_json(message), self.send_timeout)
+                except asyncio.TimeoutError:
+                    self.slow_consumer = True
+                    logger.warning(f"Session {self.id}: slow consumer, closing")
+                    await self._close(CLOSE_POLICY_VIOLATION, "Slow consumer")
+                    return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Session {self.id}: failed to send: {e}")
+            self.is_connected = False
+
+    async def _close(self, code: int, reason: str) -> None:
+        self.is_connected = False
+        try:
+            await self.websocket.close(code=code, reason=reason)
+        except Exception:
+            pass
+
+    def reset_token(self) -> None:
+        """取消目前所有進行中的辨識工作，之後的工作用新的 token"""
+        self.token.cancel()
+        self.token = CancelToken()
+
+    def stop(self) -> None:
+        self.is_connected = False
+        self.token.cancel()
+        if self._writer:
+            self._writer.cancel()
+
+    def record_inference(self, elapsed: float) -> None:
+        self.inference_seconds += elapsed
+
+    @property
+    def measured(self) -> bool:
+        return time.monotonic() - self.created_at >= COST_MEASURE_AFTER
+
+    @property
+    def cost(self) -> float:
+        """
+        這個連線每秒用掉幾秒的辨識時間 (= RTF × 送音訊的時間比例)
+        剛連上還沒有足夠資料時用預估值
+        """
+        if not self.measured:
+            return self.cost_estimate
+        return self.inference_seconds / (time.monotonic() - self.created_at)
+
+    def get_status(self) -> dict:
+        return {
+            "id": self.id,
+            "age": round(time.monotonic() - self.created_at, 1),
+            "cost": round(self.cost, 3),
+            "outbound_queued": self._outbound.qsize(),
+            "next_seq": self.reorder.next_seq,
+            "reorder_waiting": self.reorder.waiting,
+            "cancelled_jobs": self.cancelled_jobs,
+            "slow_consumer": self.slow_consumer,
+        }
+
+
+class SessionRegistry:
+    """
+    以 id 管理所有連線，並做 admission control
+    capacity 以「每秒可用的辨識秒數」計算 (大約等於 inference worker 數)，
+    新連線會讓總用量超過 capacity 就拒絕
+    新連線的用量先用已經量到的連線平均 (實測 RTF × 送音訊的時間比例)，還沒有實測資料時才用 cost_estimate
+    """
+
+    def __init__(self, capacity: float, cost_estimate: float = 0.15, estimate_alpha: float = 0.3):
+        self.capacity = capacity
+        self.cost_estimate = cost_estimate
+        self.estimate_alpha = estimate_alpha
+        self._closed_cost: Optional[float] = None  # 已經結束的連線實測用量 (指數移動平均)
+        self.sessions: dict[str, Session] = {}
+        self.rejected = 0
+        self.draining = False
+
+    @property
+    def load(self) -> float:
+        return sum(session.cost for session in self.sessions.values())
+
+    @property
+    def estimate(self) -> float:
+        """新連線預估的用量"""
+        measured = [session.cost for session in self.sessions.values() if session.measured]
+        if measured:
+            return sum(measured) / len(measured)
+        if self._closed_cost is not None:
+            return self._closed_cost
+        return self.cost_estimate
+
+    async def open(self, websocket: WebSocket) -> Optional[Session]:
+        """接受連線；容量不足時回覆錯誤並關閉，回傳 None"""
+        await websocket.accept()
+
+        load = self.load
+        estimate = self.estimate
+        if self.draining:
+            reason, message = "draining", "Server is shutting down, please reconnect"
+            logger.warning("Rejecting session: server is draining")
+        elif load + estimate > self.capacity:
+            reason, message = "capacity", "Server at capacity, please retry later"
+            logger.warning(
+                f"Rejecting session: load {load:.2f} + {estimate:.2f} > capacity {self.capacity:.2f}"
+            )
+        else:
+            reason = message = None
+
+        if reason:
+            self.rejected += 1
+            try:
+                await websocket.send_json({
+                    "type": "error",
+                    "code": reason,
+                    "message": message
+                })
+                await websocket.close(code=CLOSE_TRY_AGAIN_LATER, reason=f"Server {reason}")
+            except Exception:
+                pass
+            return None
+
+        session = Session(websocket, cost_estimate=estimate)
+        self.sessions[session.id] = session
+        session.start()
+        logger.info(f"Session {session.id} connected. Total: {len(self.sessions)}")
+        return session
+
+    def close(self, session: Session) -> None:
+        # 不 await，handler 在清理途中被取消也一定會移除
+        if session.measured:
+            cost = session.cost
+            self._closed_cost = cost if self._closed_cost is None else (
+                self.estimate_alpha * cost + (1 - self.estimate_alpha) * self._closed_cost
+            )
+        session.stop()
+        self.sessions.pop(session.id, None)
+        logger.info(f"Session {session.id} disconnected. Total: {len(self.sessions)}")
+
+    async def drain(self, timeout: float) -> None:
+        """停止接受新連線，等現有連線自己結束 (最多 timeout 秒)"""
+        self.draining = True
+        deadline = time.monotonic() + timeout
+        logger.info(f"Draining {len(self.sessions)} sessions (timeout {timeout:.0f}s)...")
+        while self.sessions and time.monotonic() < deadline:
+            await asyncio.sleep(0.5)
+        if self.sessions:
+            logger.warning(f"Drain timeout, {len(self.sessions)} sessions still open")
+
+    def get(self, session_id: str) -> Optional[Session]:
+        return self.sessions.get(session_id)
+
+    def get_status(self) -> dict:
+        return {
+            "active": len(self.sessions),
+            "load": round(self.load, 3),
+            "capacity": self.capacity,
+            "estimate": round(self.estimate, 3),
+            "rejected": self.rejected,
+            "sessions": [session.get_status() for session in self.sessions.values()],
+        }
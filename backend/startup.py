@@ -0,0 +1,84 @@
+"""
+Startup profiling for AprilVoice
+Records when the app finished importing, started accepting connections and
+became ready (seconds since process start), plus how long each heavy import,
+model load and cloud provider took, so slow cold starts can be traced.
+"""
+
+import importlib
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+_imported_at = time.monotonic()
+
+
+def process_age() -> float:
+    """process 啟動 (fork 出的 worker 從 fork 算) 到現在的秒數；沒有 /proc 時從這個模組載入開始算"""
+    try:
+        with open("/proc/self/stat") as f:
+            # comm 可能含空白，從最後一個 ")" 之後算；starttime 是第 22 個欄位
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return time.monotonic() - _imported_at
+
+
+class StartupProfile:
+    """啟動里程碑 (process 啟動後幾秒) 與各階段耗時，/startup 回傳 get_status()"""
+
+    def __init__(self):
+        self.marks: dict[str, float] = {}
+        self.durations: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def mark(self, name: str) -> None:
+        age = process_age()
+        self.marks[name] = round(age, 3)
+        logger.info(f"Startup: {name} at {age:.2f}s")
+
+    def record(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.durations[name] = round(seconds, 3)
+
+    @contextmanager
+    def phase(self, name: str):
+        """記錄 with 區塊的耗時 (async 函式裡也可以用，區塊內可以 await)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.record(name, elapsed)
+            logger.info(f"Startup: {name} took {elapsed:.2f}s")
+
+    def get_status(self) -> dict:
+        with self._lock:
+            durations = sorted(self.durations.items(), key=lambda item: item[1], reverse=True)
+        return {"marks": self.marks, "durations": dict(durations)}
+
+
+profile = StartupProfile()
+
+
+def timed_import(name: str):
+    """
+    import 重量級模組 (模型引擎、雲端 SDK) 並記錄耗時；已經載入的直接回傳
+    在 asyncio.to_thread 裡呼叫，import 期間 event loop 照常回應
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    elapsed = time.perf_counter() - start
+    profile.record(f"import {name}", elapsed)
+    logger.info(f"Imported {name} in {elapsed:.2f}s")
+    return module
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 後端模組是平的 (python main.py 在 backend/ 執行)，測試也從 backend/ import
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
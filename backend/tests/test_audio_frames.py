@@ -0,0 +1,56 @@
+"""PCM frame pipeline: 每個 chunk 不應該再配置一份 PCM 或 float32 陣列"""
+
+import random
+import tracemalloc
+
+from asr_service import pcm_to_float32
+from audio_frames import BufferPool, FrameAssembler
+
+FRAME_BYTES = 3200  # 前端每 100ms 送一個 frame
+CHUNK_BYTES = 48000  # PCM_CHUNK_SECONDS = 1.5
+
+
+def socket_frames() -> list[bytes]:
+    rng = random.Random(0)
+    return [rng.randbytes(FRAME_BYTES) for _ in range(CHUNK_BYTES // FRAME_BYTES)]
+
+
+def test_chunk_allocations_stay_below_one_copy():
+    frames = socket_frames()
+    assembler = FrameAssembler(CHUNK_BYTES)
+
+    def chunk():
+        for data in frames:
+            for frame in assembler.append(data):
+                pcm_to_float32(frame.data)
+                frame.release()
+
+    chunk()  # 預熱: pool 的 buffer 與 thread 的 float32 buffer 第一次配置
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(20):
+            baseline, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            chunk()
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - baseline)
+    finally:
+        tracemalloc.stop()
+
+    # 複製一次 PCM (48000 bytes) 或轉一次 float32 (96000 bytes) 就會超過
+    assert max(peaks) < CHUNK_BYTES // 4, peaks
+    assert assembler.pool.allocated == 1
+
+
+def test_buffer_returns_to_pool_after_last_release():
+    pool = BufferPool(FRAME_BYTES)
+    assembler = FrameAssembler(FRAME_BYTES, pool=pool)
+    (frame,) = assembler.append(bytes(FRAME_BYTES))
+
+    frame.retain()  # 送進 executor 的工作
+    frame.release()  # session 放手，工作還在讀
+    assert pool.acquire() is not frame.buffer
+
+    frame.release()  # 工作結束
+    assert pool.acquire() is frame.buffer
@@ -0,0 +1,71 @@
+"""雲端提供商收到的 PCM 一定是 bytes；pool buffer 的 memoryview 只給在工作裡同步讀完的本地引擎"""
+
+import asyncio
+
+from asr_service import ASRService, TranscriptionResult
+from audio_frames import BufferPool, FrameAssembler
+from cloud_asr import MultiProviderASRService
+
+
+class BytesOnlyService(ASRService):
+    """跟 Google 的 RecognitionAudio(content=...) 一樣，bytes 欄位不收 memoryview"""
+
+    def __init__(self, text: str = "好"):
+        self.text = text
+        self.received: list[bytes] = []
+
+    async def initialize(self) -> None:
+        pass
+
+    async def transcribe(self, audio_data: bytes) -> TranscriptionResult:
+        raise AssertionError("PCM should not be re-encoded")
+
+    async def transcribe_pcm(self, pcm_data: bytes) -> TranscriptionResult:
+        if not isinstance(pcm_data, bytes):
+            raise TypeError(f"bytes expected, got {type(pcm_data).__name__}")
+        self.received.append(pcm_data)
+        return TranscriptionResult(text=self.text, is_final=True)
+
+    async def reset(self) -> None:
+        pass
+
+
+def pooled_frame(pool: BufferPool):
+    assembler = FrameAssembler(frame_bytes=3200, pool=pool)
+    (frame,) = assembler.append(bytes(range(256)) * 12 + bytes(128))
+    return frame
+
+
+def test_pooled_frame_reaches_cloud_provider_as_bytes():
+    pool = BufferPool(3200)
+    frame = pooled_frame(pool)
+    expected = bytes(frame.data)
+
+    service = MultiProviderASRService()
+    provider = BytesOnlyService()
+    service.add_provider("google", provider)
+    result = asyncio.run(service.transcribe_pcm(frame.data))
+
+    assert result.text == "好"
+    assert provider.received == [expected]
+
+    # 工作結束後 buffer 回到 pool 被下一個 chunk 覆寫，提供商拿到的資料不受影響
+    frame.release()
+    reused = pool.acquire()
+    reused[:] = bytes(len(reused))
+    assert provider.received == [expected]
+
+
+def test_fallback_providers_get_the_same_bytes():
+    pool = BufferPool(3200)
+    frame = pooled_frame(pool)
+
+    service = MultiProviderASRService()
+    empty, second = BytesOnlyService(text=""), BytesOnlyService()
+    service.add_provider("azure", empty, priority=0)
+    service.add_provider("gemini", second, priority=1)
+    result = asyncio.run(service.transcribe_pcm(frame.data))
+
+    assert result.text == "好"
+    assert empty.received == second.received == [bytes(frame.data)]
+    frame.release()
@@ -0,0 +1,28 @@
+"""InferenceScheduler 的 quantum：必須是正數，cost 比 quantum 大的工作累積幾輪額度後照樣執行"""
+
+import asyncio
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from scheduler import InferenceScheduler, Priority
+
+
+@pytest.mark.parametrize("quantum", [0, 0.0, -1.5, math.nan])
+def test_rejects_non_positive_quantum(quantum):
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        with pytest.raises(ValueError):
+            InferenceScheduler(executor, workers=1, quantum=quantum)
+
+
+def test_job_costing_several_quanta_still_runs():
+    async def scenario():
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            scheduler = InferenceScheduler(executor, workers=1, quantum=0.5)
+            return await asyncio.wait_for(
+                scheduler.run(lambda: "done", priority=Priority.FINAL, flow="session", cost=3.0), timeout=5
+            )
+
+    assert asyncio.run(scenario()) == "done"
+
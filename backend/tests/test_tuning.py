@@ -0,0 +1,59 @@
+"""背景 CPU 調校完成後 (apply_tuning) 換掉 executor，之後的 batch 工作仍然要能執行"""
+
+import asyncio
+import os
+import shutil
+
+import numpy as np
+
+import batch_jobs
+import main
+from asr_service import MockASRService
+from batch_jobs import JobManager
+from tuning import TuningConfig
+
+
+def test_batch_job_runs_after_apply_tuning(tmp_path, monkeypatch):
+    # 測試不需要 ffmpeg：輸入已經是 16kHz int16 PCM，直接當作解碼結果
+    def decode_audio_file(input_path: str, output_path: str, timeout: float = 3600) -> int:
+        shutil.copyfile(input_path, output_path)
+        return os.path.getsize(output_path)
+
+    monkeypatch.setattr(batch_jobs, "decode_audio_file", decode_audio_file)
+    monkeypatch.setenv("SESSION_CAPACITY", str(main.sessions.capacity))
+
+    def recording(name: str) -> str:
+        """JobManager 處理完會刪掉檔案，每個 job 各給一個"""
+        path = tmp_path / name
+        samples = np.random.default_rng(0).standard_normal(16000 * 3) * 3000
+        path.write_bytes(samples.astype(np.int16).tobytes())
+        return str(path)
+
+    original = main.EXECUTOR_WORKERS
+
+    async def scenario():
+        service = MockASRService(latency="fixed:0")
+        await service.initialize()
+        manager = JobManager(get_service=lambda: service, scheduler=main.scheduler)
+        manager.start()
+        try:
+            queued = manager.submit(recording("queued.pcm"), "queued.pcm")  # 調校完成時還在排隊
+            previous = main.scheduler.executor
+            main.apply_tuning(TuningConfig(cpu_threads=1, workers=original + 1))
+            assert main.scheduler.executor is not previous
+            assert main.scheduler.workers == original + 1
+
+            submitted = manager.submit(recording("after.pcm"), "after.pcm")
+            jobs = [queued, submitted]
+            for _ in range(500):
+                if all(job.status in ("done", "failed") for job in jobs):
+                    break
+                await asyncio.sleep(0.01)
+            return jobs
+        finally:
+            await manager.stop()
+            main.apply_tuning(TuningConfig(cpu_threads=1, workers=original))
+
+    for job in asyncio.run(scenario()):
+        assert job.status == "done", job.error
+        assert job.completed_segments == len(job.segments) > 0
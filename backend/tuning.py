@@ -0,0 +1,347 @@
+"""
+CPU tuning for AprilVoice
+Benchmarks cpu_threads x inference workers x compute_type for faster-whisper on this host,
+saves the best combination and applies it at startup.
+Run: python tuning.py --model small --objective throughput --audio speech.wav [--processes 4] [--pin-cores]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TUNING_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "asr_tuning.json")
+DEFAULT_WORKERS = 2
+
+
+def available_cores() -> list[int]:
+    """這個 process 可以用的 CPU (會考慮 taskset / cgroup cpuset)"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def host_id() -> str:
+    """設定檔只套用在同一種機器上；換機器或 CPU 數改變就要重新調校"""
+    return f"{platform.machine()}/{len(available_cores())}cpu"
+
+
+@dataclass
+class TuningConfig:
+    """一組 CPU 設定；workers 是每個 process 同時辨識的數量 (executor 與 CTranslate2 num_workers)"""
+    cpu_threads: int
+    workers: int
+    compute_type: str = "int8"
+    pin_cores: bool = False  # serve.py 的每個 worker process 綁定不重疊的核心
+    processes: int = 1  # 調校時假設的 serve.py worker 數，核心平均分給每個 process
+    objective: str = "throughput"
+    model_size: Optional[str] = None
+    host: str = field(default_factory=host_id)
+    # 調校結果 (未調校為空)
+    throughput: Optional[float] = None  # 每秒處理幾秒音訊
+    latency_p50: Optional[float] = None
+    latency_p95: Optional[float] = None
+
+
+def default_tuning() -> TuningConfig:
+    """
+    沒有調校結果時的設定，可用環境變數覆寫
+    執行緒數以核心數平均分給 worker，不再固定 4 個 (小機器不會超賣，大機器不會閒置)
+    """
+    workers = int(os.getenv("EXECUTOR_WORKERS", str(DEFAULT_WORKERS)))
+    cores = len(available_cores())
+    threads = int(os.getenv("ASR_CPU_THREADS", "0")) or max(1, min(4, cores // workers))
+    return TuningConfig(
+        cpu_threads=threads,
+        workers=workers,
+        compute_type=os.getenv("ASR_COMPUTE_TYPE", "int8"),
+        pin_cores=os.getenv("ASR_PIN_CORES", "0") == "1",
+    )
+
+
+def load_tuning(path: Optional[str] = None) -> Optional[TuningConfig]:
+    """讀取調校結果；不存在或是其他機器的結果回傳 None"""
+    path = path or os.getenv("ASR_TUNING_FILE", DEFAULT_TUNING_PATH)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    config = {k: v for k, v in config.items() if not k.startswith("_")}
+    tuning = TuningConfig(**config)
+    if tuning.host != host_id():
+        logger.warning(f"Ignoring {path}: tuned on {tuning.host}, this host is {host_id()}")
+        return None
+    return tuning
+
+
+def save_tuning(tuning: TuningConfig, path: Optional[str] = None) -> str:
+    path = path or os.getenv("ASR_TUNING_FILE", DEFAULT_TUNING_PATH)
+    config = {"_comment": "python tuning.py 產生，換機器後重新執行；刪除這個檔案就回到預設值"}
+    config.update(asdict(tuning))
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(config, f, indent=2, ensure_ascii=False)
+    return path
+
+
+_active: Optional[TuningConfig] = None
+
+
+def active_tuning() -> TuningConfig:
+    """目前使用的設定: 調校結果 > 預設值 (不會在這裡跑調校，import 時呼叫也很快)"""
+    global _active
+    if _active is None:
+        _active = load_tuning() or default_tuning()
+        _log_tuning(_active)
+    return _active
+
+
+def _log_tuning(tuning: TuningConfig) -> None:
+    logger.info(
+        f"CPU tuning: {tuning.workers} workers x {tuning.cpu_threads} threads, "
+        f"{tuning.compute_type}{', pinned' if tuning.pin_cores else ''}"
+    )
+
+
+def run_autotune() -> Optional[TuningConfig]:
+    """
+    ASR_AUTOTUNE=1 且這台機器還沒有調校結果時，跑一次調校並存檔 (會花幾分鐘)，之後 active_tuning() 回傳新的設定
+    在啟動的背景工作裡 (port 已經開始接受連線、模型還沒載入) 呼叫；
+    serve.py 的多個 worker 用檔案鎖排隊，只有第一個會調校，其他的等它存檔後直接讀取
+    需要 ASR_TUNING_AUDIO 指定一段真實語音 (合成音訊測不出實際的解碼量)，沒有就不調校
+    回傳新套用的設定，沒有變更回傳 None
+    """
+    global _active
+    if os.getenv("ASR_AUTOTUNE", "0") != "1" or load_tuning() is not None:
+        return None
+    audio_path = os.getenv("ASR_TUNING_AUDIO")
+    if not audio_path:
+        logger.warning("ASR_AUTOTUNE=1 needs ASR_TUNING_AUDIO (a real speech sample), using default CPU settings")
+        return None
+
+    path = os.getenv("ASR_TUNING_FILE", DEFAULT_TUNING_PATH)
+    with open(path + ".lock", "w") as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        # 等鎖的期間其他 worker 可能已經調校完
+        tuning = load_tuning()
+        if tuning is None:
+            tuning = autotune(
+                model_size=os.getenv("ASR_TUNING_MODEL", "small"),
+                objective=os.getenv("ASR_TUNING_OBJECTIVE", "throughput"),
+                processes=int(os.getenv("WORKERS", "1")),
+                audio_path=audio_path,
+            )
+            save_tuning(tuning)
+    _active = tuning
+    _log_tuning(tuning)
+    return tuning
+
+
+def worker_cores(index: int, processes: int) -> list[int]:
+    """serve.py 第 index 個 worker 綁定的核心: 可用核心平均切成 processes 份"""
+    cores = available_cores()
+    share = max(1, len(cores) // processes)
+    start = (index * share) % len(cores)
+    return cores[start:start + share]
+
+
+def pin_worker(index: int, processes: int) -> Optional[list[int]]:
+    """把目前 process (與之後建立的 thread) 綁到自己的核心上；不支援的平台回傳 None"""
+    if not hasattr(os, "sched_setaffinity"):
+        return None
+    cores = worker_cores(index, processes)
+    os.sched_setaffinity(0, cores)
+    return cores
+
+
+# --- 調校 ---
+
+def candidate_configs(cores: int, compute_types: list[str], max_workers: int = 4) -> list[TuningConfig]:
+    """workers x cpu_threads 不超過核心數的所有組合 (threads 取 2 的次方)"""
+    candidates = []
+    threads_options = []
+    threads = 1
+    while threads <= cores:
+        threads_options.append(threads)
+        threads *= 2
+    for compute_type in compute_types:
+        for workers in range(1, min(max_workers, cores) + 1):
+            for threads in threads_options:
+                if workers * threads <= cores:
+                    candidates.append(TuningConfig(cpu_threads=threads, workers=workers,
+                                                   compute_type=compute_type))
+    return candidates
+
+
+def measure(config: TuningConfig, model_size: str, pcm: bytes, seconds: float) -> TuningConfig:
+    """
+    用這組設定載入模型，config.workers 個 thread 同時辨識同一段音訊 seconds 秒
+    記錄吞吐量 (音訊秒數 / 牆上時間) 與每次辨識的延遲
+    關掉 VAD：整段音訊都要經過模型，不會因為 VAD 把測試音訊濾掉而只量到前處理
+    """
+    from asr_service import FasterWhisperService
+
+    service = FasterWhisperService(
+        model_size=model_size,
+        cpu_threads=config.cpu_threads,
+        compute_type=config.compute_type,
+        num_workers=config.workers,
+        vad_filter=False,
+    )
+    asyncio.run(service.initialize())
+    audio_seconds = len(pcm) / 32000
+    asyncio.run(service.transcribe_pcm(pcm))  # 預熱
+
+    latencies: list[float] = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def worker():
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            asyncio.run(service.transcribe_pcm(pcm))
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(config.workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    latencies.sort()
+    config.throughput = len(latencies) * audio_seconds / wall
+    config.latency_p50 = latencies[len(latencies) // 2]
+    config.latency_p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    return config
+
+
+def _score(config: TuningConfig, objective: str) -> tuple:
+    if objective == "latency":
+        return (-config.latency_p95, config.throughput)
+    return (config.throughput, -config.latency_p95)
+
+
+def autotune(
+    model_size: str = "small",
+    objective: str = "throughput",
+    compute_types: Optional[list[str]] = None,
+    processes: int = 1,
+    seconds: float = 10.0,
+    audio_path: Optional[str] = None,
+    pin_cores: bool = False,
+    max_workers: int = 4,
+) -> TuningConfig:
+    """
+    在這台機器上測試所有組合，回傳 objective 最好的設定
+    processes > 1 時只用 1/processes 的核心測試 (serve.py 每個 worker 分到的份量)
+    """
+    compute_types = compute_types or ["int8", "float32"]
+    if not audio_path:
+        logger.warning("No --audio given: tuning with synthetic audio, decoding cost will not match real speech")
+    pcm = _tuning_audio(audio_path)
+    cores = available_cores()
+    budget = max(1, len(cores) // processes)
+    if hasattr(os, "sched_setaffinity") and processes > 1:
+        os.sched_setaffinity(0, cores[:budget])
+
+    logger.info(f"Tuning {model_size} on {host_id()} ({budget} cores per process, objective={objective})")
+    results = []
+    try:
+        for config in candidate_configs(budget, compute_types, max_workers):
+            try:
+                measure(config, model_size, pcm, seconds)
+            except Exception as e:
+                logger.warning(f"  {config.compute_type} {config.workers}x{config.cpu_threads}: failed ({e})")
+                continue
+            results.append(config)
+            logger.info(
+                f"  {config.compute_type:<8} workers={config.workers} threads={config.cpu_threads:<2} "
+                f"throughput={config.throughput:5.2f}x  p50={config.latency_p50:.3f}s  p95={config.latency_p95:.3f}s"
+            )
+    finally:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cores)
+
+    if not results:
+        raise RuntimeError("No configuration could be benchmarked")
+    best = max(results, key=lambda config: _score(config, objective))
+    best.objective = objective
+    best.model_size = model_size
+    best.processes = processes
+    best.pin_cores = pin_cores
+    return best
+
+
+def _tuning_audio(audio_path: Optional[str]) -> bytes:
+    """調校用的音訊: 指定的檔案 (真實語音) 或一段合成音訊，長度跟一個 chunk 差不多"""
+    import numpy as np
+
+    chunk_bytes = int(float(os.getenv("PCM_CHUNK_SECONDS", "1.5")) * 32000)
+    if audio_path:
+        import tempfile
+        from asr_service import decode_audio_file
+
+        fd, output_path = tempfile.mkstemp(suffix=".pcm")
+        os.close(fd)
+        try:
+            decode_audio_file(audio_path, output_path)
+            with open(output_path, "rb") as f:
+                return f.read(chunk_bytes)
+        finally:
+            os.unlink(output_path)
+
+    rng = np.random.default_rng(0)
+    t = np.arange(chunk_bytes // 2) / 16000
+    audio = 0.3 * np.sin(2 * np.pi * (160 + 40 * np.sin(np.pi * t)) * t) + 0.02 * rng.standard_normal(len(t))
+    return (audio * 32767).astype(np.int16).tobytes()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Tune faster-whisper CPU settings for this host")
+    parser.add_argument("--model", default="small")
+    parser.add_argument("--objective", choices=["throughput", "latency"], default="throughput",
+                        help="throughput = most audio per second, latency = lowest p95 per chunk")
+    parser.add_argument("--compute-types", nargs="+", default=["int8", "float32"])
+    parser.add_argument("--processes", type=int, default=int(os.getenv("WORKERS", "1")),
+                        help="serve.py --workers the result is meant for")
+    parser.add_argument("--max-workers", type=int, default=4, help="largest inference worker count to try")
+    parser.add_argument("--seconds", type=float, default=10, help="benchmark time per combination")
+    parser.add_argument("--audio", help="real speech to benchmark with (synthetic audio if omitted)")
+    parser.add_argument("--pin-cores", action="store_true", help="pin each serve.py worker to its own cores")
+    parser.add_argument("--output", help=f"where to save the result (default {DEFAULT_TUNING_PATH})")
+    args = parser.parse_args()
+
+    best = autotune(
+        model_size=args.model,
+        objective=args.objective,
+        compute_types=args.compute_types,
+        processes=args.processes,
+        seconds=args.seconds,
+        audio_path=args.audio,
+        pin_cores=args.pin_cores,
+        max_workers=args.max_workers,
+    )
+    path = save_tuning(best, args.output)
+    print(f"best: {best.compute_type} workers={best.workers} threads={best.cpu_threads} "
+          f"throughput={best.throughput:.2f}x p95={best.latency_p95:.3f}s -> {path}")
+
+
+if __name__ == "__main__":
+    main()
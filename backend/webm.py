@@ -0,0 +1,276 @@
+"""
+Minimal WebM (Matroska/EBML) reader for AprilVoice
+Reads timing information from MediaRecorder chunks without decoding the audio.
+"""
+
+import struct
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+# EBML element IDs (含長度標記位元)
+EBML_HEADER = 0x1A45DFA3
+SEGMENT = 0x18538067
+INFO = 0x1549A966
+TIMECODE_SCALE = 0x2AD7B1
+DURATION = 0x4489
+TRACKS = 0x1654AE6B
+TRACK_ENTRY = 0xAE
+TRACK_NUMBER = 0xD7
+CODEC_ID = 0x86
+CODEC_PRIVATE = 0x63A2
+CLUSTER = 0x1F43B675
+CLUSTER_TIMECODE = 0xE7
+SIMPLE_BLOCK = 0xA3
+BLOCK_GROUP = 0xA0
+BLOCK = 0xA1
+
+# 只進到這些 master element 裡面，其他的照 size 跳過
+# MediaRecorder 的 Segment / Cluster 大小是 unknown，所以不依賴 size，直接攤平往下讀
+MASTER_ELEMENTS = {SEGMENT, INFO, TRACKS, TRACK_ENTRY, CLUSTER, BLOCK_GROUP}
+
+UNKNOWN_SIZE = -1
+UNKNOWN_SIZE_VINT = b"\x01\xff\xff\xff\xff\xff\xff\xff"
+
+
+def read_vint(data, pos: int, keep_marker: bool = False) -> Optional[tuple[int, int]]:
+    """讀一個 EBML 可變長度整數，回傳 (值, 長度)；資料不夠回傳 None"""
+    if pos >= len(data):
+        return None
+    first = data[pos]
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first & mask:
+        length += 1
+        mask >>= 1
+    if length > 8 or pos + length > len(data):
+        return None
+
+    value = first if keep_marker else first & (mask - 1)
+    for byte in data[pos + 1:pos + length]:
+        value = (value << 8) | byte
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        value = UNKNOWN_SIZE
+    return value, length
+
+
+def iter_elements(data, pos: int = 0) -> Iterator[tuple[int, int, int, int]]:
+    """
+    依序走過所有 element，回傳 (id, header 開始位置, data 開始位置, data 大小)
+    master element 只回傳 header 就往裡面走；最後一個不完整的 element 不回傳
+    """
+    while pos < len(data):
+        element_id = read_vint(data, pos, keep_marker=True)
+        if element_id is None:
+            return
+        size = read_vint(data, pos + element_id[1])
+        if size is None:
+            return
+        element_id, id_length = element_id
+        size, size_length = size
+        data_start = pos + id_length + size_length
+
+        if element_id in MASTER_ELEMENTS:
+            yield element_id, pos, data_start, size
+            pos = data_start
+            continue
+        if size == UNKNOWN_SIZE or data_start + size > len(data):
+            return
+        yield element_id, pos, data_start, size
+        pos = data_start + size
+
+
+def read_uint(data, start: int, size: int) -> int:
+    return int.from_bytes(data[start:start + size], "big")
+
+
+def read_float(data, start: int, size: int) -> float:
+    return struct.unpack(">f" if size == 4 else ">d", bytes(data[start:start + size]))[0]
+
+
+def opus_packet_duration(packet) -> float:
+    """由 Opus TOC byte 算出一個 packet 的長度 (秒)，RFC 6716 3.1"""
+    if not packet:
+        return 0.0
+    toc = packet[0]
+    config = toc >> 3
+    if config < 12:  # SILK
+        frame = (0.010, 0.020, 0.040, 0.060)[config % 4]
+    elif config < 16:  # Hybrid
+        frame = (0.010, 0.020)[config % 2]
+    else:  # CELT
+        frame = (0.0025, 0.005, 0.010, 0.020)[config % 4]
+
+    code = toc & 0x03
+    if code == 0:
+        frames = 1
+    elif code in (1, 2):
+        frames = 2
+    else:
+        frames = packet[1] & 0x3F if len(packet) > 1 else 0
+    return frame * frames
+
+
+def parse_block(data, start: int, size: int) -> Optional[tuple[int, int, int]]:
+    """SimpleBlock / Block: 回傳 (track number, 相對 timecode, frame data 開始位置)"""
+    track = read_vint(data, start)
+    if track is None or track[1] + 3 > size:
+        return None
+    header = start + track[1]
+    relative = struct.unpack(">h", bytes(data[header:header + 2]))[0]
+    return track[0], relative, header + 3
+
+
+def webm_duration(data) -> Optional[float]:
+    """
+    從容器資訊取得音訊長度 (秒)，不需要解碼
+    有 Info/Duration 就直接用；MediaRecorder 的 chunk 通常沒有，改用第一個到最後一個 block 的 timecode
+    加上最後一個 Opus packet 的長度。不是 WebM 或看不出長度時回傳 None
+    """
+    if len(data) < 4 or read_uint(data, 0, 4) != EBML_HEADER:
+        return None
+
+    timecode_scale = 1_000_000  # ns，預設 1ms
+    declared = None
+    codec = None
+    cluster_timecode = 0
+    first = last = None
+    last_packet = None
+
+    for element_id, _, start, size in iter_elements(data):
+        if element_id == TIMECODE_SCALE:
+            timecode_scale = read_uint(data, start, size)
+        elif element_id == DURATION:
+            declared = read_float(data, start, size)
+        elif element_id == CODEC_ID:
+            codec = bytes(data[start:start + size]).decode("ascii", "replace")
+        elif element_id == CLUSTER_TIMECODE:
+            cluster_timecode = read_uint(data, start, size)
+        elif element_id in (SIMPLE_BLOCK, BLOCK):
+            block = parse_block(data, start, size)
+            if block is None:
+                continue
+            _, relative, frame_start = block
+            timecode = cluster_timecode + relative
+            if first is None or timecode < first:
+                first = timecode
+            if last is None or timecode >= last:
+                last = timecode
+                last_packet = (frame_start, start + size)
+
+    scale = timecode_scale / 1e9
+    if declared:
+        return declared * scale
+    if first is None:
+        return None
+
+    duration = (last - first) * scale
+    if codec == "A_OPUS" and last_packet:
+        duration += opus_packet_duration(data[last_packet[0]:last_packet[1]])
+    return duration
+
+
+@dataclass
+class AudioPacket:
+    timestamp: float  # 秒，相對於串流開始
+    data: bytes
+
+
+class WebMStreamDemuxer:
+    """
+    單一連續 MediaRecorder 串流的增量 demuxer
+    只有第一個 chunk 帶 EBML header 與 Tracks，之後的 chunk 只是接下去的 cluster，而且可能切在 element 中間
+    header 保留在 self.header；每次 feed 只回傳新完成的 block，不完整的部分留到下一次
+    """
+
+    def __init__(self, keep_media: bool = False):
+        self.header = b""  # 第一個 Cluster 之前的所有 bytes
+        self.codec: Optional[str] = None
+        self.codec_private: Optional[bytes] = None
+        self.timecode_scale = 1_000_000
+        # keep_media=True 時保留 header 之後完整的 element，可以接在 header 後面組成合法的 WebM
+        self.keep_media = keep_media
+        self._media = bytearray()
+        self._buffer = bytearray()
+        self._in_header = True
+        self._track: Optional[int] = None
+        self._entry_track: Optional[int] = None
+        self._cluster_timecode = 0
+        self._cluster_timecode_element = b""
+        self._media_prefix = b""  # take_media 從 cluster 中間開始時補上的 cluster header
+
+    @property
+    def ready(self) -> bool:
+        """已經讀到 Tracks，知道 codec"""
+        return self.codec is not None
+
+    def feed(self, data: bytes) -> list[AudioPacket]:
+        self._buffer.extend(data)
+        if self._in_header and len(self._buffer) >= 4 and read_uint(self._buffer, 0, 4) != EBML_HEADER:
+            raise ValueError("Stream does not start with an EBML header")
+
+        packets = []
+        consumed = 0
+        for element_id, header_start, start, size in iter_elements(self._buffer):
+            if element_id == CLUSTER and self._in_header:
+                self.header = bytes(self._buffer[:header_start])
+                self._in_header = False
+                consumed = header_start
+
+            if element_id in MASTER_ELEMENTS:
+                end = start
+            else:
+                end = start + size
+                self._read_element(element_id, start, size, packets)
+                if element_id == CLUSTER_TIMECODE:
+                    self._cluster_timecode_element = bytes(self._buffer[header_start:end])
+
+            if not self._in_header and self.keep_media:
+                self._media.extend(self._buffer[consumed:end])
+            consumed = end
+
+        if not self._in_header:
+            del self._buffer[:consumed]
+        return packets
+
+    def take_media(self) -> bytes:
+        """
+        取出上次之後完整的 element (需要 keep_media=True)，接在 header 後面就是合法的 WebM
+        從 cluster 中間開始的話，前面補一個 unknown size 的 cluster header
+        """
+        media = bytes(self._media)
+        self._media.clear()
+        if media and read_uint(media, 0, 4) != CLUSTER:
+            if read_uint(media, 0, 1) == CLUSTER_TIMECODE:
+                media = CLUSTER.to_bytes(4, "big") + UNKNOWN_SIZE_VINT + media
+            else:
+                media = self._media_prefix + media
+        self._media_prefix = (
+            CLUSTER.to_bytes(4, "big") + UNKNOWN_SIZE_VINT + self._cluster_timecode_element
+        )
+        return media
+
+    def _read_element(self, element_id: int, start: int, size: int, packets: list) -> None:
+        data = self._buffer
+        if element_id == TIMECODE_SCALE:
+            self.timecode_scale = read_uint(data, start, size)
+        elif element_id == TRACK_NUMBER:
+            self._entry_track = read_uint(data, start, size)
+        elif element_id == CODEC_ID:
+            codec = bytes(data[start:start + size]).decode("ascii", "replace")
+            if codec.startswith("A_") and self.codec is None:
+                self.codec = codec
+                self._track = self._entry_track
+        elif element_id == CODEC_PRIVATE:
+            if self._entry_track == self._track:
+                self.codec_private = bytes(data[start:start + size])
+        elif element_id == CLUSTER_TIMECODE:
+            self._cluster_timecode = read_uint(data, start, size)
+        elif element_id in (SIMPLE_BLOCK, BLOCK):
+            block = parse_block(data, start, size)
+            if block is None:
+                return
+            track, relative, frame_start = block
+            if self._track is not None and track != self._track:
+                return
+            timecode = (self._cluster_timecode + relative) * self.timecode_scale / 1e9
+            packets.append(AudioPacket(timecode, bytes(data[frame_start:start + size])))
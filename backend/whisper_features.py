@@ -0,0 +1,186 @@
+"""
+Whisper input features for AprilVoice
+Log-mel spectrogram in numpy, matching openai-whisper / the HF feature extractor,
+for engines that run the raw encoder (ONNX Runtime) instead of faster-whisper.
+"""
+
+import functools
+
+import numpy as np
+
+SAMPLE_RATE = 16000
+N_FFT = 400
+HOP_LENGTH = 160
+CHUNK_SECONDS = 30  # Whisper 一次看 30 秒
+N_SAMPLES = CHUNK_SECONDS * SAMPLE_RATE
+N_FRAMES = N_SAMPLES // HOP_LENGTH  # 3000
+
+
+def _hz_to_mel(freq: np.ndarray) -> np.ndarray:
+    """Slaney mel scale (librosa 預設，Whisper 訓練時用的)：1 kHz 以下線性、以上對數"""
+    f_sp = 200.0 / 3
+    min_log_hz = 1000.0
+    min_log_mel = min_log_hz / f_sp
+    logstep = np.log(6.4) / 27.0
+    freq = np.asarray(freq, dtype=np.float64)
+    mels = freq / f_sp
+    log_region = freq >= min_log_hz
+    mels[log_region] = min_log_mel + np.log(freq[log_region] / min_log_hz) / logstep
+    return mels
+
+
+def _mel_to_hz(mels: np.ndarray) -> np.ndarray:
+    f_sp = 200.0 / 3
+    min_log_hz = 1000.0
+    min_log_mel = min_log_hz / f_sp
+    logstep = np.log(6.4) / 27.0
+    mels = np.asarray(mels, dtype=np.float64)
+    freqs = f_sp * mels
+    log_region = mels >= min_log_mel
+    freqs[log_region] = min_log_hz * np.exp(logstep * (mels[log_region] - min_log_mel))
+    return freqs
+
+
+@functools.lru_cache(maxsize=None)
+def mel_filters(n_mels: int = 80) -> np.ndarray:
+    """(n_mels, N_FFT // 2 + 1) 的三角濾波器，等同 librosa.filters.mel(sr=16000, n_fft=400, norm="slaney")"""
+    fft_freqs = np.linspace(0, SAMPLE_RATE / 2, N_FFT // 2 + 1)
+    mel_points = _mel_to_hz(np.linspace(_hz_to_mel(np.array([0.0]))[0],
+                                        _hz_to_mel(np.array([SAMPLE_RATE / 2]))[0], n_mels + 2))
+    widths = np.diff(mel_points)
+    ramps = mel_points[:, None] - fft_freqs[None, :]
+    lower = -ramps[:-2] / widths[:-1, None]
+    upper = ramps[2:] / widths[1:, None]
+    weights = np.maximum(0, np.minimum(lower, upper))
+    weights *= (2.0 / (mel_points[2:] - mel_points[:-2]))[:, None]
+    return weights.astype(np.float32)
+
+
+@functools.lru_cache(maxsize=None)
+def _window() -> np.ndarray:
+    # periodic Hann (torch.hann_window 預設)
+    return (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(N_FFT) / N_FFT)).astype(np.float32)
+
+
+def pad_or_trim(audio: np.ndarray, length: int = N_SAMPLES) -> np.ndarray:
+    if len(audio) >= length:
+        return audio[:length]
+    padded = np.zeros(length, dtype=np.float32)
+    padded[:len(audio)] = audio
+    return padded
+
+
+def log_mel_spectrogram(audio: np.ndarray, n_mels: int = 80) -> np.ndarray:
+    """
+    float32 [-1, 1) 音訊 -> (n_mels, frames) log-mel
+    呼叫端先用 pad_or_trim 補到 30 秒，就是 encoder 要的 (n_mels, 3000)
+    """
+    padded = np.pad(audio, N_FFT // 2, mode="reflect")
+    n_frames = 1 + (len(padded) - N_FFT) // HOP_LENGTH
+    frames = np.lib.stride_tricks.as_strided(
+        padded,
+        shape=(n_frames, N_FFT),
+        strides=(padded.strides[0] * HOP_LENGTH, padded.strides[0]),
+        writeable=False,
+    )
+    spectrum = np.fft.rfft(frames * _window(), axis=-1)
+    # Whisper 丟掉最後一個 frame
+    power = (spectrum.real ** 2 + spectrum.imag ** 2)[:-1].astype(np.float32)
+    mel = mel_filters(n_mels) @ power.T
+    log_spec = np.log10(np.maximum(mel, 1e-10))
+    log_spec = np.maximum(log_spec, log_spec.max() - 8.0)
+    return ((log_spec + 4.0) / 4.0).astype(np.float32)
+
+
+def _log_mel_frames(audio: np.ndarray, received: int, first: int, last: int, n_mels: int) -> np.ndarray:
+    """
+    一個 30 秒視窗裡第 first..last-1 個 frame 的 log10 mel (未正規化)
+    等同先把 audio[:received] 補零到 30 秒再 reflect padding 的結果，但只算要的 frame
+    """
+    half = N_FFT // 2
+    positions = np.arange(first * HOP_LENGTH, (last - 1) * HOP_LENGTH + N_FFT) - half
+    positions = np.abs(positions)  # 視窗開頭 reflect
+    positions = np.where(positions >= N_SAMPLES, 2 * (N_SAMPLES - 1) - positions, positions)  # 30 秒處 reflect
+    segment = np.where(positions < received, audio[np.minimum(positions, max(received - 1, 0))], 0).astype(np.float32)
+    frames = np.lib.stride_tricks.as_strided(
+        segment,
+        shape=(last - first, N_FFT),
+        strides=(segment.strides[0] * HOP_LENGTH, segment.strides[0]),
+        writeable=False,
+    )
+    spectrum = np.fft.rfft(frames * _window(), axis=-1)
+    power = (spectrum.real ** 2 + spectrum.imag ** 2).astype(np.float32)
+    return np.log10(np.maximum(mel_filters(n_mels) @ power.T, 1e-10))
+
+
+class _FeatureWindow:
+    """一個 30 秒視窗: 收到的音訊與已經確定的 log10 mel frame"""
+
+    def __init__(self, n_mels: int):
+        self.audio = np.zeros(N_SAMPLES, dtype=np.float32)
+        self.received = 0
+        # 全是補零的 frame: log10(1e-10)
+        self.log_mel = np.full((n_mels, N_FRAMES), -10.0, dtype=np.float32)
+        self.settled = 0  # 前 settled 個 frame 的 STFT 範圍都已經有音訊，之後不會再變
+
+
+class IncrementalLogMel:
+    """
+    單一串流 (例如 hybrid 的一句話) 的增量 log-mel
+    每次 feed 只對新到的音訊算 STFT + mel，整段音訊不用每次重算；
+    features() 只補算最後幾個還沒有完整音訊的 frame，再做 Whisper 的整窗正規化 (逐元素運算，便宜)
+    視窗切法跟 transcribe_stream 一樣從頭每 30 秒一個，結果等同 log_mel_spectrogram(pad_or_trim(視窗))
+    feed / features 由同一個 thread 依序呼叫
+    """
+
+    def __init__(self, n_mels: int = 80):
+        self.n_mels = n_mels
+        self.samples = 0
+        self._windows: list[_FeatureWindow] = []
+
+    def feed(self, pcm_data) -> None:
+        """加入 PCM 16-bit 16kHz mono"""
+        audio = np.frombuffer(pcm_data, dtype=np.int16).astype(np.float32)
+        audio *= np.float32(1 / 32768.0)
+        offset = 0
+        while offset < len(audio):
+            if not self._windows or self._windows[-1].received == N_SAMPLES:
+                self._windows.append(_FeatureWindow(self.n_mels))
+            window = self._windows[-1]
+            take = min(len(audio) - offset, N_SAMPLES - window.received)
+            window.audio[window.received:window.received + take] = audio[offset:offset + take]
+            window.received += take
+            offset += take
+            self._settle(window)
+        self.samples += len(audio)
+
+    def _settle(self, window: _FeatureWindow) -> None:
+        """STFT 範圍 (中心前後 N_FFT / 2) 已經都收到的 frame 算好存起來"""
+        half = N_FFT // 2
+        settled = 0 if window.received < half else min(N_FRAMES, (window.received - half) // HOP_LENGTH + 1)
+        if settled > window.settled:
+            window.log_mel[:, window.settled:settled] = _log_mel_frames(
+                window.audio, window.received, window.settled, settled, self.n_mels
+            )
+            window.settled = settled
+
+    @property
+    def num_windows(self) -> int:
+        return len(self._windows)
+
+    def features(self, index: int = 0) -> np.ndarray:
+        """第 index 個 30 秒視窗的 (n_mels, 3000) encoder 輸入"""
+        window = self._windows[index]
+        log_spec = window.log_mel.copy()
+        # 還沒收到完整 STFT 範圍的尾端 frame，這次先當作後面補零 (跟 pad_or_trim 一樣) 算
+        tail = min(N_FRAMES, (window.received + N_FFT // 2 + HOP_LENGTH - 1) // HOP_LENGTH)
+        if tail > window.settled:
+            log_spec[:, window.settled:tail] = _log_mel_frames(
+                window.audio, window.received, window.settled, tail, self.n_mels
+            )
+        log_spec = np.maximum(log_spec, log_spec.max() - 8.0)
+        return (log_spec + 4.0) / 4.0
+
+    def reset(self) -> None:
+        self.samples = 0
+        self._windows = []
@@ -0,0 +1,51 @@
+// AudioWorklet: 把麥克風音訊降頻到 16 kHz int16，每湊滿一個 frame 就傳給主執行緒
+// 在 audio thread 執行，不會被 React render 卡住，也沒有 MediaRecorder 重啟造成的空隙
+
+class PcmCaptureProcessor extends AudioWorkletProcessor {
+  constructor(options) {
+    super();
+    const { targetSampleRate = 16000, frameSamples = 1600 } = options.processorOptions || {};
+    // sampleRate 是 AudioContext 的取樣率 (AudioWorkletGlobalScope 全域變數)
+    this.ratio = Math.max(1, sampleRate / targetSampleRate);
+    this.frameSamples = frameSamples;
+    this.frame = new Int16Array(frameSamples);
+    this.length = 0;
+    // 降頻: 每 ratio 個輸入 sample 取平均輸出一個 (簡單的低通，非整數倍率也適用)
+    this.phase = 0;
+    this.sum = 0;
+    this.count = 0;
+  }
+
+  process(inputs) {
+    const input = inputs[0] && inputs[0][0];
+    if (!input) {
+      return true;
+    }
+
+    for (let i = 0; i < input.length; i++) {
+      this.sum += input[i];
+      this.count += 1;
+      this.phase += 1;
+      if (this.phase >= this.ratio) {
+        this.phase -= this.ratio;
+        this.push(this.sum / this.count);
+        this.sum = 0;
+        this.count = 0;
+      }
+    }
+    return true;
+  }
+
+  push(sample) {
+    const clamped = Math.max(-1, Math.min(1, sample));
+    this.frame[this.length++] = clamped < 0 ? clamped * 0x8000 : clamped * 0x7fff;
+    if (this.length === this.frameSamples) {
+      // 轉移 buffer 所有權，不複製
+      this.port.postMessage(this.frame.buffer, [this.frame.buffer]);
+      this.frame = new Int16Array(this.frameSamples);
+      this.length = 0;
+    }
+  }
+}
+
+registerProcessor('pcm-capture', PcmCaptureProcessor);
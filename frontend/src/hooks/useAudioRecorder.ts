@@ -2,11 +2,26 @@ import { useState, useCallback, useRef, useEffect } from 'react';
 
 export type RecordingStatus = 'idle' | 'requesting' | 'recording' | 'error';
 
+// webm: MediaRecorder 每 1.5 秒產生一個完整的 WebM，伺服器用 ffmpeg 解碼
+// pcm: AudioWorklet 降頻成 16 kHz int16，每 100ms 送一個 frame，伺服器直接使用
+// stream: MediaRecorder 不重啟，每秒送出接續的 WebM 片段 (只有第一個帶 header)，伺服器增量解碼
+//         重新連線或伺服器回報解碼失敗時呼叫 restartStream 換一個新的 MediaRecorder，從 header 重新開始
+export type CaptureMode = 'webm' | 'pcm' | 'stream';
+
+interface UseAudioRecorderOptions {
+  captureMode?: CaptureMode;
+}
+
+const PCM_SAMPLE_RATE = 16000;
+const PCM_FRAME_SAMPLES = 1600; // 100ms
+const STREAM_TIMESLICE_MS = 1000;
+
 export interface UseAudioRecorderReturn {
   isRecording: boolean;
   recordingStatus: RecordingStatus;
   startRecording: () => Promise<void>;
   stopRecording: () => void;
+  restartStream: () => void;
   onAudioData: (callback: (data: ArrayBuffer) => void) => void;
   error: string | null;
   volumeLevel: number;
@@ -22,7 +37,8 @@ function getSupportedMimeType(): string {
   return '';
 }
 
-export function useAudioRecorder(): UseAudioRecorderReturn {
+export function useAudioRecorder(options: UseAudioRecorderOptions = {}): UseAudioRecorderReturn {
+  const { captureMode = 'webm' } = options;
   const [recordingStatus, setRecordingStatus] = useState<RecordingStatus>('idle');
   const [error, setError] = useState<string | null>(null);
   const [volumeLevel, setVolumeLevel] = useState<number>(0);
@@ -31,6 +47,7 @@ export function useAudioRecorder(): UseAudioRecorderReturn {
   const mediaStreamRef = useRef<MediaStream | null>(null);
   const audioContextRef = useRef<AudioContext | null>(null);
   const analyserRef = useRef<AnalyserNode | null>(null);
+  const workletNodeRef = useRef<AudioWorkletNode | null>(null);
   const audioCallbackRef = useRef<((data: ArrayBuffer) => void) | null>(null);
   const animationFrameRef = useRef<number | null>(null);
 
@@ -66,6 +83,11 @@ export function useAudioRecorder(): UseAudioRecorderReturn {
       }
     }
     mediaRecorderRef.current = null;
+    if (workletNodeRef.current) {
+      workletNodeRef.current.port.onmessage = null;
+      workletNodeRef.current.disconnect();
+      workletNodeRef.current = null;
+    }
     if (mediaStreamRef.current) {
       mediaStreamRef.current.getTracks().forEach((track) => track.stop());
       mediaStreamRef.current = null;
@@ -78,6 +100,63 @@ export function useAudioRecorder(): UseAudioRecorderReturn {
     setVolumeLevel(0);
   }, []);
 
+  const startPcmCapture = useCallback(
+    async (audioContext: AudioContext, source: MediaStreamAudioSourceNode): Promise<void> => {
+      if (!audioContext.audioWorklet) {
+        throw new Error('Browser does not support AudioWorklet');
+      }
+      await audioContext.audioWorklet.addModule('/pcm-capture-processor.js');
+
+      const workletNode = new AudioWorkletNode(audioContext, 'pcm-capture', {
+        processorOptions: { targetSampleRate: PCM_SAMPLE_RATE, frameSamples: PCM_FRAME_SAMPLES },
+      });
+      workletNode.port.onmessage = (event: MessageEvent<ArrayBuffer>) => {
+        audioCallbackRef.current?.(event.data);
+      };
+      workletNodeRef.current = workletNode;
+
+      // 接到靜音的 destination，確保瀏覽器會持續呼叫 worklet
+      const mute = audioContext.createGain();
+      mute.gain.value = 0;
+      source.connect(workletNode);
+      workletNode.connect(mute);
+      mute.connect(audioContext.destination);
+    },
+    []
+  );
+
+  const startStreamRecorder = useCallback((stream: MediaStream, mimeType: string) => {
+    const previous = mediaRecorderRef.current;
+    const mediaRecorder = new MediaRecorder(stream, { mimeType });
+    mediaRecorderRef.current = mediaRecorder;
+
+    // 片段必須依序送出，後面的片段要接在前面的後面才能解碼
+    let sendChain = Promise.resolve();
+    mediaRecorder.ondataavailable = (event: BlobEvent) => {
+      if (event.data.size === 0) return;
+      const blob = event.data;
+      sendChain = sendChain.then(async () => {
+        const arrayBuffer = await blob.arrayBuffer();
+        // 已經被換掉的 MediaRecorder 剩下的片段接不上新的串流，不送
+        if (mediaRecorderRef.current !== mediaRecorder) return;
+        audioCallbackRef.current?.(arrayBuffer);
+      });
+    };
+
+    if (previous && previous.state !== 'inactive') {
+      previous.stop();
+    }
+    mediaRecorder.start(STREAM_TIMESLICE_MS);
+  }, []);
+
+  const restartStream = useCallback(() => {
+    const current = mediaRecorderRef.current;
+    if (captureMode !== 'stream' || !current || current.state === 'inactive' || !mediaStreamRef.current) {
+      return;
+    }
+    startStreamRecorder(mediaStreamRef.current, current.mimeType);
+  }, [captureMode, startStreamRecorder]);
+
   const startRecording = useCallback(async (): Promise<void> => {
     try {
       setRecordingStatus('requesting');
@@ -108,11 +187,25 @@ export function useAudioRecorder(): UseAudioRecorderReturn {
       source.connect(analyser);
       analyserRef.current = analyser;
 
+      if (captureMode === 'pcm') {
+        await startPcmCapture(audioContext, source);
+        setRecordingStatus('recording');
+        analyzeVolume();
+        return;
+      }
+
       const mimeType = getSupportedMimeType();
       if (!mimeType) {
         throw new Error('No supported audio format');
       }
 
+      if (captureMode === 'stream') {
+        startStreamRecorder(stream, mimeType);
+        setRecordingStatus('recording');
+        analyzeVolume();
+        return;
+      }
+
       const mediaRecorder = new MediaRecorder(stream, { mimeType });
       mediaRecorderRef.current = mediaRecorder;
 
@@ -156,7 +249,7 @@ export function useAudioRecorder(): UseAudioRecorderReturn {
       setRecordingStatus('error');
       throw err;
     }
-  }, [cleanupResources, analyzeVolume]);
+  }, [cleanupResources, analyzeVolume, captureMode, startPcmCapture, startStreamRecorder]);
 
   const stopRecording = useCallback(() => {
     cleanupResources();
@@ -174,6 +267,7 @@ export function useAudioRecorder(): UseAudioRecorderReturn {
     recordingStatus,
     startRecording,
     stopRecording,
+    restartStream,
     onAudioData,
     error,
     volumeLevel,
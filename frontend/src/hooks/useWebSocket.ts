@@ -2,19 +2,25 @@ import { useState, useCallback, useRef, useEffect } from 'react';
 
 export type ConnectionStatus = 'disconnected' | 'connecting' | 'connected' | 'reconnecting';
 
+// webm: 完整的 WebM/Opus 檔；pcm16: 16 kHz mono int16 little-endian
+// webm-stream: 單一 MediaRecorder 接續的片段，只有第一個帶 EBML header
+export type AudioFormat = 'webm' | 'pcm16' | 'webm-stream';
+
 interface UseWebSocketOptions {
   url?: string;
   autoReconnect?: boolean;
   reconnectInterval?: number;
   maxReconnectAttempts?: number;
   onTranscript?: (text: string, isFinal: boolean) => void;
+  onServerError?: (code: string | undefined, message: string) => void;
 }
 
 export interface UseWebSocketReturn {
   isConnected: boolean;
   connectionStatus: ConnectionStatus;
-  sendAudio: (audioData: ArrayBuffer) => void;
+  sendAudio: (audioData: ArrayBuffer, format?: AudioFormat) => void;
   transcript: string;
+  partialTranscript: string;
   connect: () => void;
   disconnect: () => void;
   clearTranscript: () => void;
@@ -29,10 +35,16 @@ export function useWebSocket(options: UseWebSocketOptions = {}): UseWebSocketRet
     reconnectInterval = 3000,
     maxReconnectAttempts = 5,
     onTranscript,
+    onServerError,
   } = options;
 
   const [connectionStatus, setConnectionStatus] = useState<ConnectionStatus>('disconnected');
   const [transcript, setTranscript] = useState<string>('');
+  // hybrid 模式: 本地模型的即時結果，之後會被同一句 (utterance_id) 的 final 取代
+  const [partialTranscript, setPartialTranscript] = useState<string>('');
+  const partialUtteranceIdRef = useRef<number | null>(null);
+  // 辨識途中先送來的段落 (segment)，同一個 seq 的 transcript 到了就取代
+  const segmentSeqRef = useRef<number | null>(null);
 
   const wsRef = useRef<WebSocket | null>(null);
   const reconnectAttemptsRef = useRef<number>(0);
@@ -92,16 +104,40 @@ export function useWebSocket(options: UseWebSocketOptions = {}): UseWebSocketRet
         try {
           console.log('WebSocket received:', event.data);
           const message = JSON.parse(event.data);
-          if (message.type === 'transcript') {
+          if (message.type === 'segment') {
+            if (message.seq === segmentSeqRef.current) {
+              setPartialTranscript((prev) => prev + message.text);
+            } else {
+              segmentSeqRef.current = message.seq;
+              partialUtteranceIdRef.current = null;
+              setPartialTranscript(message.text);
+            }
+          } else if (message.type === 'transcript') {
             console.log('Transcript received:', message.text, 'is_final:', message.is_final);
+            const utteranceId: number | null = message.utterance_id ?? null;
             if (message.is_final) {
-              setTranscript((prev) => {
-                const newText = prev ? `${prev} ${message.text}` : message.text;
-                console.log('Updated transcript:', newText);
-                return newText;
-              });
+              if (message.text) {
+                setTranscript((prev) => {
+                  const newText = prev ? `${prev} ${message.text}` : message.text;
+                  console.log('Updated transcript:', newText);
+                  return newText;
+                });
+              }
+              if (utteranceId === null || utteranceId === partialUtteranceIdRef.current) {
+                partialUtteranceIdRef.current = null;
+                segmentSeqRef.current = null;
+                setPartialTranscript('');
+              }
+            } else {
+              partialUtteranceIdRef.current = utteranceId;
+              setPartialTranscript(message.text);
             }
             onTranscript?.(message.text, message.is_final);
+          } else if (message.type === 'error') {
+            // 例如 code=capacity: 伺服器滿載，連線會被關閉 (1013)，之後自動重連
+            // code=stream: 串流解碼失敗，錄音端要從新的 header 重新開始
+            console.error('Server error:', message.code, message.message);
+            onServerError?.(message.code, message.message);
           }
         } catch (e) {
           console.error('Failed to parse message:', e);
@@ -111,9 +147,9 @@ export function useWebSocket(options: UseWebSocketOptions = {}): UseWebSocketRet
       setConnectionStatus('disconnected');
       console.error('WebSocket connection error:', e);
     }
-  }, [url, autoReconnect, reconnectInterval, maxReconnectAttempts, onTranscript]);
+  }, [url, autoReconnect, reconnectInterval, maxReconnectAttempts, onTranscript, onServerError]);
 
-  const sendAudio = useCallback((audioData: ArrayBuffer) => {
+  const sendAudio = useCallback((audioData: ArrayBuffer, format: AudioFormat = 'webm') => {
     if (wsRef.current && wsRef.current.readyState === WebSocket.OPEN) {
       const uint8Array = new Uint8Array(audioData);
       let binary = '';
@@ -121,12 +157,18 @@ export function useWebSocket(options: UseWebSocketOptions = {}): UseWebSocketRet
         binary += String.fromCharCode(uint8Array[i]);
       }
       const base64Audio = btoa(binary);
-      wsRef.current.send(JSON.stringify({ type: 'audio', data: base64Audio }));
+      const message = format === 'webm'
+        ? { type: 'audio', data: base64Audio }
+        : { type: 'audio', format, data: base64Audio };
+      wsRef.current.send(JSON.stringify(message));
     }
   }, []);
 
   const clearTranscript = useCallback(() => {
     setTranscript('');
+    setPartialTranscript('');
+    partialUtteranceIdRef.current = null;
+    segmentSeqRef.current = null;
   }, []);
 
   useEffect(() => {
@@ -144,6 +186,7 @@ export function useWebSocket(options: UseWebSocketOptions = {}): UseWebSocketRet
     connectionStatus,
     sendAudio,
     transcript,
+    partialTranscript,
     connect,
     disconnect,
     clearTranscript,
@@ -1,31 +1,56 @@
 import { useEffect, useCallback } from 'react';
 import { TextDisplay } from '../components/TextDisplay';
 import { ControlBar } from '../components/ControlBar';
-import { useWebSocket } from '../hooks/useWebSocket';
-import { useAudioRecorder } from '../hooks/useAudioRecorder';
+import { useWebSocket, type AudioFormat } from '../hooks/useWebSocket';
+import { useAudioRecorder, type CaptureMode } from '../hooks/useAudioRecorder';
+
+// 網址加上 ?capture=pcm 改用 AudioWorklet 串流 PCM，?capture=stream 改用不重啟的 MediaRecorder
+const CAPTURE_PARAM = new URLSearchParams(window.location.search).get('capture');
+const CAPTURE_MODE: CaptureMode =
+  CAPTURE_PARAM === 'pcm' || CAPTURE_PARAM === 'stream' ? CAPTURE_PARAM : 'webm';
+const AUDIO_FORMATS: Record<CaptureMode, AudioFormat> = {
+  webm: 'webm',
+  pcm: 'pcm16',
+  stream: 'webm-stream',
+};
 
 function VoiceApp() {
+  const {
+    isRecording,
+    startRecording,
+    stopRecording,
+    restartStream,
+    onAudioData,
+    volumeLevel,
+  } = useAudioRecorder({ captureMode: CAPTURE_MODE });
+
+  const handleServerError = useCallback((code: string | undefined) => {
+    if (code === 'stream') {
+      restartStream();
+    }
+  }, [restartStream]);
+
   const {
     isConnected,
     sendAudio,
     transcript,
+    partialTranscript,
     connect,
     clearTranscript,
-  } = useWebSocket();
+  } = useWebSocket({ onServerError: handleServerError });
 
-  const {
-    isRecording,
-    startRecording,
-    stopRecording,
-    onAudioData,
-    volumeLevel,
-  } = useAudioRecorder();
+  // stream 模式: 新的連線 (含自動重連) 沒收過 header，錄音中就從新的 header 重新開始
+  useEffect(() => {
+    if (isConnected) {
+      restartStream();
+    }
+  }, [isConnected, restartStream]);
 
   // Set up audio data callback
   useEffect(() => {
     onAudioData((data) => {
       if (isConnected) {
-        sendAudio(data);
+        sendAudio(data, AUDIO_FORMATS[CAPTURE_MODE]);
       }
     });
   }, [onAudioData, sendAudio, isConnected]);
@@ -47,6 +72,10 @@ function VoiceApp() {
     }
   }, [isRecording, isConnected, startRecording, stopRecording, connect]);
 
+  const displayText = partialTranscript
+    ? (transcript ? `${transcript} ${partialTranscript}` : partialTranscript)
+    : transcript;
+
   const handleClearClick = useCallback(() => {
     clearTranscript();
   }, [clearTranscript]);
@@ -54,13 +83,13 @@ function VoiceApp() {
   return (
     <div className="h-full flex flex-col bg-gray-900">
       {/* Top half - flipped for person across */}
-      <TextDisplay text={transcript} isFlipped={true} />
+      <TextDisplay text={displayText} isFlipped={true} />
 
       {/* Divider */}
       <div className="h-px bg-gray-600" />
 
       {/* Bottom half - normal for self */}
-      <TextDisplay text={transcript} isFlipped={false} />
+      <TextDisplay text={displayText} isFlipped={false} />
 
       {/* Control bar */}
       <ControlBar